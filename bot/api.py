@@ -1,16 +1,20 @@
 """Small FastAPI app to expose endpoints for the web dashboard to control bot settings and stream events."""
 import os
 import json
-from datetime import datetime
-from fastapi import FastAPI, HTTPException
-from fastapi.responses import StreamingResponse
+from datetime import datetime, timedelta
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import StreamingResponse, PlainTextResponse
 from pydantic import BaseModel
 
+from sqlalchemy import select, func
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from sqlalchemy.orm import sessionmaker
 
-from shared.models import AIChannel, UsageLog, Base, ChatLog
+from shared.models import AIChannel, UsageLog, ChatLog, Quota, SystemState, GuildConfig, migrate
 from bot.events import broadcaster
+from bot.eventbus import event_bus
+from bot.telemetry import metrics_reporter
+from bot.registry import channel_registry
 
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite+aiosqlite:///./bot.db")
 
@@ -41,7 +45,24 @@ class ChannelPayload(BaseModel):
 @app.on_event("startup")
 async def startup():
     async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
+        await conn.run_sync(migrate)
+    # receive the bot process's events (chat, music, channels) and send ours (config, music control)
+    broadcaster.register_handler(relay_music_events)
+    await event_bus.start(broadcaster)
+    metrics_reporter.start(f"api-{os.getpid()}")
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    broadcaster.flush()
+    await metrics_reporter.close()
+    await event_bus.close()
+
+
+async def relay_music_events(data):
+    """Music state published by the bot process reaches Socket.IO clients connected here."""
+    if isinstance(data, dict) and "origin" in data and data.get("type") in ("music:play", "music:queue_update"):
+        await sio.emit(data["type"], data.get("payload"))
 
 
 @app.post("/api/channels")
@@ -54,6 +75,14 @@ async def add_channel(payload: ChannelPayload):
         ch = AIChannel(guild_id=payload.guild_id, channel_id=payload.channel_id, name=payload.name)
         session.add(ch)
         await session.commit()
+    channel_registry.add(payload.channel_id, payload.guild_id)
+
+    # publish event so the bot's channel registry and web clients pick it up
+    try:
+        broadcaster.publish({"type": "channel:created", "payload": {"id": payload.channel_id, "name": payload.name, "type": ch.type or "public", "guild_id": payload.guild_id}})
+    except Exception:
+        pass
+
     return {"ok": True}
 
 
@@ -66,6 +95,7 @@ async def remove_channel(channel_id: int):
             raise HTTPException(404, "Not found")
         await session.execute(AIChannel.__table__.delete().where(AIChannel.channel_id == channel_id))
         await session.commit()
+    channel_registry.remove(channel_id)
 
     # publish event so web clients can remove UI
     try:
@@ -112,15 +142,16 @@ async def stats():
 
 @app.get('/api/monitor')
 async def monitor():
-    # Summarize token usage and quota
+    # Summarize token usage inside the quota window (the bot enforces the same window in memory)
     quota_name = 'free_tokens'
     async with AsyncSessionLocal() as session:
-        q = await session.execute(UsageLog.__table__.select())
-        rows = q.fetchall()
-        total_tokens = sum(r[0] for r in [(row.tokens,) for row in rows]) if rows else 0
         qx = await session.execute(Quota.__table__.select().where(Quota.name == quota_name))
-        qrow = qx.scalar_one_or_none()
+        qrow = qx.first()
         quota = qrow.limit if qrow else None
+        window = int(qrow.window_seconds or 86400) if qrow else 86400
+        since = datetime.utcnow() - timedelta(seconds=window)
+        q = await session.execute(select(func.coalesce(func.sum(UsageLog.tokens), 0.0)).where(UsageLog.created_at >= since))
+        total_tokens = q.scalar() or 0.0
     # basic system metrics (best-effort)
     try:
         import psutil, time
@@ -129,7 +160,102 @@ async def monitor():
     except Exception:
         mem = None
         uptime = None
-    return {"tokens_used": float(total_tokens), "quota": quota, "memory": mem, "uptime": int(uptime) if uptime else None}
+    return {"tokens_used": float(total_tokens), "quota": quota, "window_seconds": window, "memory": mem, "uptime": int(uptime) if uptime else None}
+
+
+class PausePayload(BaseModel):
+    paused: bool
+
+
+@app.post("/api/ai/pause")
+async def set_ai_paused(payload: PausePayload):
+    """Pause / resume AI replies for every guild"""
+    value = "1" if payload.paused else "0"
+    async with AsyncSessionLocal() as session:
+        q = await session.execute(SystemState.__table__.select().where(SystemState.key == "ai_paused"))
+        existing = q.first()
+        if existing:
+            await session.execute(SystemState.__table__.update().where(SystemState.key == "ai_paused").values(value=value, updated_at=datetime.utcnow()))
+        else:
+            session.add(SystemState(key="ai_paused", value=value))
+        await session.commit()
+    # guild config snapshots carry the pause flag: invalidate all of them
+    broadcaster.publish({"type": "config:updated", "payload": {"guild_id": None, "ai_paused": payload.paused}})
+    return {"ok": True, "paused": payload.paused}
+
+
+class QuotaPayload(BaseModel):
+    limit: float
+    window_seconds: int = 86400
+
+
+@app.put("/api/quota/{name}")
+async def set_quota(name: str, payload: QuotaPayload):
+    """Create or update a quota (`free_tokens`, `guild:<id>` or `user:<id>`)"""
+    if payload.limit < 0 or payload.window_seconds <= 0:
+        raise HTTPException(status_code=400, detail="invalid quota")
+    async with AsyncSessionLocal() as session:
+        q = await session.execute(Quota.__table__.select().where(Quota.name == name))
+        if q.first():
+            await session.execute(Quota.__table__.update().where(Quota.name == name).values(limit=payload.limit, window_seconds=payload.window_seconds, updated_at=datetime.utcnow()))
+        else:
+            session.add(Quota(name=name, limit=payload.limit, window_seconds=payload.window_seconds))
+        await session.commit()
+    broadcaster.publish({"type": "quota:updated", "payload": {"name": name}})
+    return {"ok": True, "name": name, "limit": payload.limit, "window_seconds": payload.window_seconds}
+
+
+class IntentsPayload(BaseModel):
+    intents: list[dict]
+
+
+@app.get("/api/guilds/{guild_id}/intents")
+async def get_intents(guild_id: int):
+    from bot.intents import DEFAULT_INTENTS
+    async with AsyncSessionLocal() as session:
+        q = await session.execute(GuildConfig.__table__.select().where(GuildConfig.guild_id == guild_id))
+        row = q.first()
+    custom = json.loads(row.intents) if row and row.intents else []
+    return {"defaults": DEFAULT_INTENTS, "intents": custom}
+
+
+@app.put("/api/guilds/{guild_id}/intents")
+async def set_intents(guild_id: int, payload: IntentsPayload):
+    """Replace a guild's custom intents; the bot recompiles its matcher on `intents:updated`"""
+    raw = json.dumps(payload.intents, ensure_ascii=False)
+    async with AsyncSessionLocal() as session:
+        q = await session.execute(GuildConfig.__table__.select().where(GuildConfig.guild_id == guild_id))
+        if q.first():
+            await session.execute(GuildConfig.__table__.update().where(GuildConfig.guild_id == guild_id).values(intents=raw))
+        else:
+            session.add(GuildConfig(guild_id=guild_id, intents=raw))
+        await session.commit()
+    broadcaster.publish({"type": "intents:updated", "payload": {"guild_id": guild_id}})
+    return {"ok": True}
+
+
+@app.get("/api/cache")
+async def cache_stats():
+    """Hit/miss counters of the Gemini response cache, per bot process"""
+    return metrics_reporter.section("cache")
+
+
+@app.get("/api/gemini")
+async def gemini_stats():
+    """Gemini client counters (backend, single-flight sharing, scheduler, breakers, cache), per bot process"""
+    return metrics_reporter.section("gemini")
+
+
+@app.get("/api/events")
+async def event_stats():
+    """SSE subscriber buffers (count, buffered events, worst lag, drops, evictions) and event bus counters"""
+    return dict(broadcaster.stats(), bus=event_bus.stats())
+
+
+@app.get("/api/metrics", response_class=PlainTextResponse)
+async def stage_metrics():
+    """Per-stage latency histograms and gauges of every process, in the Prometheus text exposition format"""
+    return PlainTextResponse(metrics_reporter.render(), media_type="text/plain; version=0.0.4")
 
 
 @app.get("/api/chatlogs")
@@ -155,6 +281,8 @@ async def chatlogs(limit: int = 100):
                 "user_message": r["user_message"],
                 "bot_response": r["bot_response"],
                 "tokens": float(r["tokens"] or 0.0),
+                "queue_ms": float(r.get("queue_ms") or 0.0),
+                "ttft_ms": float(r.get("ttft_ms") or 0.0),
                 "latency_ms": float(r["latency_ms"] or 0.0),
                 "created_at": r["created_at"].isoformat() if r["created_at"] else None,
             })
@@ -162,14 +290,23 @@ async def chatlogs(limit: int = 100):
 
 
 @app.get("/api/stream")
-async def stream():
-    """Server Sent Events stream. Clients receive newline-delimited JSON payloads as SSE data."""
+async def stream(request: Request, types: str | None = None, guild_id: int | None = None, last_event_id: str | None = None):
+    """Server Sent Events stream. Clients receive newline-delimited JSON payloads as SSE data.
+
+    `types` is a comma-separated list of event types or namespaces (`chat,network,music`);
+    `guild_id` drops events that belong to other guilds. Without filters every event is sent.
+    A `Last-Event-ID` header (or `last_event_id` parameter) replays the events missed since then.
+    """
+    topics = [t.strip() for t in types.split(",") if t.strip()] if types else None
+    last_event_id = request.headers.get("last-event-id") or last_event_id
+
     async def event_generator():
-        q = broadcaster.subscribe()
+        # bounded buffer: a stalled client loses old events or is evicted (the stream then ends)
+        q = broadcaster.subscribe(topics=topics, guild_id=guild_id, last_event_id=last_event_id)
         try:
-            while True:
-                data = await q.get()
-                yield f"data: {json.dumps(data)}\n\n"
+            # frames are pre-encoded by the broadcaster; a chunk may hold several of them
+            async for chunk in q:
+                yield chunk
         finally:
             broadcaster.unsubscribe(q)
 
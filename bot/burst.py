@@ -0,0 +1,116 @@
+"""Burst coalescing: merge a user's rapid consecutive messages in one channel into a single prompt."""
+import os
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from typing import Dict, Hashable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# quiet period that closes a burst of follow-ups, and the longest follow-ups may be held (seconds).
+# The first message is answered at once; only messages arriving while its reply is in flight or
+# within BURST_WINDOW of the previous one wait, so a single message is never delayed.
+BURST_WINDOW = float(os.getenv("BURST_WINDOW", "1.0"))
+BURST_MAX_WAIT = float(os.getenv("BURST_MAX_WAIT", "4.0"))
+
+
+class _Burst:
+    __slots__ = ("items", "first", "last", "busy", "waiting", "event", "timer")
+
+    def __init__(self, now: float):
+        self.items: List = []
+        self.first = now
+        self.last = now
+        self.busy = False
+        self.waiting = False
+        self.event = asyncio.Event()
+        self.timer: Optional[asyncio.TimerHandle] = None
+
+
+class BurstCoalescer:
+    """Leading-edge debounce per key (e.g. (user_id, channel_id)).
+
+    The first message is handed back immediately as a burst of one and the key is marked busy
+    until done(key). Messages arriving while it is busy, or within `window` seconds of the last
+    message, are merged: the first of them waits for the running reply to finish and for
+    `window` seconds of quiet (at most `max_wait` after it arrived), then receives all of them.
+    The others get None and should not be answered on their own. Use turn() to pair both calls.
+    """
+
+    def __init__(self, window: float = BURST_WINDOW, max_wait: float = BURST_MAX_WAIT):
+        self.window = window
+        self.max_wait = max_wait
+        self._bursts: Dict[Hashable, _Burst] = {}
+        self.bursts = 0
+        self.merged = 0
+
+    @asynccontextmanager
+    async def turn(self, key: Hashable, item):
+        """collect() and, once the block exits with a burst to answer, done()."""
+        items = await self.collect(key, item)
+        try:
+            yield items
+        finally:
+            if items is not None:
+                self.done(key)
+
+    async def collect(self, key: Hashable, item) -> Optional[List]:
+        if self.window <= 0:
+            return [item]
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        burst = self._bursts.get(key)
+        if burst is None:
+            burst = self._bursts[key] = _Burst(now)
+            burst.busy = True
+            self.bursts += 1
+            return [item]
+        if not burst.items:
+            burst.first = now
+        burst.items.append(item)
+        burst.last = now
+        burst.event.set()
+        if burst.waiting:
+            self.merged += 1
+            return None
+        burst.waiting = True
+        try:
+            while True:
+                remaining = min(burst.last + self.window, burst.first + self.max_wait) - loop.time()
+                if not burst.busy and remaining <= 0:
+                    break
+                burst.event.clear()
+                try:
+                    # an unfinished reply is waited for however long it takes
+                    await asyncio.wait_for(burst.event.wait(), remaining if remaining > 0 else None)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            burst.waiting = False
+        items, burst.items = burst.items, []
+        burst.busy = True
+        self.bursts += 1
+        return items
+
+    def done(self, key: Hashable) -> None:
+        """The reply to the burst collect() returned for `key` was sent."""
+        burst = self._bursts.get(key)
+        if burst is None:
+            return
+        burst.busy = False
+        burst.event.set()
+        if burst.timer is not None:
+            burst.timer.cancel()
+        burst.timer = asyncio.get_running_loop().call_later(self.window, self._expire, key, burst)
+
+    def _expire(self, key: Hashable, burst: _Burst) -> None:
+        # forget an idle key once a window passed after its last reply
+        if self._bursts.get(key) is burst and not burst.busy and not burst.waiting:
+            del self._bursts[key]
+
+    def stats(self) -> dict:
+        return {"open": len(self._bursts), "bursts": self.bursts, "merged": self.merged}
+
+
+# singleton
+burst_coalescer = BurstCoalescer()
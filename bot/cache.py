@@ -0,0 +1,153 @@
+"""Response cache in front of Gemini: in-memory LRU with per-entry TTL and an optional SQLite tier."""
+import os
+import time
+import asyncio
+import hashlib
+import logging
+import unicodedata
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+import aiosqlite
+
+logger = logging.getLogger(__name__)
+
+CACHE_MAX_ENTRIES = int(os.getenv("GEMINI_CACHE_SIZE", "1024"))
+CACHE_MAX_BYTES = int(os.getenv("GEMINI_CACHE_MAX_BYTES", str(8 * 1024 * 1024)))
+CACHE_TTL = float(os.getenv("GEMINI_CACHE_TTL", "3600"))
+# path of the on-disk tier; empty disables it
+CACHE_DB_PATH = os.getenv("GEMINI_CACHE_DB", "")
+
+
+def normalize_prompt(prompt: str) -> str:
+    return " ".join(unicodedata.normalize("NFKC", prompt or "").split())
+
+
+def make_key(model: str, system: str | None, prompt: str) -> str:
+    raw = f"{model}\x00{system or ''}\x00{normalize_prompt(prompt)}"
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """LRU + TTL cache of chat responses keyed on (model, system, normalized prompt).
+
+    Memory is bounded both by entry count and by the total encoded size of cached texts.
+    When `db_path` is set, entries are written through to SQLite so they survive restarts.
+    """
+
+    def __init__(self, max_entries: int = CACHE_MAX_ENTRIES, max_bytes: int = CACHE_MAX_BYTES, ttl: float = CACHE_TTL, db_path: str = CACHE_DB_PATH):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.db_path = db_path
+        # key -> (text, tokens, expires_at, size)
+        self._entries: "OrderedDict[str, Tuple[str, float, float, int]]" = OrderedDict()
+        self._bytes = 0
+        self._db: Optional[aiosqlite.Connection] = None
+        self._db_lock = asyncio.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    async def _get_db(self) -> Optional[aiosqlite.Connection]:
+        if not self.db_path:
+            return None
+        if self._db is not None:
+            return self._db
+        # concurrent first lookups share one connection; it is published once the table exists
+        async with self._db_lock:
+            if self._db is None:
+                db = await aiosqlite.connect(self.db_path)
+                try:
+                    await db.execute(
+                        "CREATE TABLE IF NOT EXISTS response_cache (key TEXT PRIMARY KEY, text TEXT NOT NULL, tokens REAL, expires_at REAL NOT NULL)"
+                    )
+                    await db.execute("DELETE FROM response_cache WHERE expires_at < ?", (time.time(),))
+                    await db.commit()
+                except BaseException:
+                    await db.close()
+                    raise
+                self._db = db
+        return self._db
+
+    def _drop(self, key: str) -> None:
+        entry = self._entries.pop(key, None)
+        if entry:
+            self._bytes -= entry[3]
+
+    def _put_memory(self, key: str, text: str, tokens: float, expires_at: float) -> None:
+        self._drop(key)
+        size = len(text.encode("utf-8"))
+        if size > self.max_bytes:
+            return
+        self._entries[key] = (text, tokens, expires_at, size)
+        self._bytes += size
+        while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+            _, old = self._entries.popitem(last=False)
+            self._bytes -= old[3]
+            self.evictions += 1
+
+    async def get(self, key: str) -> Optional[dict]:
+        now = time.time()
+        entry = self._entries.get(key)
+        if entry:
+            if entry[2] > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return {"text": entry[0], "tokens": entry[1], "cached": True}
+            self._drop(key)
+        try:
+            db = await self._get_db()
+            if db is not None:
+                async with db.execute("SELECT text, tokens, expires_at FROM response_cache WHERE key = ?", (key,)) as cur:
+                    row = await cur.fetchone()
+                if row and row[2] > now:
+                    self._put_memory(key, row[0], row[1] or 0.0, row[2])
+                    self.hits += 1
+                    self.disk_hits += 1
+                    return {"text": row[0], "tokens": row[1] or 0.0, "cached": True}
+        except Exception:
+            logger.exception("Response cache disk read failed")
+        self.misses += 1
+        return None
+
+    async def set(self, key: str, text: str, tokens: float, ttl: float | None = None) -> None:
+        if not text:
+            return
+        expires_at = time.time() + (self.ttl if ttl is None else ttl)
+        self._put_memory(key, text, tokens, expires_at)
+        try:
+            db = await self._get_db()
+            if db is not None:
+                await db.execute(
+                    "INSERT OR REPLACE INTO response_cache (key, text, tokens, expires_at) VALUES (?, ?, ?, ?)",
+                    (key, text, tokens, expires_at),
+                )
+                await db.commit()
+        except Exception:
+            logger.exception("Response cache disk write failed")
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": (self.hits / lookups) if lookups else 0.0,
+        }
+
+    async def close(self) -> None:
+        if self._db is not None:
+            try:
+                await self._db.close()
+            except Exception:
+                pass
+            self._db = None
+
+
+# singleton
+response_cache = ResponseCache()
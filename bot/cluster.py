@@ -0,0 +1,303 @@
+"""Clustered runtime: a supervisor runs Discord shards across several worker processes.
+
+    python -m bot.cluster --workers 4 [--shards 16]
+
+The supervisor splits shard ids into contiguous ranges, starts one worker process per range
+(each runs an AutoShardedBot with the usual cogs) and restarts workers that exit. When the
+event bus is disabled it also hosts a small IPC hub on a Unix socket: broadcaster events
+listed in SYNC_TYPES are relayed between workers, so channel registry changes, config/quota
+updates and music control reach every shard. The hub also carries the event bus's
+unsequenced messages (quota usage), which never go through the broadcaster.
+"""
+import os
+import sys
+import json
+import signal
+import asyncio
+import logging
+import argparse
+import multiprocessing
+from typing import Dict, List, Optional, Set
+
+from bot.events import broadcaster
+from bot.eventbus import event_bus
+
+logger = logging.getLogger(__name__)
+
+CLUSTER_SOCKET = os.getenv("CLUSTER_SOCKET", "./bot-cluster.sock")
+CLUSTER_WORKERS = int(os.getenv("CLUSTER_WORKERS", "2"))
+# 0 = ask Discord for the recommended shard count
+CLUSTER_SHARDS = int(os.getenv("CLUSTER_SHARDS", "0"))
+RESTART_BACKOFF_MAX = 60.0
+# a worker that stayed up this long gets its restart backoff reset (seconds)
+HEALTHY_UPTIME = 300.0
+# how long stopping workers get to flush buffered rows and histories before they are killed
+# (seconds; keep `docker stop -t` / stop_grace_period above this)
+WORKER_STOP_TIMEOUT = float(os.getenv("CLUSTER_STOP_TIMEOUT", "20"))
+
+SYNC_TYPES = {
+    "channel:created", "channel:deleted",
+    "config:updated", "intents:updated",
+    "quota:updated",
+    "music:control",
+}
+
+
+def shard_ranges(shard_count: int, workers: int) -> List[List[int]]:
+    """Split shard ids 0..shard_count-1 into at most `workers` contiguous, balanced ranges."""
+    workers = max(1, min(workers, shard_count))
+    base, extra = divmod(shard_count, workers)
+    ranges, start = [], 0
+    for i in range(workers):
+        size = base + (1 if i < extra else 0)
+        ranges.append(list(range(start, start + size)))
+        start += size
+    return ranges
+
+
+async def recommended_shards(token: Optional[str]) -> int:
+    if not token:
+        return 1
+    import aiohttp
+    try:
+        async with aiohttp.ClientSession() as session:
+            async with session.get("https://discord.com/api/v10/gateway/bot", headers={"Authorization": f"Bot {token}"}) as resp:
+                resp.raise_for_status()
+                return int((await resp.json()).get("shards") or 1)
+    except Exception:
+        logger.exception("Could not fetch recommended shard count, using 1")
+        return 1
+
+
+class ClusterHub:
+    """Line-delimited JSON relay: every message from one worker is sent to all the others."""
+
+    def __init__(self, path: str = CLUSTER_SOCKET):
+        self.path = path
+        self._writers: Set[asyncio.StreamWriter] = set()
+        self._server: asyncio.AbstractServer | None = None
+        self.relayed = 0
+
+    async def start(self) -> None:
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self._server = await asyncio.start_unix_server(self._handle, path=self.path)
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self._writers.add(writer)
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                for w in list(self._writers):
+                    if w is writer:
+                        continue
+                    try:
+                        w.write(line)
+                    except Exception:
+                        self._writers.discard(w)
+                self.relayed += 1
+                await asyncio.gather(*(w.drain() for w in list(self._writers) if w is not writer), return_exceptions=True)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self._writers.discard(writer)
+            writer.close()
+
+    async def close(self) -> None:
+        for w in list(self._writers):
+            w.close()
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+class ClusterLink:
+    """Worker side of the hub: forwards local SYNC_TYPES events and republishes remote ones.
+
+    Remote events are republished with an `origin` key (the sending worker id); events that
+    carry one are never forwarded again, which keeps the relay loop-free.
+    """
+
+    def __init__(self, worker_id: int, path: str = CLUSTER_SOCKET):
+        self.worker_id = worker_id
+        self.path = path
+        self._writer: asyncio.StreamWriter | None = None
+        self._task: asyncio.Task | None = None
+
+    async def start(self) -> None:
+        broadcaster.register_handler(self._forward)
+        event_bus.relay_through(self._send)
+        self._task = asyncio.create_task(self._run())
+
+    async def _run(self) -> None:
+        delay = 0.5
+        while True:
+            try:
+                reader, self._writer = await asyncio.open_unix_connection(self.path)
+                delay = 0.5
+                while True:
+                    line = await reader.readline()
+                    if not line:
+                        break
+                    try:
+                        data = json.loads(line)
+                    except ValueError:
+                        continue
+                    if not event_bus.consume(data):
+                        broadcaster.publish(data)
+            except (ConnectionError, FileNotFoundError, OSError):
+                pass
+            except Exception:
+                logger.exception("Cluster link failed")
+            self._writer = None
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 10.0)
+
+    async def _forward(self, data) -> None:
+        if not isinstance(data, dict) or data.get("type") not in SYNC_TYPES or "origin" in data:
+            return
+        writer = self._writer
+        if writer is None:
+            return
+        try:
+            writer.write(json.dumps(dict(data, origin=self.worker_id), default=str).encode("utf-8") + b"\n")
+            await writer.drain()
+        except Exception:
+            logger.exception("Cluster forward failed")
+
+    def _send(self, body: str) -> None:
+        # unsequenced bus messages (see EventBus.send); dropped while the hub is unreachable
+        writer = self._writer
+        if writer is None:
+            return
+        try:
+            writer.write(body.encode("utf-8") + b"\n")
+        except Exception:
+            logger.exception("Cluster send failed")
+
+    async def close(self) -> None:
+        broadcaster.unregister_handler(self._forward)
+        event_bus.relay_through(None)
+        if self._task is not None:
+            self._task.cancel()
+        if self._writer is not None:
+            self._writer.close()
+
+
+def _worker_main(worker_id: int, shard_ids: List[int], shard_count: int, path: str) -> None:
+    from bot.main import create_bot, run_bot
+
+    async def run():
+        # the supervisor stops workers with SIGTERM: cancel the main task so run_bot's cleanup
+        # (write-behind flush, conversation spill, event bus close) runs before exiting
+        main_task = asyncio.current_task()
+        try:
+            asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, main_task.cancel)
+        except NotImplementedError:
+            pass
+        # the cross-process event bus already reaches every worker; the hub link is only
+        # needed when it is disabled (relaying over both would deliver events twice)
+        link = None if event_bus.enabled else ClusterLink(worker_id, path)
+        if link is not None:
+            await link.start()
+        try:
+            await run_bot(create_bot(shard_ids=shard_ids, shard_count=shard_count), process=f"worker-{worker_id}")
+        finally:
+            if link is not None:
+                await link.close()
+
+    logger.info("Worker %d starting shards %s/%d", worker_id, shard_ids, shard_count)
+    try:
+        asyncio.run(run())
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        pass
+    logger.info("Worker %d stopped", worker_id)
+
+
+class Supervisor:
+    def __init__(self, workers: int = CLUSTER_WORKERS, shards: int = CLUSTER_SHARDS, path: str = CLUSTER_SOCKET):
+        self.workers = workers
+        self.shards = shards
+        self.path = path
+        # workers only link to the hub when the event bus is disabled (see _worker_main)
+        self.hub = None if event_bus.enabled else ClusterHub(path)
+        self._ctx = multiprocessing.get_context("spawn")
+        self._procs: Dict[int, multiprocessing.Process] = {}
+        self._started: Dict[int, float] = {}
+        self._stopping = False
+
+    def _spawn(self, worker_id: int, shard_ids: List[int], shard_count: int) -> None:
+        proc = self._ctx.Process(target=_worker_main, args=(worker_id, shard_ids, shard_count, self.path), name=f"bot-worker-{worker_id}")
+        proc.start()
+        self._procs[worker_id] = proc
+        self._started[worker_id] = asyncio.get_running_loop().time()
+
+    async def run(self) -> None:
+        shard_count = self.shards or await recommended_shards(os.getenv("DISCORD_TOKEN"))
+        ranges = shard_ranges(shard_count, self.workers)
+        if self.hub is not None:
+            await self.hub.start()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, self.stop)
+            except NotImplementedError:
+                pass
+        logger.info("Supervisor: %d shards across %d workers", shard_count, len(ranges))
+        for worker_id, shard_ids in enumerate(ranges):
+            self._spawn(worker_id, shard_ids, shard_count)
+        backoff = {i: 1.0 for i in range(len(ranges))}
+        # worker id -> loop time of its scheduled restart; the loop itself never waits on a backoff,
+        # so one crash-looping worker does not hold up the others or a stop request
+        respawn_at: Dict[int, float] = {}
+        try:
+            while not self._stopping:
+                await asyncio.sleep(1.0)
+                now = loop.time()
+                for worker_id, proc in list(self._procs.items()):
+                    if proc.is_alive() or self._stopping:
+                        continue
+                    at = respawn_at.get(worker_id)
+                    if at is None:
+                        if now - self._started[worker_id] > HEALTHY_UPTIME:
+                            backoff[worker_id] = 1.0
+                        logger.warning("Worker %d exited (code %s), restarting in %.0fs", worker_id, proc.exitcode, backoff[worker_id])
+                        respawn_at[worker_id] = now + backoff[worker_id]
+                        backoff[worker_id] = min(backoff[worker_id] * 2, RESTART_BACKOFF_MAX)
+                    elif now >= at:
+                        del respawn_at[worker_id]
+                        self._spawn(worker_id, ranges[worker_id], shard_count)
+        finally:
+            for proc in self._procs.values():
+                if proc.is_alive():
+                    proc.terminate()
+            deadline = loop.time() + WORKER_STOP_TIMEOUT
+            for worker_id, proc in self._procs.items():
+                await loop.run_in_executor(None, proc.join, max(0.0, deadline - loop.time()))
+                if proc.is_alive():
+                    logger.warning("Worker %d did not stop within %.0fs, killing it", worker_id, WORKER_STOP_TIMEOUT)
+                    proc.kill()
+                    proc.join()
+            if self.hub is not None:
+                await self.hub.close()
+
+    def stop(self) -> None:
+        self._stopping = True
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description="Run the Discord bot as a sharded cluster")
+    parser.add_argument("--workers", type=int, default=CLUSTER_WORKERS)
+    parser.add_argument("--shards", type=int, default=CLUSTER_SHARDS, help="total shard count (0 = Discord's recommendation)")
+    parser.add_argument("--socket", default=CLUSTER_SOCKET)
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(Supervisor(args.workers, args.shards, args.socket).run())
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -2,8 +2,6 @@
 import os
 import logging
 import asyncio
-from collections import defaultdict, deque
-from typing import Dict, Deque
 
 import discord
 from discord.ext import commands
@@ -12,9 +10,21 @@ from discord import app_commands
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.orm import sessionmaker
 
-from shared.models import AIChannel, Mode, UsageLog, Base, ChatLog
-from bot.gemini_client import chat
+from shared.models import AIChannel, Mode, UsageLog, ChatLog, migrate
+from bot.gemini_client import chat, chat_stream, estimate_tokens, DEFAULT_CHEAP_MODEL, DEFAULT_HIGH_MODEL
+from bot.scheduler import SchedulerBusy
 from bot.events import broadcaster
+from bot.registry import channel_registry
+from bot.guild_config import guild_configs
+from bot.persistence import write_behind
+from bot.summarizer import summarizer
+from bot.memory import conversation_store
+from bot.burst import burst_coalescer
+from bot.intents import intent_engine
+from bot.quota import quota_engine
+from bot.metrics import metrics
+from bot.dispatcher import dispatcher, ROUTE_AI, ROUTE_INTENT
+from bot.outbound import outbound, split_message
 import time
 from datetime import datetime
 
@@ -25,8 +35,17 @@ DATABASE_URL = os.getenv("DATABASE_URL", "sqlite+aiosqlite:///./bot.db")
 engine = create_async_engine(DATABASE_URL, echo=False)
 AsyncSessionLocal = sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
 
-# Per-user in-memory conversation history
-histories: Dict[int, Deque[str]] = defaultdict(lambda: deque(maxlen=8))
+# Stream replies by progressively editing a placeholder message
+STREAM_REPLIES = os.getenv("AI_STREAM_REPLIES", "1") == "1"
+# Minimum seconds between edits of one message (Discord allows ~5 edits / 5s per channel)
+STREAM_EDIT_INTERVAL = float(os.getenv("AI_STREAM_EDIT_INTERVAL", "1.2"))
+STREAM_PLACEHOLDER = "…"
+BUSY_REPLY = "ただいま混み合っています。少し時間をおいてからもう一度お試しください。"
+PAUSED_REPLY = '現在、無料枠上限に達しているためAIは休止中です。'
+QUOTA_REPLIES = {
+    "guild": "このサーバーの利用上限に達したため、AIは一時休止中です。",
+    "user": "利用上限に達しました。しばらく時間をおいてからお試しください。",
+}
 
 MODE_INSTRUCTIONS = {
     "standard": "You are a helpful assistant.",
@@ -39,12 +58,31 @@ class AICommands(commands.Cog):
     def __init__(self, bot: commands.Bot):
         self.bot = bot
         self._ready_task = bot.loop.create_task(self._init_db())
+        dispatcher.register(ROUTE_INTENT, self.handle_intent)
+        dispatcher.register(ROUTE_AI, self.handle_message)
+
+    def cog_unload(self):
+        dispatcher.unregister(ROUTE_INTENT, self.handle_intent)
+        dispatcher.unregister(ROUTE_AI, self.handle_message)
 
     async def _init_db(self):
-        # Create tables
-        async with engine.begin() as conn:
-            await conn.run_sync(Base.metadata.create_all)
-        logger.info("DB initialized")
+        # Create tables and add columns introduced since the database was created
+        try:
+            async with engine.begin() as conn:
+                await conn.run_sync(migrate)
+            logger.info("DB initialized")
+        except Exception:
+            logger.exception("DB initialization failed")
+        guild_configs.configure(AsyncSessionLocal)
+        write_behind.configure(AsyncSessionLocal)
+        summarizer.configure(AsyncSessionLocal)
+        conversation_store.configure(AsyncSessionLocal)
+        # independent loaders: one failing must not keep the others from running
+        for name, loader in (("intents", intent_engine), ("channel registry", channel_registry), ("quotas", quota_engine)):
+            try:
+                await loader.load(AsyncSessionLocal)
+            except Exception:
+                logger.exception("Failed to load %s", name)
 
     @app_commands.command(name="mode", description="Set AI mode for the guild")
     @app_commands.describe(mode="Mode: standard, creative, coder")
@@ -64,6 +102,8 @@ class AICommands(commands.Cog):
                 res = Mode(guild_id=interaction.guild_id, mode=mode)
                 session.add(res)
             await session.commit()
+        guild_configs.invalidate(interaction.guild_id)
+        broadcaster.publish({"type": "config:updated", "payload": {"guild_id": interaction.guild_id, "mode": mode}})
         await interaction.response.send_message(f"Mode set to {mode}")
 
     @app_commands.command(name="setup-public-chat", description="Create a public AI chat channel in the guild")
@@ -95,12 +135,13 @@ class AICommands(commands.Cog):
             ch = AIChannel(guild_id=guild.id, channel_id=channel.id, name=channel.name, type="public")
             session.add(ch)
             await session.commit()
+        channel_registry.add(channel.id, guild.id)
 
         # Notify channel and user
         embed = discord.Embed(title="準備完了！", description="公開AIチャネルが作成されました。ここでAIと会話できます。", color=0xff66aa)
         embed.set_footer(text="Gemini Bot")
         try:
-            await channel.send(embed=embed)
+            await outbound.send(channel, embed=embed)
         except Exception:
             pass
         await interaction.followup.send(f"公開チャネル {channel.mention} を作成しました。", ephemeral=True)
@@ -147,12 +188,13 @@ class AICommands(commands.Cog):
             ch = AIChannel(guild_id=guild.id, channel_id=channel.id, name=channel.name, type="private", owner_id=member.id, owner_name=str(member), owner_avatar=str(member.display_avatar.url) if member.display_avatar else None)
             session.add(ch)
             await session.commit()
+        channel_registry.add(channel.id, guild.id)
 
         # Notify channel and user
         embed = discord.Embed(title="準備完了！", description=f"{member.mention} のプライベートチャネルを作成しました。", color=0xff66aa)
         embed.set_footer(text="Gemini Bot")
         try:
-            await channel.send(embed=embed)
+            await outbound.send(channel, embed=embed)
         except Exception:
             pass
         await interaction.followup.send(f"プライベートチャネル {channel.mention} を作成しました。", ephemeral=True)
@@ -171,173 +213,232 @@ class AICommands(commands.Cog):
             total_msgs = sum(r[0] for r in [ (row.message_count,) for row in rows ]) if rows else 0
         await interaction.response.send_message(f"Tokens: {total_tokens:.0f}, Messages: {total_msgs}")
 
-    @commands.Cog.listener()
-    async def on_message(self, message: discord.Message):
-        # Ignore bot messages
-        if message.author.bot:
-            return
+    async def handle_intent(self, message: discord.Message, intent):
+        """Quick local reply to a common phrase (no API call); routed by the dispatcher."""
+        try:
+            await outbound.send(message.channel, intent.render(message.author.display_name))
+        except Exception:
+            pass
 
-        # Quick local regex replies to common phrases to avoid API calls
-        content_low = (message.content or "").strip()
-        if not content_low:
-            return
-        import re
-        greetings = re.compile(r"^(hi|hello|こんにちは|おはよう|こんばんは)\b", re.I)
-        farewells = re.compile(r"\b(bye|さようなら|おやすみ)\b", re.I)
-        if greetings.search(content_low):
-            try:
-                await message.channel.send(f"こんにちは、{message.author.display_name} さん！")
-            except Exception:
-                pass
-            return
-        if farewells.search(content_low):
+    async def handle_message(self, message: discord.Message, intent=None):
+        """Answer a message in an AI channel; the dispatcher has already filtered bots,
+        non-AI channels and canned intents."""
+        # Merge quick follow-ups from this user into one prompt / one reply (the first message
+        # is answered at once; later ones wait for its reply to finish)
+        async with burst_coalescer.turn((message.author.id, message.channel.id), message) as burst:
+            if burst is not None:
+                await self._turn(burst)
+
+    async def _turn(self, burst: list):
+        """Answer one burst of messages (a single message unless follow-ups were merged)."""
+        content = "\n".join(m.content for m in burst if m.content)
+        message = burst[-1]
+        started = time.perf_counter()
+
+        # Guild settings (pause state, mode, music channel) come from one cached snapshot
+        # Before calling Gemini, validate system state (manual pause) and sliding-window quotas
+        with metrics.span("ai.pause_check"):
+            config = await guild_configs.get(message.guild.id)
+            exhausted = quota_engine.check(message.guild.id, message.author.id)
+        if config.paused or exhausted:
+            scope = exhausted.split(":", 1)[0] if exhausted else None
             try:
-                await message.channel.send("またね！")
+                await outbound.send(message.channel, QUOTA_REPLIES.get(scope, PAUSED_REPLY))
             except Exception:
                 pass
             return
 
-        # Check if channel is an AI channel
-        async with AsyncSessionLocal() as session:
-            q = await session.execute(AIChannel.__table__.select().where(AIChannel.channel_id == message.channel.id))
-            channel_row = q.scalar_one_or_none()
-            if not channel_row:
-                return
-
-        # Before calling Gemini, validate quota / system state
-        async with AsyncSessionLocal() as session:
-            qstate = await session.execute(SystemState.__table__.select().where(SystemState.key == 'ai_paused'))
-            paused = qstate.scalar_one_or_none()
-            if paused and paused.value == '1':
-                try:
-                    await message.channel.send('現在、無料枠上限に達しているためAIは休止中です。')
-                except Exception:
-                    pass
-                return
-
         # Build prompt from recent history and optionally use summary
-        user_hist = histories[message.author.id]
-        user_hist.append(f"User: {message.content}")
-        # If history grows, summarize to save tokens
-        if len(user_hist) >= 6:
-            text_to_summarize = '\n'.join(list(user_hist))
-            sresp = await summarize_context(text_to_summarize)
-            # store summary in DB
-            async with AsyncSessionLocal() as session:
-                qsum = await session.execute(ConversationSummary.__table__.select().where(ConversationSummary.user_id == message.author.id))
-                sumrow = qsum.scalar_one_or_none()
-                if sumrow:
-                    sumrow.summary = sresp.get('summary')
-                    sumrow.updated_at = datetime.utcnow()
-                else:
-                    sumrow = ConversationSummary(user_id=message.author.id, guild_id=message.guild.id, summary=sresp.get('summary'))
-                    session.add(sumrow)
-                await session.commit()
-            # reduce history to summary only
-            user_hist.clear()
-            user_hist.append(f"Summary: {sresp.get('summary')}")
+        # (bounded store; idle users are spilled to the DB and rehydrated here on demand)
+        with metrics.span("ai.history"):
+            user_hist = await conversation_store.get(message.author.id, message.guild.id)
+        try:
+            await self._answer(message, content, config, user_hist, started)
+        finally:
+            # the history is pinned while the turn runs; the store may spill it again afterwards
+            conversation_store.release(message.author.id)
+
+    async def _answer(self, message: discord.Message, content: str, config, user_hist, started: float):
+        """Generate, record and send the reply for one (coalesced) user turn."""
+        user_hist.append(f"User: {content}")
+        # If history grows, summarize to save tokens (in the background; this reply uses the full history)
+        with metrics.span("ai.summarize"):
+            if len(user_hist) >= 6:
+                summarizer.request(message.author.id, message.guild.id, user_hist)
 
         prompt = "\n".join(list(user_hist))
 
         # Get current mode for guild
-        async with AsyncSessionLocal() as session:
-            q = await session.execute(Mode.__table__.select().where(Mode.guild_id == message.guild.id))
-            mode_row = q.scalar_one_or_none()
-            mode = mode_row.mode if mode_row else "standard"
-        system_instruction = MODE_INSTRUCTIONS.get(mode, MODE_INSTRUCTIONS["standard"])
+        with metrics.span("ai.mode_lookup"):
+            mode = config.mode
+            system_instruction = MODE_INSTRUCTIONS.get(mode, MODE_INSTRUCTIONS["standard"])
 
-        # Use cheaper model for standard mode to save cost
-        model_to_use = DEFAULT_CHEAP_MODEL if mode == 'standard' else DEFAULT_HIGH_MODEL
+            # Use cheaper model for standard mode to save cost
+            model_to_use = DEFAULT_CHEAP_MODEL if mode == 'standard' else DEFAULT_HIGH_MODEL
 
         # Call Gemini asynchronously and measure latency
-        start = time.perf_counter()
-        resp = await chat(prompt, system=system_instruction, model=model_to_use)
-        end = time.perf_counter()
-        latency_ms = (end - start) * 1000.0
-        text = resp.get("text") or ""
-        tokens = resp.get("tokens", 0.0)
+        # (queue wait in the scheduler is reported separately from model latency)
+        reply_msg = None
+        gemini_started = time.perf_counter()
+        try:
+            if STREAM_REPLIES:
+                text, queue_ms, ttft_ms, latency_ms, reply_msg, cached = await self._stream_reply(message, prompt, system_instruction, model_to_use)
+                tokens = estimate_tokens(text)
+            else:
+                start = time.perf_counter()
+                resp = await chat(prompt, system=system_instruction, model=model_to_use, guild_id=message.guild.id)
+                end = time.perf_counter()
+                queue_ms = resp.get("queue_ms", 0.0)
+                latency_ms = (end - start) * 1000.0 - queue_ms
+                ttft_ms = latency_ms
+                text = resp.get("text") or ""
+                tokens = resp.get("tokens", 0.0)
+                cached = resp.get("cached", False)
+        except SchedulerBusy:
+            metrics.observe("ai.gemini_busy", time.perf_counter() - gemini_started)
+            user_hist.pop()
+            if not STREAM_REPLIES:
+                try:
+                    await outbound.send(message.channel, BUSY_REPLY)
+                except Exception:
+                    pass
+            return
+        metrics.observe("ai.gemini", time.perf_counter() - gemini_started)
+        metrics.observe("ai.gemini_queue", (queue_ms or 0.0) / 1000.0)
+        metrics.observe("ai.gemini_ttft", (ttft_ms or 0.0) / 1000.0)
+        if cached:
+            # served from the response cache: no model tokens were spent, so nothing is charged
+            tokens = 0.0
 
         # Append assistant reply to history
         user_hist.append(f"Assistant: {text}")
+        quota_engine.record(message.guild.id, message.author.id, tokens)
 
         # Approximate byte sizes for network stats
-        rx_size = len(message.content.encode("utf-8")) if message.content else 0
+        rx_size = len(content.encode("utf-8")) if content else 0
         tx_size = len(text.encode("utf-8")) if text else 0
 
-        # Record usage and chat log
-        async with AsyncSessionLocal() as session:
-            log = UsageLog(guild_id=message.guild.id, user_id=message.author.id, tokens=tokens, message_count=1)
-            session.add(log)
+        # Record usage and chat log (write-behind: buffered and bulk-inserted off the reply path)
+        now = datetime.utcnow()
+        try:
+            avatar_url = str(message.author.display_avatar.url)
+        except Exception:
+            avatar_url = None
+        chat_values = {
+            "guild_id": message.guild.id,
+            "channel_id": message.channel.id,
+            "channel_name": message.channel.name if hasattr(message.channel, 'name') else None,
+            "user_id": message.author.id,
+            "user_name": str(message.author),
+            "user_avatar": avatar_url,
+            "user_message": content,
+            "bot_response": text,
+            "tokens": tokens,
+            "queue_ms": queue_ms,
+            "ttft_ms": ttft_ms,
+            "latency_ms": latency_ms,
+            "created_at": now,
+        }
 
-            # Safe avatar URL extraction
-            try:
-                avatar_url = str(message.author.display_avatar.url)
-            except Exception:
-                avatar_url = None
-
-            chat_row = ChatLog(
-                guild_id=message.guild.id,
-                channel_id=message.channel.id,
-                channel_name=message.channel.name if hasattr(message.channel, 'name') else None,
-                user_id=message.author.id,
-                user_name=str(message.author),
-                user_avatar=avatar_url,
-                user_message=message.content,
-                bot_response=text,
-                tokens=tokens,
-                latency_ms=latency_ms,
-            )
-            session.add(chat_row)
-            await session.commit()
+        def publish_chat(row_id: int):
+            # published once the row is flushed so the event carries the DB id
+            payload = dict(chat_values, id=row_id, tokens=float(tokens or 0.0), queue_ms=float(queue_ms or 0.0),
+                           ttft_ms=float(ttft_ms or 0.0), latency_ms=float(latency_ms or 0.0), created_at=now.isoformat())
+            broadcaster.publish({"type": "chat", "payload": payload})
+
+        try:
+            with metrics.span("ai.db_write"):
+                await write_behind.add(UsageLog, {"guild_id": message.guild.id, "user_id": message.author.id, "tokens": tokens, "message_count": 1, "created_at": now})
+                await write_behind.add(ChatLog, chat_values, on_flushed=publish_chat)
+        except Exception as e:
+            logger.exception("Failed to buffer chat log: %s", e)
 
-            # Publish events for web clients
+        # Publish events for web clients
+        broadcast_started = time.perf_counter()
+        try:
+            # publish network event
+            broadcaster.publish({
+                "type": "network",
+                "payload": {
+                    "rx": rx_size,
+                    "tx": tx_size,
+                    "timestamp": now.isoformat(),
+                },
+            })
+
+            # publish music events if channel is a music channel
+            if config.music_channel_id == message.channel.id:
+                broadcaster.publish({'type': 'music:chat', 'payload': {'guild_id': message.guild.id, 'channel_id': message.channel.id}})
+        except Exception as e:
+            logger.exception("Publish event failed: %s", e)
+        metrics.observe("ai.broadcast", time.perf_counter() - broadcast_started)
+
+        # Send reply (streamed replies were already delivered by editing the placeholder);
+        # the outbound queue splits long replies and paces sends per channel
+        if reply_msg is None:
             try:
-                # publish chat event
-                broadcaster.publish({
-                    "type": "chat",
-                    "payload": {
-                        "id": chat_row.id,
-                        "guild_id": chat_row.guild_id,
-                        "channel_id": chat_row.channel_id,
-                        "channel_name": chat_row.name if hasattr(chat_row, 'name') else None,
-                        "user_id": chat_row.user_id,
-                        "user_name": chat_row.user_name,
-                        "user_avatar": chat_row.user_avatar,
-                        "user_message": chat_row.user_message,
-                        "bot_response": chat_row.bot_response,
-                        "tokens": float(chat_row.tokens or 0.0),
-                        "latency_ms": float(chat_row.latency_ms or 0.0),
-                        "created_at": chat_row.created_at.isoformat() if chat_row.created_at else datetime.utcnow().isoformat(),
-                    },
-                })
-
-                # publish network event
-                broadcaster.publish({
-                    "type": "network",
-                    "payload": {
-                        "rx": rx_size,
-                        "tx": tx_size,
-                        "timestamp": datetime.utcnow().isoformat(),
-                    },
-                })
-
-                # publish music events if channel is a music channel
-                try:
-                    async with AsyncSessionLocal() as session:
-                        q = await session.execute(MusicChannel.__table__.select().where(MusicChannel.channel_id == message.channel.id))
-                        mrow = q.scalar_one_or_none()
-                        if mrow:
-                            broadcaster.publish({'type': 'music:chat', 'payload': {'guild_id': message.guild.id, 'channel_id': message.channel.id}})
-                except Exception:
-                    pass
+                with metrics.span("ai.discord_send"):
+                    await outbound.send(message.channel, text)
             except Exception as e:
-                logger.exception("Publish event failed: %s", e)
+                logger.exception("Failed to send reply: %s", e)
+        metrics.observe("ai.total", time.perf_counter() - started)
+
+    async def _stream_reply(self, message: discord.Message, prompt: str, system: str, model: str):
+        """Stream a Gemini answer into a placeholder reply, editing it at most every STREAM_EDIT_INTERVAL.
 
-        # Send reply
+        Returns (text, queue_ms, ttft_ms, total_ms, reply_message, cached); model timings exclude queue wait.
+        Raises SchedulerBusy after replacing the placeholder with BUSY_REPLY.
+        """
         try:
-            await message.channel.send(text)
+            with metrics.span("ai.discord_send"):
+                reply_msg = (await outbound.send(message.channel, STREAM_PLACEHOLDER))[0]
         except Exception as e:
-            logger.exception("Failed to send reply: %s", e)
+            logger.exception("Failed to send placeholder: %s", e)
+            reply_msg = None
+        start = time.perf_counter()
+        ttft_ms = None
+        parts = []
+        shown = STREAM_PLACEHOLDER
+        last_edit = 0.0
+        timings = {}
+        try:
+            async for chunk in chat_stream(prompt, system=system, model=model, guild_id=message.guild.id, timings=timings):
+                if ttft_ms is None:
+                    ttft_ms = (time.perf_counter() - start) * 1000.0 - timings.get("queue_ms", 0.0)
+                parts.append(chunk)
+                now = time.monotonic()
+                if reply_msg is not None and now - last_edit >= STREAM_EDIT_INTERVAL:
+                    partial = split_message("".join(parts))[0] if parts else ""
+                    if partial.strip() and partial != shown:
+                        # not awaited: a newer edit replaces this one if it is still queued
+                        outbound.edit(reply_msg, partial)
+                        shown = partial
+                        last_edit = now
+        except SchedulerBusy:
+            # shed before any chunk was produced
+            if reply_msg is not None:
+                try:
+                    await outbound.edit(reply_msg, BUSY_REPLY)
+                except Exception:
+                    pass
+            raise
+        queue_ms = timings.get("queue_ms", 0.0)
+        total_ms = (time.perf_counter() - start) * 1000.0 - queue_ms
+        text = "".join(parts)
+        if ttft_ms is None:
+            ttft_ms = total_ms
+        if reply_msg is not None:
+            # first chunk replaces the placeholder, the rest of a long reply follows as new messages
+            chunks = split_message(text) or ["（応答を生成できませんでした）"]
+            try:
+                with metrics.span("ai.discord_edit"):
+                    if chunks[0] != shown:
+                        await outbound.edit(reply_msg, chunks[0])
+                    for extra in chunks[1:]:
+                        await outbound.send(message.channel, extra)
+            except Exception as e:
+                logger.exception("Failed to send reply: %s", e)
+        return text, queue_ms, ttft_ms, total_ms, reply_msg, timings.get("cached", False)
 
 
 async def setup(bot: commands.Bot) -> None:
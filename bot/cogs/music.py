@@ -18,6 +18,10 @@ import yt_dlp
 from shared.models import MusicChannel, MusicTrack, MusicPlayback, Base
 from bot.events import broadcaster
 from bot.gemini_client import chat
+from bot.scheduler import SchedulerBusy, PRIORITY_BACKGROUND
+from bot.dispatcher import dispatcher, ROUTE_MUSIC
+from bot.outbound import outbound
+from bot.metrics import metrics
 from bot.socketio_server import sio
 
 logger = logging.getLogger(__name__)
@@ -48,6 +52,7 @@ class TrackInfo:
     thumbnail: Optional[str] = None
 
 
+@metrics.timed("music.extract_info")
 async def extract_info(query: str) -> Optional[TrackInfo]:
     loop = asyncio.get_running_loop()
     try:
@@ -76,6 +81,10 @@ class Music(commands.Cog):
             broadcaster.register_handler(self._on_broadcast)
         except Exception:
             pass
+        dispatcher.register(ROUTE_MUSIC, self.handle_trigger)
+
+    def cog_unload(self):
+        dispatcher.unregister(ROUTE_MUSIC, self.handle_trigger)
 
     async def _on_broadcast(self, data):
         # handle music:control events
@@ -166,6 +175,7 @@ class Music(commands.Cog):
             return None
         return voice_client
 
+    @metrics.timed("music.play_next")
     async def play_next(self, guild: discord.Guild):
         q = queues.get(guild.id, [])
         if not q:
@@ -307,7 +317,11 @@ class Music(commands.Cog):
             # ignore for now
         # Ask Gemini to suggest a search keyword
         ai_prompt = f"ユーザーが求める音楽を一言の検索語に変換してください。入力: {prompt or 'リラックスできる曲'}。出力は日本語の検索キーワードのみ。"
-        resp = await chat(ai_prompt, system='You are a music search assistant.')
+        try:
+            resp = await chat(ai_prompt, system='You are a music search assistant.', guild_id=interaction.guild.id, priority=PRIORITY_BACKGROUND)
+        except SchedulerBusy:
+            # keyword extraction is shed under load; search with the raw prompt instead
+            resp = {}
         suggestion = (resp.get('text') or '').strip().split('\n')[0]
         if not suggestion:
             suggestion = prompt or 'リラックスできる曲'
@@ -337,65 +351,59 @@ class Music(commands.Cog):
         if not cur:
             await self.play_next(interaction.guild)
 
-    @commands.Cog.listener()
-    async def on_message(self, message: discord.Message):
-        # simple trigger phrases to auto-create music channel and start
-        if message.author.bot:
-            return
-        content = message.content.lower()
-        triggers = ['音楽流して', 'リラックスできる曲', '曲を流して', 'プレイリスト', '音楽かけて']
-        if any(t in content for t in triggers):
-            # create or join voice channel and call recommend
-            guild = message.guild
-            if not guild:
-                return
-            channel = await self.join_or_create_music_channel(guild, message.author)
-            # call gemini to extract a suggestion
-            ai_prompt = f"ユーザーの発言から最適な検索ワードを一つにしてください: {message.content}"
-            resp = await chat(ai_prompt, system='You are a music search assistant.')
-            suggestion = (resp.get('text') or '').strip().split('\n')[0]
-            if not suggestion:
-                suggestion = message.content
-            info = await extract_info(suggestion)
-            if not info:
-                try:
-                    await message.channel.send('曲が見つかりませんでした。')
-                except Exception:
-                    pass
-                return
-            # persist
-            async with AsyncSessionLocal() as session:
-                t = MusicTrack(guild_id=guild.id, requested_by=message.author.id, title=info.title, url=info.url, stream_url=info.stream_url, duration=info.duration, thumbnail=info.thumbnail, reason=suggestion)
-                session.add(t)
-                await session.commit()
-                await session.refresh(t)
-            queues.setdefault(guild.id, [])
-            queues[guild.id].append(t)
-            qpayload = {'guild_id': guild.id, 'queue': [{'id': x.id, 'title': x.title} for x in queues[guild.id]]}
-            broadcaster.publish({'type': 'music:queue_update', 'payload': qpayload})
+    async def handle_trigger(self, message: discord.Message, intent=None):
+        # trigger phrases (routed by the dispatcher) auto-create the music channel and start
+        guild = message.guild
+        channel = await self.join_or_create_music_channel(guild, message.author)
+        # call gemini to extract a suggestion
+        ai_prompt = f"ユーザーの発言から最適な検索ワードを一つにしてください: {message.content}"
+        try:
+            resp = await chat(ai_prompt, system='You are a music search assistant.', guild_id=guild.id, priority=PRIORITY_BACKGROUND)
+        except SchedulerBusy:
+            resp = {}
+        suggestion = (resp.get('text') or '').strip().split('\n')[0]
+        if not suggestion:
+            suggestion = message.content
+        info = await extract_info(suggestion)
+        if not info:
             try:
-                asyncio.create_task(sio.emit('music:queue_update', qpayload))
+                await outbound.send(message.channel, '曲が見つかりませんでした。')
             except Exception:
                 pass
+            return
+        # persist
+        async with AsyncSessionLocal() as session:
+            t = MusicTrack(guild_id=guild.id, requested_by=message.author.id, title=info.title, url=info.url, stream_url=info.stream_url, duration=info.duration, thumbnail=info.thumbnail, reason=suggestion)
+            session.add(t)
+            await session.commit()
+            await session.refresh(t)
+        queues.setdefault(guild.id, [])
+        queues[guild.id].append(t)
+        qpayload = {'guild_id': guild.id, 'queue': [{'id': x.id, 'title': x.title} for x in queues[guild.id]]}
+        broadcaster.publish({'type': 'music:queue_update', 'payload': qpayload})
+        try:
+            asyncio.create_task(sio.emit('music:queue_update', qpayload))
+        except Exception:
+            pass
+        try:
+            await outbound.send(message.channel, f'自動選曲: {t.title} をキューに追加しました。')
+        except Exception:
+            pass
+        # attempt to connect and play
+        vc = discord.utils.get(self.bot.voice_clients, guild=guild)
+        if not vc:
+            # connect to created channel
             try:
-                await message.channel.send(f'自動選曲: {t.title} をキューに追加しました。')
+                await (await self.join_or_create_music_channel(guild, message.author))
             except Exception:
                 pass
-            # attempt to connect and play
-            vc = discord.utils.get(self.bot.voice_clients, guild=guild)
-            if not vc:
-                # connect to created channel
-                try:
-                    await (await self.join_or_create_music_channel(guild, message.author))
-                except Exception:
-                    pass
-            # if nothing playing, start
-            async with AsyncSessionLocal() as session:
-                q2 = await session.execute(MusicPlayback.__table__.select().where(MusicPlayback.guild_id == guild.id))
-                cur = q2.scalar_one_or_none()
-            if not cur:
-                # schedule play
-                asyncio.create_task(self.play_next(guild))
+        # if nothing playing, start
+        async with AsyncSessionLocal() as session:
+            q2 = await session.execute(MusicPlayback.__table__.select().where(MusicPlayback.guild_id == guild.id))
+            cur = q2.scalar_one_or_none()
+        if not cur:
+            # schedule play
+            asyncio.create_task(self.play_next(guild))
 
 
 async def setup(bot: commands.Bot):
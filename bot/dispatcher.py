@@ -0,0 +1,94 @@
+"""Single on_message entrypoint: classify each message once and route it to one handler.
+
+Routes, in priority order:
+- `intent`  canned reply matched by the intent engine (any channel)
+- `music`   music trigger phrase (any channel)
+- `ai`      message in a registered AI channel
+- `ignore`  everything else (bots, DMs, empty messages, unrelated channels)
+
+Cogs register their handler for a route on load. `intent` and `music` only apply while a
+handler is registered for them; otherwise the message falls through to the AI channel check.
+"""
+import os
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+import discord
+
+from bot.intents import Intent, intent_engine
+from bot.registry import channel_registry
+from bot.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+ROUTE_IGNORE = "ignore"
+ROUTE_INTENT = "intent"
+ROUTE_MUSIC = "music"
+ROUTE_AI = "ai"
+
+# longest a message waits for the channel registry's initial load (seconds)
+REGISTRY_WAIT = float(os.getenv("DISPATCH_REGISTRY_WAIT", "10"))
+
+Handler = Callable[[discord.Message, Optional[Intent]], Awaitable[None]]
+
+
+class MessageDispatcher:
+    def __init__(self):
+        self._handlers: Dict[str, Handler] = {}
+        self.counts: Dict[str, int] = {}
+
+    def attach(self, bot) -> None:
+        """Install the dispatcher as the bot's only message listener."""
+        bot.add_listener(self.dispatch, "on_message")
+
+    def register(self, route: str, handler: Handler) -> None:
+        self._handlers[route] = handler
+
+    def unregister(self, route: str, handler: Handler) -> None:
+        if self._handlers.get(route) == handler:
+            del self._handlers[route]
+
+    async def classify(self, message: discord.Message) -> Tuple[str, Optional[Intent]]:
+        if message.author.bot or message.guild is None:
+            return ROUTE_IGNORE, None
+        content = (message.content or "").strip()
+        if not content:
+            return ROUTE_IGNORE, None
+        # one regex pass covers both canned replies and music triggers
+        intent = intent_engine.match(content, message.guild.id)
+        if intent is not None:
+            if intent.response and ROUTE_INTENT in self._handlers:
+                return ROUTE_INTENT, intent
+            if intent.action == "music" and ROUTE_MUSIC in self._handlers:
+                return ROUTE_MUSIC, intent
+        if not channel_registry.loaded:
+            try:
+                await asyncio.wait_for(channel_registry.wait_ready(), REGISTRY_WAIT)
+            except asyncio.TimeoutError:
+                logger.warning("Channel registry not loaded after %.0fs; ignoring message", REGISTRY_WAIT)
+                return ROUTE_IGNORE, None
+        if await channel_registry.lookup(message.channel.id):
+            return ROUTE_AI, intent
+        return ROUTE_IGNORE, None
+
+    async def dispatch(self, message: discord.Message) -> None:
+        with metrics.span("dispatch.classify"):
+            route, intent = await self.classify(message)
+        handler = self._handlers.get(route) if route != ROUTE_IGNORE else None
+        if handler is None:
+            route = ROUTE_IGNORE
+        self.counts[route] = self.counts.get(route, 0) + 1
+        if handler is None:
+            return
+        try:
+            await handler(message, intent)
+        except Exception:
+            logger.exception("Message handler for %s failed", route)
+
+    def stats(self) -> dict:
+        return {"routes": sorted(self._handlers), "counts": dict(self.counts)}
+
+
+# singleton
+dispatcher = MessageDispatcher()
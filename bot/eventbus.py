@@ -0,0 +1,424 @@
+"""Cross-process event bus so broadcaster events reach every process (bot, API workers).
+
+Transport: a Unix domain socket served by a small broker that relays events between peers
+without decoding their JSON. Every peer connects as a client. With EVENT_BUS_BROKER=auto (the
+default) the first process that finds no broker starts one in-process. A standalone broker
+runs with `python -m bot.eventbus`. A broker holds an exclusive lock on `<socket>.lock` for
+its lifetime, so when the hosting process exits exactly one of the reconnecting peers takes
+over (the OS releases the lock with the process).
+
+Event ids are assigned once, by the broker: every event gets the next number of the broker's
+sequence, tagged with the broker's epoch (its start time), and is relayed to every peer
+including its sender. All processes therefore frame an event with the same SSE id, and a
+client may resume on any API worker. The broker keeps the last EVENT_REPLAY_SIZE events and
+sends them to each peer when it connects, so a restarted API worker starts with a full
+replay buffer (see Broadcaster.seed).
+
+Framing (binary, big-endian). Peer to broker: a batch is `u32 body_length, u16 count`
+followed by `count` items of `u8 flags, u32 length` + UTF-8 JSON. Broker to peer: `u32
+body_length, u16 count, u8 kind, u64 epoch` followed by items of `u64 id, u8 flags, u32
+length` + JSON, where kind is live or replay. Events published in the same loop iteration
+go out as one batch. Events from other processes are published locally with an `origin`
+key and are never forwarded again. Unsequenced messages (bus-only traffic such as metrics
+snapshots) get no id, are not echoed or kept, and go to the consumer registered with
+EventBus.on() instead of the broadcaster.
+"""
+import os
+import sys
+import json
+import fcntl
+import random
+import struct
+import time
+import tempfile
+import asyncio
+import logging
+from collections import deque
+from typing import Callable, Deque, Dict, List, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+# unix:<path>, or "none" to keep events in-process. The default is absolute so processes started
+# from different directories meet; a relative path resolves against each process's working directory
+DEFAULT_EVENT_BUS_PATH = os.path.join(os.getenv("XDG_RUNTIME_DIR") or tempfile.gettempdir(), "gemini-bot-events.sock")
+EVENT_BUS_URL = os.getenv("EVENT_BUS_URL", f"unix:{DEFAULT_EVENT_BUS_PATH}")
+# auto: start an in-process broker when none is running; off: only connect
+EVENT_BUS_BROKER = os.getenv("EVENT_BUS_BROKER", "auto")
+# events kept while disconnected / unsent bytes tolerated per peer before it is dropped
+EVENT_BUS_MAX_PENDING = int(os.getenv("EVENT_BUS_MAX_PENDING", "1000"))
+EVENT_BUS_PEER_BUFFER = int(os.getenv("EVENT_BUS_PEER_BUFFER", str(4 * 1024 * 1024)))
+MAX_BATCH_ITEMS = 0xFFFF
+# events the broker keeps for peers that (re)connect (same setting as the SSE replay buffer)
+EVENT_BUS_REPLAY_SIZE = min(int(os.getenv("EVENT_REPLAY_SIZE", "1024")), MAX_BATCH_ITEMS)
+
+_HEADER = struct.Struct(">IH")
+_ITEM = struct.Struct(">BI")
+_DOWN_HEADER = struct.Struct(">IHBQ")
+_DOWN_ITEM = struct.Struct(">QBI")
+
+# item flags: an event (numbered, kept for replay, echoed to its sender) / the receiver sent it
+FLAG_SEQUENCED = 1
+FLAG_OWN = 2
+# downstream batch kinds
+BATCH_LIVE = 0
+BATCH_REPLAY = 1
+
+
+def _socket_path(url: str) -> str | None:
+    if not url or url == "none":
+        return None
+    if url.startswith("unix://"):
+        return url[len("unix://"):]
+    if url.startswith("unix:"):
+        return url[len("unix:"):]
+    raise ValueError(f"unsupported event bus url {url!r}")
+
+
+class BrokerLocked(ConnectionRefusedError):
+    """Another process holds the broker lock (it is running or starting the broker)."""
+
+
+def _lock(path: str) -> int | None:
+    """Exclusive non-blocking lock on `path`; the open fd, or None when someone else holds it."""
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        os.close(fd)
+        return None
+    return fd
+
+
+def encode_batch(items: List[Tuple[int, bytes]]) -> bytes:
+    """Peer -> broker: (flags, body) items."""
+    body = b"".join(_ITEM.pack(flags, len(raw)) + raw for flags, raw in items)
+    return _HEADER.pack(len(body), len(items)) + body
+
+
+def decode_batch(body: bytes, count: int) -> List[Tuple[int, bytes]]:
+    items, offset = [], 0
+    for _ in range(count):
+        flags, n = _ITEM.unpack_from(body, offset)
+        offset += _ITEM.size
+        items.append((flags, body[offset:offset + n]))
+        offset += n
+    return items
+
+
+def encode_down(kind: int, epoch: int, items: List[Tuple[int, int, bytes]]) -> bytes:
+    """Broker -> peer: (event id, flags, body) items."""
+    body = b"".join(_DOWN_ITEM.pack(event_id, flags, len(raw)) + raw for event_id, flags, raw in items)
+    return _DOWN_HEADER.pack(len(body), len(items), kind, epoch) + body
+
+
+def decode_down(body: bytes, count: int) -> List[Tuple[int, int, bytes]]:
+    items, offset = [], 0
+    for _ in range(count):
+        event_id, flags, n = _DOWN_ITEM.unpack_from(body, offset)
+        offset += _DOWN_ITEM.size
+        items.append((event_id, flags, body[offset:offset + n]))
+        offset += n
+    return items
+
+
+async def read_batch(reader: asyncio.StreamReader, header: struct.Struct = _HEADER) -> tuple:
+    """(header fields, body) of the next batch."""
+    fields = header.unpack(await reader.readexactly(header.size))
+    body = await reader.readexactly(fields[0])
+    return fields, body
+
+
+class EventBroker:
+    """Numbers the events of every batch and relays them to all peers (the sender gets its own
+    events back flagged FLAG_OWN); unsequenced items only go to the other peers."""
+
+    def __init__(self, path: str, replay_size: int = EVENT_BUS_REPLAY_SIZE):
+        self.path = path
+        self.epoch = int(time.time() * 1000)
+        self.seq = 0
+        # (event id, body) of the latest events, sent to every peer when it connects
+        self._ring: Deque[Tuple[int, bytes]] = deque(maxlen=replay_size)
+        self._peers: Set[asyncio.StreamWriter] = set()
+        self._server: asyncio.AbstractServer | None = None
+        self._lock_fd: int | None = None
+        self.relayed = 0
+        self.dropped_peers = 0
+
+    async def start(self) -> None:
+        """Bind the socket; raises BrokerLocked when another broker owns it."""
+        self._lock_fd = _lock(self.path + ".lock")
+        if self._lock_fd is None:
+            raise BrokerLocked(self.path)
+        try:
+            # holding the lock means no broker is alive: a leftover socket file is stale
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+            self._server = await asyncio.start_unix_server(self._handle, path=self.path)
+        except BaseException:
+            self._unlock()
+            raise
+        logger.info("Event bus broker listening on %s", self.path)
+
+    def _unlock(self) -> None:
+        if self._lock_fd is not None:
+            os.close(self._lock_fd)
+            self._lock_fd = None
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        # the replay buffer first: the peer learns the epoch and can resume its clients
+        writer.write(encode_down(BATCH_REPLAY, self.epoch, [(i, FLAG_SEQUENCED, raw) for i, raw in self._ring]))
+        self._peers.add(writer)
+        try:
+            while True:
+                (_, count), body = await read_batch(reader)
+                relayed, echoed = [], []
+                for flags, raw in decode_batch(body, count):
+                    if flags & FLAG_SEQUENCED:
+                        self.seq += 1
+                        self._ring.append((self.seq, raw))
+                        relayed.append((self.seq, FLAG_SEQUENCED, raw))
+                        echoed.append((self.seq, FLAG_SEQUENCED | FLAG_OWN, raw))
+                    else:
+                        relayed.append((0, 0, raw))
+                batches = {
+                    False: encode_down(BATCH_LIVE, self.epoch, relayed),
+                    True: encode_down(BATCH_LIVE, self.epoch, echoed) if echoed else None,
+                }
+                for peer in list(self._peers):
+                    data = batches[peer is writer]
+                    if data is None:
+                        continue
+                    if peer.transport.get_write_buffer_size() > EVENT_BUS_PEER_BUFFER:
+                        # slow consumer: drop it rather than buffer without bound
+                        logger.warning("Dropping slow event bus peer")
+                        self._peers.discard(peer)
+                        self.dropped_peers += 1
+                        peer.close()
+                        continue
+                    peer.write(data)
+                self.relayed += 1
+        except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):
+            # a cancelled handler (loop shutdown) ends quietly like a disconnect
+            pass
+        finally:
+            self._peers.discard(writer)
+            writer.close()
+
+    async def close(self) -> None:
+        for peer in list(self._peers):
+            peer.close()
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+        self._unlock()
+
+
+class EventBus:
+    def __init__(self, url: str = EVENT_BUS_URL, broker: str = EVENT_BUS_BROKER):
+        self.path = _socket_path(url)
+        self.auto_broker = broker == "auto"
+        self._broadcaster = None
+        self._writer: asyncio.StreamWriter | None = None
+        self._pending: List[Tuple[int, bytes]] = []
+        self._flush_scheduled = False
+        self._task: asyncio.Task | None = None
+        self._broker: EventBroker | None = None
+        self._consumers: Dict[str, Callable[[dict], None]] = {}
+        self._relay: Callable[[str], None] | None = None
+        self.sent = 0
+        self.received = 0
+        self.batches = 0
+        self.dropped = 0
+        self.epoch: int | None = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.path is not None
+
+    async def start(self, broadcaster) -> None:
+        if not self.enabled or self._task is not None:
+            return
+        self._broadcaster = broadcaster
+        broadcaster.attach_bus(self)
+        self._task = asyncio.create_task(self._run())
+
+    def on(self, event_type: str, fn: Callable[[dict], None]) -> None:
+        """Hand received `event_type` messages to `fn` instead of the broadcaster."""
+        self._consumers[event_type] = fn
+
+    def relay_through(self, fn: Callable[[str], None] | None) -> None:
+        """Carry unsequenced messages over `fn` while the bus is disabled (the cluster hub link)."""
+        self._relay = fn
+
+    def consume(self, data) -> bool:
+        """Pass a received unsequenced message to its consumer; False when nobody registered one."""
+        consumer = self._consumers.get(data.get("type")) if isinstance(data, dict) else None
+        if consumer is None:
+            return False
+        try:
+            consumer(data)
+        except Exception:
+            logger.exception("Event bus consumer for %s failed", data.get("type"))
+        return True
+
+    def send(self, body: str, sequenced: bool = True) -> None:
+        """Queue one JSON-encoded message; everything queued in this loop iteration is one batch.
+
+        Events (`sequenced`) come back from the broker with their id and are fanned out to local
+        subscribers then (Broadcaster.fan_out); other messages only reach the other processes."""
+        if not sequenced and not self.enabled:
+            if self._relay is not None:
+                self._relay(body)
+            return
+        if len(self._pending) >= EVENT_BUS_MAX_PENDING:
+            self._pending.pop(0)
+            self.dropped += 1
+        self._pending.append((FLAG_SEQUENCED if sequenced else 0, body.encode("utf-8")))
+        if self._writer is not None and not self._flush_scheduled:
+            self._flush_scheduled = True
+            asyncio.get_running_loop().call_soon(self._flush)
+
+    def _flush(self) -> None:
+        self._flush_scheduled = False
+        writer = self._writer
+        if writer is None or not self._pending:
+            return
+        if writer.transport.get_write_buffer_size() > EVENT_BUS_PEER_BUFFER:
+            # broker is not reading; keep the newest events and try again on the next send
+            self.dropped += max(0, len(self._pending) - EVENT_BUS_MAX_PENDING)
+            self._pending = self._pending[-EVENT_BUS_MAX_PENDING:]
+            return
+        while self._pending:
+            items, self._pending = self._pending[:MAX_BATCH_ITEMS], self._pending[MAX_BATCH_ITEMS:]
+            writer.write(encode_batch(items))
+            self.sent += len(items)
+            self.batches += 1
+
+    async def _connect(self):
+        try:
+            return await asyncio.open_unix_connection(self.path)
+        except (FileNotFoundError, ConnectionRefusedError):
+            if not self.auto_broker or self._broker is not None:
+                raise
+        # no broker reachable: become it, unless another peer holds the broker lock
+        # (BrokerLocked is a ConnectionError, so _run retries the connection after a backoff)
+        broker = EventBroker(self.path)
+        await broker.start()
+        self._broker = broker
+        return await asyncio.open_unix_connection(self.path)
+
+    async def _run(self) -> None:
+        delay = 0.2
+        while True:
+            try:
+                reader, self._writer = await self._connect()
+                delay = 0.2
+                self._flush()
+                while True:
+                    (_, count, kind, epoch), body = await read_batch(reader, _DOWN_HEADER)
+                    self.epoch = epoch
+                    items = decode_down(body, count)
+                    if kind == BATCH_REPLAY:
+                        self._seed(epoch, items)
+                    else:
+                        self._deliver(epoch, items)
+            except (asyncio.IncompleteReadError, ConnectionError, FileNotFoundError, OSError):
+                pass
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Event bus connection failed")
+            self._writer = None
+            # jittered so peers that lost the same broker do not reconnect in lockstep
+            await asyncio.sleep(delay * random.uniform(0.5, 1.5))
+            delay = min(delay * 2, 5.0)
+
+    def _seed(self, epoch: int, items: List[Tuple[int, int, bytes]]) -> None:
+        events = []
+        for event_id, _, raw in items:
+            try:
+                events.append((event_id, json.loads(raw), raw.decode("utf-8")))
+            except ValueError:
+                continue
+        self._broadcaster.seed(epoch, events)
+
+    def _deliver(self, epoch: int, items: List[Tuple[int, int, bytes]]) -> None:
+        for event_id, flags, raw in items:
+            try:
+                data = json.loads(raw)
+            except ValueError:
+                continue
+            self.received += 1
+            if not flags & FLAG_SEQUENCED:
+                self.consume(data)
+                continue
+            body = raw.decode("utf-8")
+            if flags & FLAG_OWN:
+                # published here: handlers already ran, only the subscribers were waiting for the id
+                self._broadcaster.fan_out(data, body, epoch, event_id)
+                continue
+            if isinstance(data, dict):
+                data.setdefault("origin", "bus")
+            self._broadcaster.publish(data, forward=False, event_id=(epoch, event_id), body=body)
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._writer is not None:
+            self._flush()
+            self._writer.close()
+            self._writer = None
+        if self._broker is not None:
+            await self._broker.close()
+            self._broker = None
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "connected": self._writer is not None,
+            "broker": self._broker is not None,
+            "sent": self.sent,
+            "received": self.received,
+            "batches": self.batches,
+            "dropped": self.dropped,
+            "pending": len(self._pending),
+            "epoch": self.epoch,
+        }
+
+
+# singleton
+event_bus = EventBus()
+
+
+def main(argv=None) -> None:
+    path = _socket_path(EVENT_BUS_URL)
+    if path is None:
+        sys.exit("EVENT_BUS_URL is disabled")
+    logging.basicConfig(level=logging.INFO)
+
+    async def run():
+        broker = EventBroker(path)
+        await broker.start()
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await broker.close()
+
+    try:
+        asyncio.run(run())
+    except BrokerLocked:
+        sys.exit(f"another event bus broker owns {path}")
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
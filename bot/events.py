@@ -1,24 +1,376 @@
-"""Simple in-process broadcaster used for SSE push from bot to web clients."""
+"""Simple in-process broadcaster used for SSE push from bot to web clients.
+
+Subscribers may filter by topic and guild. A topic is either an exact event type
+(`music:play`) or a namespace (`music` matches every `music:*` event). Subscribers are indexed
+by topic, so publish() only visits the subscribers that asked for the event's type.
+
+Each event is encoded once into an SSE frame (immutable bytes) shared by every subscriber
+buffer; readers only concatenate frames that are already encoded.
+
+Events get ids of the form `<epoch>-<seq>` and the latest EVENT_REPLAY_SIZE frames are kept in
+a ring buffer, so a reconnecting client that sends Last-Event-ID gets only what it missed. If
+the missed range is no longer buffered it first receives a `stream:reset` event. With the event
+bus attached, ids come from the bus broker, so they are the same in every process (see
+bot.eventbus); the broadcaster numbers events itself only when it runs on its own.
+
+High-frequency types can be coalesced before fan-out (see Broadcaster.coalesce): events of
+that type are held for a short window and published as one, either summing numeric payload
+fields (`network` rx/tx per second) or keeping only the newest event per key (queue state).
+"""
+import os
+import json
+import time
 import asyncio
-from typing import Set, Any
+import logging
+from collections import deque
+from typing import Any, Deque, Dict, Iterable, Optional, Set, Tuple
+
+from bot.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# events buffered per subscriber before the overflow policy applies
+EVENT_QUEUE_SIZE = int(os.getenv("EVENT_QUEUE_SIZE", "256"))
+# drop_oldest | drop_newest | disconnect
+EVENT_OVERFLOW = os.getenv("EVENT_OVERFLOW", "drop_oldest")
+# a subscriber whose oldest undelivered event is older than this is evicted (seconds)
+EVENT_MAX_LAG = float(os.getenv("EVENT_MAX_LAG", "30"))
+
+# frames a reader may combine into one write, and how long it waits for more (seconds, 0 = no wait)
+EVENT_BATCH_MAX = int(os.getenv("EVENT_BATCH_MAX", "64"))
+EVENT_BATCH_WINDOW = float(os.getenv("EVENT_BATCH_WINDOW", "0"))
+# recent events kept for Last-Event-ID resume
+EVENT_REPLAY_SIZE = int(os.getenv("EVENT_REPLAY_SIZE", "1024"))
+# coalescing windows in seconds (0 = publish every event)
+EVENT_COALESCE_NETWORK = float(os.getenv("EVENT_COALESCE_NETWORK", "1"))
+EVENT_COALESCE_QUEUE = float(os.getenv("EVENT_COALESCE_QUEUE", "0.25"))
+
+OVERFLOW_POLICIES = ("drop_oldest", "drop_newest", "disconnect")
+COALESCE_MODES = ("sum", "last")
+
+
+def encode_json(data: Any) -> str:
+    return json.dumps(data, default=str)
+
+
+def format_event_id(epoch: int, seq: int) -> str:
+    return f"{epoch}-{seq}"
+
+
+def parse_event_id(value: Optional[str]) -> Optional[Tuple[int, int]]:
+    """(epoch, seq) of an id made by format_event_id(), None when malformed."""
+    try:
+        epoch, seq = str(value).split("-", 1)
+        return int(epoch), int(seq)
+    except (TypeError, ValueError):
+        return None
+
+
+def encode_sse(body: str, event_id: str | None = None) -> bytes:
+    if event_id is None:
+        return f"data: {body}\n\n".encode("utf-8")
+    return f"id: {event_id}\ndata: {body}\n\n".encode("utf-8")
+
+
+class SubscriptionClosed(Exception):
+    """Raised by Subscription.get() once the subscriber was unsubscribed or evicted."""
+
+
+class Subscription:
+    """Bounded per-subscriber buffer of encoded SSE frames.
+
+    `async for chunk in sub` yields bytes holding one or more frames and ends when closed.
+    """
+
+    def __init__(self, maxsize: int = EVENT_QUEUE_SIZE, policy: str = EVENT_OVERFLOW,
+                 topics: Optional[Iterable[str]] = None, guild_id: Optional[int] = None):
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"unknown overflow policy {policy!r}")
+        self.maxsize = maxsize
+        self.policy = policy
+        self.topics = frozenset(t for t in topics if t) if topics else None
+        self.guild_id = guild_id
+        self._items: Deque[Tuple[float, bytes]] = deque()
+        self._waiter: asyncio.Future | None = None
+        self.closed = False
+        self.close_reason: str | None = None
+        self.delivered = 0
+        self.dropped = 0
+
+    def qsize(self) -> int:
+        return len(self._items)
+
+    def lag(self, now: float | None = None) -> float:
+        """Age of the oldest undelivered event (0 when caught up)."""
+        if not self._items:
+            return 0.0
+        return (time.monotonic() if now is None else now) - self._items[0][0]
+
+    def matches(self, data: Any) -> bool:
+        """Topic and guild filter together (publish() resolves topics through its index)."""
+        if self.topics is not None:
+            event_type = data.get("type") if isinstance(data, dict) else None
+            if not isinstance(event_type, str):
+                return False
+            if event_type not in self.topics and event_type.split(":", 1)[0] not in self.topics:
+                return False
+        return self.wants(data)
+
+    def wants(self, data: Any) -> bool:
+        """Guild filter: events without a guild_id reach every subscriber."""
+        if self.guild_id is None:
+            return True
+        payload = data.get("payload") if isinstance(data, dict) else None
+        guild_id = payload.get("guild_id") if isinstance(payload, dict) else None
+        return guild_id is None or str(guild_id) == str(self.guild_id)
+
+    def offer(self, frame: bytes, now: float) -> bool:
+        """Buffer `frame`; returns False when the subscriber should be disconnected."""
+        if self.closed:
+            return False
+        if len(self._items) >= self.maxsize:
+            if self.policy == "disconnect":
+                return False
+            self.dropped += 1
+            if self.policy == "drop_newest":
+                return True
+            self._items.popleft()
+        self._items.append((now, frame))
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+        return True
+
+    def close(self, reason: str = "unsubscribed") -> None:
+        if self.closed:
+            return
+        self.closed = True
+        self.close_reason = reason
+        self._items.clear()
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+
+    async def _wait(self, timeout: float | None = None) -> None:
+        self._waiter = asyncio.get_running_loop().create_future()
+        try:
+            await asyncio.wait_for(self._waiter, timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            self._waiter = None
+
+    async def get(self) -> bytes:
+        """Next single frame."""
+        while not self._items:
+            if self.closed:
+                raise SubscriptionClosed(self.close_reason)
+            await self._wait()
+        self.delivered += 1
+        return self._items.popleft()[1]
+
+    async def get_batch(self, max_frames: int = EVENT_BATCH_MAX, window: float = EVENT_BATCH_WINDOW) -> bytes:
+        """Every buffered frame (up to `max_frames`) as one chunk, optionally waiting `window`
+        seconds after the first frame for more to arrive."""
+        first = await self.get()
+        if window > 0 and len(self._items) < max_frames - 1 and not self.closed:
+            await self._wait(window)
+        if not self._items:
+            return first
+        frames = [first]
+        while self._items and len(frames) < max_frames:
+            frames.append(self._items.popleft()[1])
+        self.delivered += len(frames) - 1
+        return b"".join(frames)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> bytes:
+        try:
+            return await self.get_batch()
+        except SubscriptionClosed:
+            raise StopAsyncIteration
+
+
+class Coalescer:
+    """Holds events of one type for `window` seconds and releases one event per key.
+
+    `sum` adds up the numeric payload `fields` (other payload keys come from the newest event)
+    and sets `payload.count`; `last` keeps only the newest event. `key` names the payload field
+    that separates buckets (e.g. guild_id), None puts every event in one bucket.
+    """
+
+    def __init__(self, window: float, mode: str = "last", fields: Iterable[str] = (), key: Optional[str] = None):
+        if mode not in COALESCE_MODES:
+            raise ValueError(f"unknown coalesce mode {mode!r}")
+        self.window = window
+        self.mode = mode
+        self.fields = tuple(fields)
+        self.key = key
+        self._pending: Dict[Any, dict] = {}
+        self.received = 0
+        self.released = 0
+
+    def bucket(self, data: dict) -> Any:
+        if self.key is None:
+            return None
+        payload = data.get("payload")
+        return payload.get(self.key) if isinstance(payload, dict) else None
+
+    def add(self, data: dict) -> bool:
+        """Merge `data` into its bucket; True when the bucket was empty (a flush must be scheduled)."""
+        self.received += 1
+        key = self.bucket(data)
+        pending = self._pending.get(key)
+        if pending is None or self.mode == "last":
+            merged = dict(data)
+            payload = data.get("payload")
+            if self.mode == "sum" and isinstance(payload, dict):
+                merged["payload"] = dict(payload, count=1)
+            self._pending[key] = merged
+            return pending is None
+        payload = pending.get("payload")
+        incoming = data.get("payload")
+        if isinstance(payload, dict) and isinstance(incoming, dict):
+            totals = {f: (payload.get(f) or 0) + (incoming.get(f) or 0) for f in self.fields}
+            pending["payload"] = dict(incoming, **totals, count=payload.get("count", 1) + 1)
+        return False
+
+    def pop(self, key: Any) -> Optional[dict]:
+        data = self._pending.pop(key, None)
+        if data is not None:
+            self.released += 1
+        return data
+
+    def keys(self) -> list:
+        return list(self._pending)
 
 
 class Broadcaster:
-    def __init__(self):
-        self._queues: Set[asyncio.Queue] = set()
+    def __init__(self, max_lag: float = EVENT_MAX_LAG, replay_size: int = EVENT_REPLAY_SIZE):
+        self.max_lag = max_lag
+        # id sequence: our own until the event bus hands us the broker's (seed / fan_out)
+        self._epoch = int(time.time() * 1000)
+        self._seq = 0
+        # (seq, event, frame) of the current epoch, oldest first
+        self._replay: Deque[Tuple[int, Any, bytes]] = deque(maxlen=replay_size)
+        self._queues: Set[Subscription] = set()
+        # subscribers without a topic filter, and topic -> subscribers for the rest
+        self._unfiltered: Set[Subscription] = set()
+        self._by_topic: Dict[str, Set[Subscription]] = {}
         self._handlers: Set[callable] = set()
+        self._bus = None
+        self._coalescers: Dict[str, Coalescer] = {}
+        self._timers: Dict[Tuple[str, Any], asyncio.TimerHandle] = {}
+        self.evictions = 0
+        metrics.gauge("event_subscribers", lambda: len(self._queues))
+        metrics.gauge("event_max_lag_seconds", lambda: self.stats()["max_lag"])
+        metrics.gauge("event_evictions", lambda: self.evictions)
 
-    def subscribe(self) -> asyncio.Queue:
-        q: asyncio.Queue = asyncio.Queue()
+    @property
+    def last_event_id(self) -> str:
+        return format_event_id(self._epoch, self._seq)
+
+    def subscribe(self, maxsize: int = EVENT_QUEUE_SIZE, policy: str = EVENT_OVERFLOW,
+                  topics: Optional[Iterable[str]] = None, guild_id: Optional[int] = None,
+                  last_event_id: Optional[str] = None) -> Subscription:
+        """New subscriber; with `last_event_id` it starts with the buffered events it missed."""
+        q = Subscription(maxsize, policy, topics, guild_id)
+        if last_event_id is not None:
+            self._replay_into(q, last_event_id)
         self._queues.add(q)
+        if q.topics is None:
+            self._unfiltered.add(q)
+        else:
+            for topic in q.topics:
+                self._by_topic.setdefault(topic, set()).add(q)
         return q
 
-    def unsubscribe(self, q: asyncio.Queue) -> None:
+    def _replay_into(self, q: Subscription, last_event_id: str) -> None:
+        now = time.monotonic()
+        epoch, last_seq = parse_event_id(last_event_id) or (None, -1)
+        oldest = self._replay[0][0] if self._replay else self._seq + 1
+        missed = []
+        # an id of another sequence (the broker restarted) or one that fell out of the ring
+        # cannot be resumed; neither can more events than fit the subscriber buffer
+        if epoch == self._epoch and oldest - 1 <= last_seq <= self._seq:
+            missed = [(i, data, frame) for i, data, frame in self._replay if i > last_seq and q.matches(data)]
+            if len(missed) < q.maxsize:
+                for _, _, frame in missed:
+                    q.offer(frame, now)
+                return
+            missed = missed[-(q.maxsize - 1):] if q.maxsize > 1 else []
+        # the reset carries the id just before the first replayed frame, so a client that
+        # drops again right after it still resumes at the replayed events
+        reset_id = format_event_id(self._epoch, missed[0][0] - 1 if missed else self._seq)
+        reset = {"type": "stream:reset", "payload": {"last_event_id": reset_id}}
+        q.offer(encode_sse(encode_json(reset), reset_id), now)
+        for _, _, frame in missed:
+            q.offer(frame, now)
+
+    def _remove(self, q: Subscription) -> None:
+        self._queues.discard(q)
+        self._unfiltered.discard(q)
+        for topic in q.topics or ():
+            subs = self._by_topic.get(topic)
+            if subs is not None:
+                subs.discard(q)
+                if not subs:
+                    del self._by_topic[topic]
+
+    def unsubscribe(self, q: Subscription) -> None:
         try:
-            self._queues.discard(q)
+            self._remove(q)
+            q.close()
         except Exception:
             pass
 
+    def _targets(self, data: Any) -> Set[Subscription]:
+        event_type = data.get("type") if isinstance(data, dict) else None
+        if not isinstance(event_type, str):
+            return set(self._unfiltered)
+        targets = set(self._unfiltered)
+        targets.update(self._by_topic.get(event_type, ()))
+        namespace = event_type.split(":", 1)[0]
+        if namespace != event_type:
+            targets.update(self._by_topic.get(namespace, ()))
+        return targets
+
+    def _evict(self, q: Subscription, reason: str) -> None:
+        logger.warning("Evicting event subscriber (%s, %d buffered, %d dropped)", reason, q.qsize(), q.dropped)
+        self._remove(q)
+        q.close(reason)
+        self.evictions += 1
+
+    def attach_bus(self, bus) -> None:
+        """Forward published events to other processes (see bot.eventbus)."""
+        self._bus = bus
+
+    def coalesce(self, event_type: str, window: float, mode: str = "last",
+                 fields: Iterable[str] = (), key: Optional[str] = None) -> None:
+        """Coalesce events of `event_type` over `window` seconds (see Coalescer); 0 turns it off."""
+        self.flush(event_type)
+        if window <= 0:
+            self._coalescers.pop(event_type, None)
+            return
+        self._coalescers[event_type] = Coalescer(window, mode, fields, key)
+
+    def _release(self, event_type: str, key: Any) -> None:
+        timer = self._timers.pop((event_type, key), None)
+        if timer is not None:
+            timer.cancel()
+        coalescer = self._coalescers.get(event_type)
+        data = coalescer.pop(key) if coalescer is not None else None
+        if data is not None:
+            self._publish(data, forward=True)
+
+    def flush(self, event_type: Optional[str] = None) -> None:
+        """Publish held events now (all types, or only `event_type`)."""
+        types = [event_type] if event_type is not None else list(self._coalescers)
+        for t in types:
+            coalescer = self._coalescers.get(t)
+            for key in coalescer.keys() if coalescer is not None else ():
+                self._release(t, key)
+
     def register_handler(self, fn: callable) -> None:
         self._handlers.add(fn)
 
@@ -28,13 +380,43 @@ class Broadcaster:
         except Exception:
             pass
 
-    def publish(self, data: Any) -> None:
-        # push into queues for SSE
-        for q in list(self._queues):
+    def publish(self, data: Any, forward: bool = True, event_id: Optional[Tuple[int, int]] = None,
+                body: Optional[str] = None) -> None:
+        """Deliver `data` to local subscribers and handlers, and (unless it came from the
+        event bus, `forward=False`) to other processes. The bus passes the broker's
+        `event_id` (epoch, seq) and the received JSON `body`.
+
+        Types registered with coalesce() are held and published once per window; events from
+        the bus were already coalesced by the process that published them."""
+        event_type = data.get("type") if isinstance(data, dict) else None
+        coalescer = self._coalescers.get(event_type) if forward and event_type else None
+        if coalescer is not None:
             try:
-                q.put_nowait(data)
-            except asyncio.QueueFull:
-                pass
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                loop = None
+            if loop is not None:
+                if coalescer.add(data):
+                    key = coalescer.bucket(data)
+                    self._timers[(event_type, key)] = loop.call_later(coalescer.window, self._release, event_type, key)
+                return
+        self._publish(data, forward, event_id, body)
+
+    def _publish(self, data: Any, forward: bool, event_id: Optional[Tuple[int, int]] = None,
+                 body: Optional[str] = None) -> None:
+        # encoded once: the JSON body goes to the event bus and into the shared SSE frame
+        if body is None:
+            body = encode_json(data)
+        if forward and self._bus is not None:
+            # the broker numbers the event and echoes it back; subscribers get it then (fan_out)
+            try:
+                self._bus.send(body)
+            except Exception:
+                logger.exception("Event bus send failed")
+        else:
+            if event_id is None:
+                event_id = (self._epoch, self._seq + 1)
+            self.fan_out(data, body, *event_id)
         # call registered handlers (non-blocking)
         loop = asyncio.get_event_loop()
         for h in list(self._handlers):
@@ -46,6 +428,67 @@ class Broadcaster:
                 except Exception:
                     pass
 
+    def fan_out(self, data: Any, body: str, epoch: int, seq: int) -> None:
+        """Frame event `seq` of `epoch`, keep it for replay and push it into the subscriber buffers."""
+        if epoch != self._epoch:
+            # a new sequence (the broker restarted): ids of the old one cannot be resumed
+            self._epoch = epoch
+            self._replay.clear()
+        self._seq = seq
+        frame = encode_sse(body, format_event_id(epoch, seq))
+        self._replay.append((seq, data, frame))
+        # push into bounded subscriber buffers for SSE; evict subscribers that overflow
+        # under the disconnect policy or stay too far behind
+        now = time.monotonic()
+        for q in self._targets(data):
+            if not q.wants(data):
+                continue
+            if not q.offer(frame, now):
+                self._evict(q, "overflow")
+            elif q.lag(now) > self.max_lag:
+                self._evict(q, "lag")
+
+    def seed(self, epoch: int, events: Iterable[Tuple[int, Any, str]]) -> None:
+        """Take over the event bus broker's replay buffer ((seq, event, body) items) on connect.
+
+        A restarted process starts with the broker's recent events, so its clients can resume.
+        After a short disconnect from the same broker, the events missed meanwhile are also
+        pushed to the current subscribers (their handlers are not run again)."""
+        catch_up = epoch == self._epoch
+        if not catch_up:
+            self._epoch, self._seq = epoch, 0
+            self._replay.clear()
+        for seq, data, body in events:
+            if seq <= self._seq:
+                continue
+            if catch_up:
+                self.fan_out(data, body, epoch, seq)
+            else:
+                self._replay.append((seq, data, encode_sse(body, format_event_id(epoch, seq))))
+                self._seq = seq
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        subs = list(self._queues)
+        return {
+            "subscribers": len(subs),
+            "topics": {topic: len(s) for topic, s in self._by_topic.items()},
+            "buffered": sum(q.qsize() for q in subs),
+            "max_lag": max((q.lag(now) for q in subs), default=0.0),
+            "dropped": sum(q.dropped for q in subs),
+            "evictions": self.evictions,
+            "last_event_id": self.last_event_id,
+            "replay_buffered": len(self._replay),
+            "coalesced": {
+                t: {"received": c.received, "published": c.released, "pending": len(c.keys())}
+                for t, c in self._coalescers.items()
+            },
+        }
+
 
 # singleton
 broadcaster = Broadcaster()
+# chat replies publish one network event each: chart them as rx/tx per second
+broadcaster.coalesce("network", EVENT_COALESCE_NETWORK, "sum", fields=("rx", "tx"))
+# every queue change carries the whole queue, so only the newest per guild matters
+broadcaster.coalesce("music:queue_update", EVENT_COALESCE_QUEUE, "last", key="guild_id")
@@ -1,9 +1,24 @@
-"""Lightweight Gemini API wrapper (synchronous/async usage)
-This wrapper prefers google-generative-ai library if available, otherwise falls back to a simple HTTP stub.
+"""Lightweight Gemini API wrapper (async usage)
+This wrapper prefers google-generative-ai library if available, otherwise falls back to the Gemini REST API
+over pooled aiohttp connections, or to a simple stub when no API key is configured.
+Setting GEMINI_STANDIN_URL routes every call to the local stand-in server (bot/gemini_stub.py) instead.
+No backend ever blocks the event loop: the native async SDK is used when present, and sync-only SDK calls
+are pushed onto a bounded dedicated executor.
 """
 import os
 import asyncio
+import json
+import time
 import logging
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, Awaitable, Callable, Dict
+
+import aiohttp
+
+from bot.cache import response_cache, make_key
+from bot.scheduler import scheduler, SchedulerBusy, PRIORITY_INTERACTIVE, PRIORITY_BACKGROUND
+from bot.resilience import breakers, Permit, GEMINI_DEADLINE
 
 try:
     import google.generativeai as genai
@@ -19,37 +34,492 @@ API_KEY = os.getenv("GEMINI_API_KEY")
 DEFAULT_CHEAP_MODEL = os.getenv("GEMINI_CHEAP_MODEL", "gemini-1.5" )
 DEFAULT_HIGH_MODEL = os.getenv("GEMINI_HIGH_MODEL", "gemini-pro")
 
+# Connection / worker limits
+GEMINI_MAX_WORKERS = int(os.getenv("GEMINI_MAX_WORKERS", "16"))
+GEMINI_POOL_SIZE = int(os.getenv("GEMINI_POOL_SIZE", "32"))
+GEMINI_KEEPALIVE = float(os.getenv("GEMINI_KEEPALIVE", "60"))
+GEMINI_REST_URL = os.getenv("GEMINI_REST_URL", "https://generativelanguage.googleapis.com/v1beta")
+# local stand-in server for load tests / benchmarks, e.g. http://127.0.0.1:8089/v1beta
+GEMINI_STANDIN_URL = os.getenv("GEMINI_STANDIN_URL")
+
 if _HAS_GENAI and API_KEY:
     genai.configure(api_key=API_KEY)
 
 
-async def chat(prompt: str, system: str = None, max_tokens: int = 512, model: str | None = None) -> dict:
-    """Call Gemini chat. Returns dict with keys: 'text', 'tokens' (estimated)"""
-    model = model or DEFAULT_HIGH_MODEL
-    if _HAS_GENAI:
-        try:
-            resp = genai.ChatCompletion.create(
+def estimate_tokens(text: str) -> float:
+    return float(len(text.split()) / 0.75) if text else 0.0
+
+
+def _rest_body(prompt: str, system: str | None, max_tokens: int) -> dict:
+    body = {
+        "contents": [{"role": "user", "parts": [{"text": prompt}]}],
+        "generationConfig": {"maxOutputTokens": max_tokens},
+    }
+    if system:
+        body["systemInstruction"] = {"parts": [{"text": system}]}
+    return body
+
+
+def _rest_text(data: dict) -> str:
+    parts = ((data.get("candidates") or [{}])[0].get("content") or {}).get("parts") or []
+    return "".join(p.get("text", "") for p in parts)
+
+
+def _rest_tokens(data: dict, text: str) -> float:
+    """Output tokens (like estimate_tokens(text) on the other backends); the prompt is charged separately."""
+    usage = data.get("usageMetadata") or {}
+    if usage.get("candidatesTokenCount"):
+        return float(usage["candidatesTokenCount"])
+    return estimate_tokens(text)
+
+
+def _rest_prompt_tokens(data: dict) -> float | None:
+    usage = data.get("usageMetadata") or {}
+    if usage.get("promptTokenCount"):
+        return float(usage["promptTokenCount"])
+    return None
+
+
+class GeminiClient:
+    """Per-process Gemini client holding the pooled resources shared by every call.
+
+    - native async SDK (`GenerativeModel.generate_content_async`) when available
+    - legacy sync SDK calls on a bounded executor (never the default loop executor)
+    - REST fallback with one keep-alive aiohttp session per model
+    """
+
+    def __init__(self, max_workers: int = GEMINI_MAX_WORKERS, pool_size: int = GEMINI_POOL_SIZE):
+        self.max_workers = max_workers
+        self.pool_size = pool_size
+        self._executor: ThreadPoolExecutor | None = None
+        self._sessions: Dict[str, aiohttp.ClientSession] = {}
+        self._models: Dict[str, object] = {}
+
+    @property
+    def backend(self) -> str:
+        if GEMINI_STANDIN_URL:
+            return "standin"
+        if _HAS_GENAI and hasattr(genai, "GenerativeModel"):
+            return "genai-async"
+        if _HAS_GENAI:
+            return "genai-sync"
+        if API_KEY:
+            return "rest"
+        return "stub"
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="gemini")
+        return self._executor
+
+    def _get_session(self, model: str) -> aiohttp.ClientSession:
+        session = self._sessions.get(model)
+        if session is None or session.closed:
+            connector = aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=GEMINI_KEEPALIVE)
+            session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=120))
+            self._sessions[model] = session
+        return session
+
+    def _get_model(self, model: str, system: str | None):
+        key = f"{model}\x00{system or ''}"
+        m = self._models.get(key)
+        if m is None:
+            m = genai.GenerativeModel(model, system_instruction=system or None)
+            self._models[key] = m
+        return m
+
+    async def generate(self, prompt: str, system: str | None, max_tokens: int, model: str) -> dict:
+        backend = self.backend
+        if backend == "genai-async":
+            m = self._get_model(model, system)
+            resp = await m.generate_content_async(prompt, generation_config={"max_output_tokens": max_tokens})
+            text = getattr(resp, "text", None) or ""
+        elif backend == "genai-sync":
+            loop = asyncio.get_running_loop()
+            resp = await loop.run_in_executor(self._get_executor(), lambda: genai.ChatCompletion.create(
                 model=model,
                 messages=[{"role": "system", "content": system or ""}, {"role": "user", "content": prompt}],
                 max_output_tokens=max_tokens,
-            )
+            ))
             text = getattr(resp, "content", None) or resp["choices"][0]["message"]["content"]
-            tokens = (len(text.split()) // 0.75) if text else 0
-            return {"text": text, "tokens": float(tokens)}
-        except Exception as e:
-            logger.exception("Gemini chat failed: %s", e)
-            return {"text": "", "tokens": 0.0}
-    else:
-        await asyncio.sleep(0.2)
-        text = f"[stub] {prompt[:512]}"
-        return {"text": text, "tokens": float(len(text.split())/0.75)}
-
-
-async def summarize_context(text: str, max_tokens: int = 128) -> dict:
+        elif backend in ("rest", "standin"):
+            return await self._generate_rest(prompt, system, max_tokens, model)
+        else:
+            await asyncio.sleep(0.2)
+            text = f"[stub] {prompt[:512]}"
+        return {"text": text, "tokens": estimate_tokens(text)}
+
+    def _rest_endpoint(self, model: str, action: str) -> tuple:
+        if GEMINI_STANDIN_URL:
+            return f"{GEMINI_STANDIN_URL}/models/{model}:{action}", {}
+        return f"{GEMINI_REST_URL}/models/{model}:{action}", {"key": API_KEY}
+
+    async def _generate_rest(self, prompt: str, system: str | None, max_tokens: int, model: str) -> dict:
+        body = _rest_body(prompt, system, max_tokens)
+        url, params = self._rest_endpoint(model, "generateContent")
+        session = self._get_session(model)
+        async with session.post(url, params=params, json=body) as resp:
+            resp.raise_for_status()
+            data = await resp.json()
+        text = _rest_text(data)
+        resp = {"text": text, "tokens": _rest_tokens(data, text)}
+        prompt_tokens = _rest_prompt_tokens(data)
+        if prompt_tokens is not None:
+            resp["prompt_tokens"] = prompt_tokens
+        return resp
+
+    async def generate_stream(self, prompt: str, system: str | None, max_tokens: int, model: str) -> AsyncIterator[str]:
+        """Yield partial text chunks as the model produces them."""
+        backend = self.backend
+        if backend == "genai-async":
+            m = self._get_model(model, system)
+            resp = await m.generate_content_async(prompt, generation_config={"max_output_tokens": max_tokens}, stream=True)
+            async for chunk in resp:
+                text = getattr(chunk, "text", None)
+                if text:
+                    yield text
+        elif backend in ("rest", "standin"):
+            async for text in self._stream_rest(prompt, system, max_tokens, model):
+                yield text
+        elif backend == "stub":
+            text = f"[stub] {prompt[:512]}"
+            for word in text.split(" "):
+                await asyncio.sleep(0.02)
+                yield word + " "
+        else:
+            # sync SDK has no streaming: deliver the whole answer as one chunk
+            resp = await self.generate(prompt, system, max_tokens, model)
+            if resp["text"]:
+                yield resp["text"]
+
+    async def _stream_rest(self, prompt: str, system: str | None, max_tokens: int, model: str) -> AsyncIterator[str]:
+        body = _rest_body(prompt, system, max_tokens)
+        url, params = self._rest_endpoint(model, "streamGenerateContent")
+        session = self._get_session(model)
+        async with session.post(url, params=dict(params, alt="sse"), json=body) as resp:
+            resp.raise_for_status()
+            async for raw in resp.content:
+                line = raw.decode("utf-8", "ignore").strip()
+                if not line.startswith("data:"):
+                    continue
+                text = _rest_text(json.loads(line[5:]))
+                if text:
+                    yield text
+
+    async def close(self) -> None:
+        for session in list(self._sessions.values()):
+            try:
+                await session.close()
+            except Exception:
+                pass
+        self._sessions.clear()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+        await response_cache.close()
+
+
+class SingleFlight:
+    """Coalesce concurrent identical calls: the first caller for a key starts the request,
+    every caller arriving while it is in flight awaits the same result.
+
+    The request runs in its own task, so cancelling any one caller (the first included) does
+    not cancel the others; it is only cancelled once no caller is waiting for it any more."""
+
+    def __init__(self):
+        self._calls: Dict[str, asyncio.Task] = {}
+        self._waiters: Dict[str, int] = {}
+        self.leaders = 0
+        self.shared = 0
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[dict]]) -> dict:
+        task = self._calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fn())
+            self._calls[key] = task
+            task.add_done_callback(lambda t: self._finished(key, t))
+            self.leaders += 1
+        else:
+            self.shared += 1
+        self._waiters[key] = self._waiters.get(key, 0) + 1
+        try:
+            return dict(await asyncio.shield(task))
+        finally:
+            self._waiters[key] -= 1
+            if not self._waiters[key]:
+                del self._waiters[key]
+                if not task.done():
+                    # every caller gave up: stop the request and let the next caller start afresh
+                    task.cancel()
+                    if self._calls.get(key) is task:
+                        del self._calls[key]
+
+    def _finished(self, key: str, task: asyncio.Task) -> None:
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        # mark retrieved so a failure nobody awaited is not reported as unhandled
+        if not task.cancelled():
+            task.exception()
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": len(self._calls),
+            "waiting": sum(self._waiters.values()),
+            "leaders": self.leaders,
+            "shared": self.shared,
+        }
+
+
+# singletons
+client = GeminiClient()
+singleflight = SingleFlight()
+
+
+def _request_cost(prompt: str, system: str | None, max_tokens: int) -> float:
+    # up-front TPM charge; reconciled with the real usage once the call completes
+    return estimate_tokens(prompt) + estimate_tokens(system or "") + max_tokens
+
+
+class EmptyResponse(Exception):
+    """The model answered without any text."""
+
+
+def _alternate(model: str) -> str | None:
+    """The fallback / hedge target for `model` (cheap <-> high)."""
+    if model == DEFAULT_HIGH_MODEL and DEFAULT_CHEAP_MODEL != model:
+        return DEFAULT_CHEAP_MODEL
+    if model == DEFAULT_CHEAP_MODEL and DEFAULT_HIGH_MODEL != model:
+        return DEFAULT_HIGH_MODEL
+    return None
+
+
+def _pick_models(model: str) -> tuple:
+    """(primary, its breaker permit, alternate) honoring open breakers; primary is None when no
+    model is available."""
+    alt = _alternate(model)
+    permit = breakers.get(model).allow()
+    if permit:
+        return model, permit, alt
+    permit = breakers.get(alt).allow() if alt else None
+    if permit:
+        return alt, permit, None
+    return None, None, None
+
+
+@asynccontextmanager
+async def _dispatch(model: str, permit: Permit, guild_id: int | None, priority: int, cost: float,
+                    dispatched: asyncio.Event | None = None):
+    """scheduler.slot() for `model`. A call that never leaves the queue (shed or cancelled) gives
+    back its breaker `permit` (the half-open probe, possibly); `dispatched` is set once it runs."""
+    entered = False
+    try:
+        async with scheduler.slot(model, guild_id=guild_id, priority=priority, cost=cost) as ticket:
+            entered = True
+            if dispatched is not None:
+                dispatched.set()
+            yield ticket
+    finally:
+        if not entered:
+            breakers.get(model).record_cancel(permit)
+
+
+async def _with_deadline(chunks: AsyncIterator[str], deadline: float) -> AsyncIterator[str]:
+    """Re-yield `chunks`; raises TimeoutError when the first chunk, or the gap between two chunks,
+    takes longer than `deadline` seconds."""
+    it = chunks.__aiter__()
+    try:
+        while True:
+            try:
+                chunk = await asyncio.wait_for(it.__anext__(), deadline)
+            except StopAsyncIteration:
+                return
+            yield chunk
+    finally:
+        await it.aclose()
+
+
+async def _attempt(prompt: str, system: str | None, max_tokens: int, model: str, permit: Permit, guild_id: int | None,
+                   priority: int, dispatched: asyncio.Event | None = None) -> dict:
+    """One scheduled, deadline-bounded call to `model`, recorded on its circuit breaker under `permit`."""
+    breaker = breakers.get(model)
+    async with _dispatch(model, permit, guild_id, priority, _request_cost(prompt, system, max_tokens), dispatched) as ticket:
+        start = time.perf_counter()
+        # failed and abandoned attempts (a lost hedge included) give back their up-front estimate
+        used = 0.0
+        try:
+            resp = await asyncio.wait_for(client.generate(prompt, system, max_tokens, model), GEMINI_DEADLINE)
+            if not resp["text"]:
+                raise EmptyResponse(model)
+            # the prompt is charged once: counted by the API when it reports it, estimated otherwise
+            used = (resp.pop("prompt_tokens", None) or estimate_tokens(prompt)) + resp["tokens"]
+        except asyncio.CancelledError:
+            breaker.record_cancel(permit)
+            raise
+        except Exception:
+            breaker.record_failure(permit)
+            raise
+        finally:
+            ticket.used(used)
+        breaker.record_success(permit, time.perf_counter() - start)
+    resp["queue_ms"] = ticket.queue_ms
+    resp["model"] = model
+    return resp
+
+
+async def _hedged_call(prompt: str, system: str | None, max_tokens: int, model: str, guild_id: int | None, priority: int) -> dict:
+    """Call `model`; once it runs past its p95 latency (or fails) race the alternate model. First answer wins.
+    The hedge delay counts from when the primary leaves the scheduler queue, so queueing alone never hedges."""
+    primary, permit, alt = _pick_models(model)
+    if primary is None:
+        logger.warning("Gemini circuit open for %s and its fallback", model)
+        return {"text": "", "tokens": 0.0}
+    loop = asyncio.get_running_loop()
+    dispatched = asyncio.Event()
+    tasks = {asyncio.create_task(_attempt(prompt, system, max_tokens, primary, permit, guild_id, priority, dispatched))}
+    hedge_delay = breakers.get(primary).hedge_delay()
+    dispatch_wait = asyncio.create_task(dispatched.wait())
+    hedge_at = None
+    hedged = False
+    busy = 0
+    attempts = 1
+    try:
+        while tasks:
+            waiting = set(tasks)
+            timeout = None
+            if alt and not hedged and hedge_delay:
+                if dispatched.is_set():
+                    if hedge_at is None:
+                        hedge_at = loop.time() + hedge_delay
+                    timeout = max(0.0, hedge_at - loop.time())
+                else:
+                    waiting.add(dispatch_wait)
+            done, _ = await asyncio.wait(waiting, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            launch = not done
+            done.discard(dispatch_wait)
+            tasks -= done
+            for t in done:
+                err = t.exception()
+                if err is None:
+                    resp = t.result()
+                    resp["hedged"] = hedged
+                    return resp
+                if isinstance(err, SchedulerBusy):
+                    busy += 1
+                elif not isinstance(err, EmptyResponse):
+                    logger.warning("Gemini call to %s failed: %r", primary, err)
+                launch = True
+            hedge_permit = breakers.get(alt).allow() if launch and alt and not hedged else None
+            if hedge_permit:
+                hedged = True
+                attempts += 1
+                tasks.add(asyncio.create_task(_attempt(prompt, system, max_tokens, alt, hedge_permit, guild_id, priority)))
+    finally:
+        dispatch_wait.cancel()
+        for t in tasks:
+            t.cancel()
+    if busy == attempts:
+        raise SchedulerBusy("all models busy")
+    return {"text": "", "tokens": 0.0}
+
+
+async def chat(prompt: str, system: str = None, max_tokens: int = 512, model: str | None = None, cache: bool = True,
+               guild_id: int | None = None, priority: int = PRIORITY_INTERACTIVE) -> dict:
+    """Call Gemini chat. Returns dict with keys: 'text', 'tokens' (estimated), 'queue_ms', 'model' and 'cached' on a cache hit.
+    Slow or failing calls are hedged / retried on the alternate model; open circuit breakers are skipped.
+    Raises SchedulerBusy when the request is shed by the scheduler."""
+    model = model or DEFAULT_HIGH_MODEL
+    key = make_key(model, system, prompt) if cache else None
+    if key:
+        hit = await response_cache.get(key)
+        if hit:
+            return hit
+
+    async def call() -> dict:
+        resp = await _hedged_call(prompt, system, max_tokens, model, guild_id, priority)
+        if key:
+            await response_cache.set(key, resp["text"], resp["tokens"])
+        return resp
+
+    return await singleflight.do(key or make_key(model, system, prompt), call)
+
+
+async def chat_stream(prompt: str, system: str = None, max_tokens: int = 512, model: str | None = None, cache: bool = True,
+                      guild_id: int | None = None, priority: int = PRIORITY_INTERACTIVE, timings: dict | None = None) -> AsyncIterator[str]:
+    """Call Gemini chat in streaming mode. Yields partial text chunks; yields nothing on failure.
+    A cached answer is yielded as a single chunk and sets `timings['cached']`. Queue wait is stored in
+    `timings['queue_ms']` when given.
+    Open circuit breakers route to the alternate model, and a stream failing before its first chunk is retried there.
+    GEMINI_DEADLINE bounds the wait for the first chunk and every gap between chunks.
+    Raises SchedulerBusy (before the first chunk) when the request is shed by the scheduler."""
+    model = model or DEFAULT_HIGH_MODEL
+    key = make_key(model, system, prompt) if cache else None
+    if key:
+        hit = await response_cache.get(key)
+        if hit:
+            if timings is not None:
+                timings["cached"] = True
+            yield hit["text"]
+            return
+    primary, permit, alt = _pick_models(model)
+    candidates = [m for m in (primary, alt) if m]
+    parts = []
+    for i, current in enumerate(candidates):
+        breaker = breakers.get(current)
+        if i:
+            permit = breaker.allow()
+            if not permit:
+                break
+        async with _dispatch(current, permit, guild_id, priority, _request_cost(prompt, system, max_tokens)) as ticket:
+            if timings is not None:
+                timings["queue_ms"] = timings.get("queue_ms", 0.0) + ticket.queue_ms
+            start = time.perf_counter()
+            try:
+                async for chunk in _with_deadline(client.generate_stream(prompt, system, max_tokens, current), GEMINI_DEADLINE):
+                    parts.append(chunk)
+                    yield chunk
+            except (asyncio.CancelledError, GeneratorExit):
+                breaker.record_cancel(permit)
+                raise
+            except Exception as e:
+                logger.exception("Gemini stream failed: %s", e)
+                breaker.record_failure(permit)
+                if parts:
+                    return
+                continue
+            finally:
+                # a stream that produced nothing gives back its up-front estimate
+                ticket.used(estimate_tokens(prompt) + estimate_tokens("".join(parts)) if parts else 0.0)
+            if not parts:
+                breaker.record_failure(permit)
+                continue
+            breaker.record_success(permit, time.perf_counter() - start)
+        break
+    if key and parts:
+        text = "".join(parts)
+        await response_cache.set(key, text, estimate_tokens(text))
+
+
+def stats() -> dict:
+    """Client-side counters for the dashboard / API."""
+    return {
+        "backend": client.backend,
+        "singleflight": singleflight.stats(),
+        "scheduler": scheduler.stats(),
+        "breakers": breakers.stats(),
+        "cache": response_cache.stats(),
+    }
+
+
+async def summarize_context(text: str, max_tokens: int = 128, guild_id: int | None = None) -> dict:
     """Generate a short summary using the cheap model to save tokens."""
     # Use cheap model for summarization
     if not text:
         return {"summary": "", "tokens": 0.0}
     prompt = f"要約してください（短く）: {text}"
-    resp = await chat(prompt, system="Summarize the conversation briefly.", max_tokens=max_tokens, model=DEFAULT_CHEAP_MODEL)
+    try:
+        resp = await chat(prompt, system="Summarize the conversation briefly.", max_tokens=max_tokens, model=DEFAULT_CHEAP_MODEL,
+                          guild_id=guild_id, priority=PRIORITY_BACKGROUND)
+    except SchedulerBusy:
+        # background work is shed first under load; keep the raw history for now
+        return {"summary": "", "tokens": 0.0}
     return {"summary": (resp.get("text") or "").strip(), "tokens": resp.get("tokens", 0.0)}
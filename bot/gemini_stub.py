@@ -0,0 +1,182 @@
+"""Local Gemini stand-in server for load tests and benchmarks without real quota.
+
+Speaks the subset of the Gemini REST API the bot uses:
+- POST /v1beta/models/{model}:generateContent
+- POST /v1beta/models/{model}:streamGenerateContent?alt=sse
+- GET  /stats   (token / request accounting)
+
+Point the bot at it with GEMINI_STANDIN_URL=http://127.0.0.1:8089/v1beta.
+
+Run: python -m bot.gemini_stub --port 8089 [--profile profiles.json]
+
+Profiles (JSON, keyed by model name or "default"):
+    {"default": {"latency": "lognormal:0.8,0.4", "chunk_delay": 0.05, "error_rate": 0.01, "rate_limit_rate": 0.02},
+     "gemini-pro": {"latency": "uniform:1.0,3.0"}}
+Latency specs: "fixed:S", "uniform:LO,HI", "lognormal:MEDIAN,SIGMA" (seconds).
+"""
+import os
+import json
+import math
+import random
+import asyncio
+import argparse
+import logging
+from dataclasses import dataclass, field, asdict
+from typing import Dict
+
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class Profile:
+    latency: str = os.getenv("STANDIN_LATENCY", "fixed:0.2")
+    # pacing between streamed chunks and words per chunk
+    chunk_delay: float = float(os.getenv("STANDIN_CHUNK_DELAY", "0.05"))
+    chunk_words: int = int(os.getenv("STANDIN_CHUNK_WORDS", "3"))
+    response_words: int = int(os.getenv("STANDIN_RESPONSE_WORDS", "40"))
+    error_rate: float = float(os.getenv("STANDIN_ERROR_RATE", "0"))
+    rate_limit_rate: float = float(os.getenv("STANDIN_429_RATE", "0"))
+
+    def sample_latency(self, rng: random.Random) -> float:
+        kind, _, args = self.latency.partition(":")
+        vals = [float(v) for v in args.split(",") if v]
+        if kind == "uniform":
+            return rng.uniform(vals[0], vals[1])
+        if kind == "lognormal":
+            return rng.lognormvariate(math.log(vals[0]), vals[1])
+        return vals[0] if vals else 0.0
+
+
+@dataclass
+class Accounting:
+    requests: int = 0
+    streams: int = 0
+    errors: int = 0
+    rate_limited: int = 0
+    prompt_tokens: int = 0
+    output_tokens: int = 0
+    per_model: Dict[str, int] = field(default_factory=dict)
+
+
+class StandInServer:
+    def __init__(self, profiles: Dict[str, Profile] | None = None, seed: int = int(os.getenv("STANDIN_SEED", "0"))):
+        self.profiles = profiles or {"default": Profile()}
+        self.rng = random.Random(seed)
+        self.stats = Accounting()
+
+    def profile(self, model: str) -> Profile:
+        return self.profiles.get(model) or self.profiles.get("default") or Profile()
+
+    @staticmethod
+    def _count(text: str) -> int:
+        return int(len(text.split()) / 0.75) if text else 0
+
+    def _answer(self, model: str, prompt: str, words: int) -> str:
+        src = prompt.split() or ["ok"]
+        body = [src[i % len(src)] for i in range(words)]
+        return f"[standin:{model}] " + " ".join(body)
+
+    async def _parse(self, request: web.Request):
+        data = await request.json()
+        model = request.match_info["model"]
+        prompt = " ".join(p.get("text", "") for c in data.get("contents", []) for p in c.get("parts", []))
+        max_tokens = (data.get("generationConfig") or {}).get("maxOutputTokens") or 512
+        return model, prompt, max_tokens
+
+    def _inject_failure(self, prof: Profile):
+        roll = self.rng.random()
+        if roll < prof.rate_limit_rate:
+            self.stats.rate_limited += 1
+            return web.json_response(
+                {"error": {"code": 429, "message": "Resource has been exhausted", "status": "RESOURCE_EXHAUSTED"}},
+                status=429, headers={"Retry-After": "1"},
+            )
+        if roll < prof.rate_limit_rate + prof.error_rate:
+            self.stats.errors += 1
+            return web.json_response({"error": {"code": 500, "message": "Internal error", "status": "INTERNAL"}}, status=500)
+        return None
+
+    def _account(self, model: str, prompt: str, text: str) -> dict:
+        p, o = self._count(prompt), self._count(text)
+        self.stats.prompt_tokens += p
+        self.stats.output_tokens += o
+        self.stats.per_model[model] = self.stats.per_model.get(model, 0) + p + o
+        return {"promptTokenCount": p, "candidatesTokenCount": o, "totalTokenCount": p + o}
+
+    @staticmethod
+    def _candidate(text: str) -> dict:
+        return {"content": {"role": "model", "parts": [{"text": text}]}}
+
+    async def generate(self, request: web.Request) -> web.StreamResponse:
+        action = request.match_info["action"]
+        model, prompt, max_tokens = await self._parse(request)
+        prof = self.profile(model)
+        self.stats.requests += 1
+        failure = self._inject_failure(prof)
+        if failure is not None:
+            await asyncio.sleep(prof.sample_latency(self.rng) / 4)
+            return failure
+        words = min(prof.response_words, max(1, int(max_tokens * 0.75)))
+        text = self._answer(model, prompt, words)
+        # time to first token
+        await asyncio.sleep(prof.sample_latency(self.rng))
+        if action == "generateContent":
+            usage = self._account(model, prompt, text)
+            return web.json_response({"candidates": [self._candidate(text)], "usageMetadata": usage})
+
+        self.stats.streams += 1
+        resp = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await resp.prepare(request)
+        tokens = text.split(" ")
+        step = max(1, prof.chunk_words)
+        for i in range(0, len(tokens), step):
+            if i:
+                await asyncio.sleep(prof.chunk_delay)
+            chunk = " ".join(tokens[i:i + step]) + (" " if i + step < len(tokens) else "")
+            frame = {"candidates": [self._candidate(chunk)]}
+            if i + step >= len(tokens):
+                frame["usageMetadata"] = self._account(model, prompt, text)
+            await resp.write(f"data: {json.dumps(frame)}\r\n\r\n".encode("utf-8"))
+        await resp.write_eof()
+        return resp
+
+    async def get_stats(self, request: web.Request) -> web.Response:
+        return web.json_response(asdict(self.stats))
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post(r"/v1beta/models/{model}:{action:(generateContent|streamGenerateContent)}", self.generate)
+        app.router.add_get("/stats", self.get_stats)
+        return app
+
+
+def load_profiles(path: str | None) -> Dict[str, Profile]:
+    profiles = {"default": Profile()}
+    if not path:
+        return profiles
+    with open(path, "r", encoding="utf-8") as f:
+        raw = json.load(f)
+    base = asdict(profiles["default"])
+    for name, cfg in raw.items():
+        merged = dict(base, **(raw.get("default") or {}))
+        merged.update(cfg)
+        profiles[name] = Profile(**merged)
+    return profiles
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local Gemini stand-in server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--profile", default=os.getenv("STANDIN_PROFILE"))
+    parser.add_argument("--seed", type=int, default=int(os.getenv("STANDIN_SEED", "0")))
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    server = StandInServer(load_profiles(args.profile), seed=args.seed)
+    web.run_app(server.app(), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
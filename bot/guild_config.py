@@ -0,0 +1,124 @@
+"""Cached per-guild config snapshot (mode, pause state, quota, music channel) for the reply path."""
+import os
+import time
+import asyncio
+import logging
+from dataclasses import dataclass
+from typing import Dict, Optional
+
+from sqlalchemy import select, or_
+
+from shared.models import Mode, SystemState, Quota, MusicChannel
+from bot.events import broadcaster
+
+logger = logging.getLogger(__name__)
+
+GUILD_CONFIG_TTL = float(os.getenv("GUILD_CONFIG_TTL", "60"))
+DEFAULT_QUOTA_NAME = "free_tokens"
+
+
+@dataclass(frozen=True)
+class GuildConfigSnapshot:
+    guild_id: int
+    mode: str = "standard"
+    paused: bool = False
+    quota_limit: Optional[float] = None
+    music_channel_id: Optional[int] = None
+    loaded_at: float = 0.0
+
+
+def _snapshot_query(guild_id: int):
+    """One SELECT with a scalar subquery per setting, so a snapshot costs a single round-trip."""
+    mode = select(Mode.mode).where(Mode.guild_id == guild_id).limit(1).scalar_subquery()
+    paused = select(SystemState.value).where(SystemState.key == "ai_paused").limit(1).scalar_subquery()
+    # a guild-specific quota ("guild:<id>") overrides the global one
+    quota = (
+        select(Quota.limit)
+        .where(or_(Quota.name == f"guild:{guild_id}", Quota.name == DEFAULT_QUOTA_NAME))
+        .order_by((Quota.name == DEFAULT_QUOTA_NAME).asc())
+        .limit(1)
+        .scalar_subquery()
+    )
+    music = select(MusicChannel.channel_id).where(MusicChannel.guild_id == guild_id).limit(1).scalar_subquery()
+    return select(mode.label("mode"), paused.label("paused"), quota.label("quota_limit"), music.label("music_channel_id"))
+
+
+class GuildConfigCache:
+    """TTL cache of GuildConfigSnapshot with event-driven invalidation (`config:updated`)."""
+
+    def __init__(self, ttl: float = GUILD_CONFIG_TTL):
+        self.ttl = ttl
+        self._session_factory = None
+        self._snapshots: Dict[int, GuildConfigSnapshot] = {}
+        self._loading: Dict[int, asyncio.Task] = {}
+        self.hits = 0
+        self.loads = 0
+
+    def configure(self, session_factory) -> None:
+        if self._session_factory is None:
+            broadcaster.register_handler(self._on_broadcast)
+        self._session_factory = session_factory
+
+    async def get(self, guild_id: int) -> GuildConfigSnapshot:
+        snap = self._snapshots.get(guild_id)
+        if snap is not None and time.monotonic() - snap.loaded_at < self.ttl:
+            self.hits += 1
+            return snap
+        task = self._loading.get(guild_id)
+        if task is None:
+            # the load runs in its own task: cancelling the caller that started it must not
+            # cancel the lookup for every other caller waiting on the same guild
+            task = asyncio.ensure_future(self._fetch(guild_id))
+            self._loading[guild_id] = task
+            task.add_done_callback(lambda t: self._finished(guild_id, t))
+        return await asyncio.shield(task)
+
+    async def _fetch(self, guild_id: int) -> GuildConfigSnapshot:
+        try:
+            return await self._load(guild_id)
+        except Exception as e:
+            logger.exception("Guild config load failed: %s", e)
+            # serve the stale snapshot (or defaults) rather than failing the reply
+            return self._snapshots.get(guild_id) or GuildConfigSnapshot(guild_id=guild_id, loaded_at=time.monotonic())
+
+    def _finished(self, guild_id: int, task: asyncio.Task) -> None:
+        if self._loading.get(guild_id) is task:
+            del self._loading[guild_id]
+
+    async def _load(self, guild_id: int) -> GuildConfigSnapshot:
+        self.loads += 1
+        async with self._session_factory() as session:
+            row = (await session.execute(_snapshot_query(guild_id))).one()
+        snap = GuildConfigSnapshot(
+            guild_id=guild_id,
+            mode=row.mode or "standard",
+            paused=row.paused == "1",
+            quota_limit=row.quota_limit,
+            music_channel_id=row.music_channel_id,
+            loaded_at=time.monotonic(),
+        )
+        self._snapshots[guild_id] = snap
+        return snap
+
+    def invalidate(self, guild_id: Optional[int] = None) -> None:
+        """Drop one guild's snapshot, or every snapshot when guild_id is None (global settings changed)."""
+        if guild_id is None:
+            self._snapshots.clear()
+        else:
+            self._snapshots.pop(guild_id, None)
+
+    async def _on_broadcast(self, data):
+        try:
+            if not isinstance(data, dict):
+                return
+            if data.get("type") in ("config:updated", "music:channel_created", "music:channel_deleted"):
+                self.invalidate((data.get("payload") or {}).get("guild_id"))
+        except Exception:
+            logger.exception("Guild config invalidation failed")
+
+    def stats(self) -> dict:
+        return {"guilds": len(self._snapshots), "hits": self.hits, "loads": self.loads}
+
+
+# singleton
+guild_configs = GuildConfigCache()
@@ -0,0 +1,147 @@
+"""Local intent engine: canned replies and trigger phrases matched in one regex pass per message.
+
+Intents are compiled once into a single alternation of named groups (one group per intent) and
+rebuilt only when a guild's configuration changes. Guilds can override or extend the defaults
+through `GuildConfig.intents` (JSON list of intent specs):
+
+    [{"name": "greeting", "patterns": ["^(hi|hello)\\b"], "response": "こんにちは、{user} さん！"},
+     {"name": "music", "keywords": ["音楽流して"], "action": "music"}]
+
+`patterns` are regular expressions, `keywords` are literal substrings; matching ignores case.
+"""
+import re
+import json
+import logging
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+from shared.models import GuildConfig
+from bot.events import broadcaster
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_INTENTS = [
+    {"name": "greeting", "patterns": [r"^(hi|hello|こんにちは|おはよう|こんばんは)\b"], "response": "こんにちは、{user} さん！"},
+    {"name": "farewell", "patterns": [r"\b(bye|さようなら|おやすみ)\b"], "response": "またね！"},
+    {"name": "music", "keywords": ["音楽流して", "リラックスできる曲", "曲を流して", "プレイリスト", "音楽かけて"], "action": "music"},
+]
+
+_GLOBAL_FLAGS = re.compile(r"^\(\?[aiLmsux]+\)")
+
+
+@dataclass(frozen=True)
+class Intent:
+    name: str
+    response: Optional[str] = None
+    action: Optional[str] = None
+
+    def render(self, user: str) -> str:
+        return (self.response or "").replace("{user}", user)
+
+
+class CompiledIntents:
+    """One combined regex; the named group that matched identifies the intent."""
+
+    def __init__(self, specs: List[dict]):
+        self.intents: List[Intent] = []
+        alternatives = []
+        for spec in specs:
+            parts = [p for p in spec.get("patterns") or [] if self._valid(p)]
+            parts += [re.escape(k) for k in spec.get("keywords") or [] if k]
+            if not parts:
+                continue
+            idx = len(self.intents)
+            self.intents.append(Intent(name=spec.get("name") or f"intent{idx}", response=spec.get("response"), action=spec.get("action")))
+            alternatives.append(f"(?P<i{idx}>{'|'.join(f'(?:{p})' for p in parts)})")
+        self.regex = re.compile("|".join(alternatives), re.IGNORECASE) if alternatives else None
+
+    @staticmethod
+    def _valid(pattern: str) -> bool:
+        try:
+            compiled = re.compile(pattern)
+        except re.error:
+            logger.warning("Ignoring invalid intent pattern %r", pattern)
+            return False
+        if compiled.groupindex or _GLOBAL_FLAGS.match(pattern):
+            # named groups / global inline flags would break the combined alternation
+            logger.warning("Ignoring intent pattern with named groups or inline flags %r", pattern)
+            return False
+        return True
+
+    def match(self, text: str) -> Optional[Intent]:
+        if self.regex is None or not text:
+            return None
+        m = self.regex.search(text)
+        if m is None or m.lastgroup is None:
+            return None
+        return self.intents[int(m.lastgroup[1:])]
+
+
+def merge_specs(overrides: List[dict]) -> List[dict]:
+    """Guild specs replace defaults with the same name; new names are appended."""
+    by_name = {spec["name"]: spec for spec in DEFAULT_INTENTS}
+    order = [spec["name"] for spec in DEFAULT_INTENTS]
+    for spec in overrides:
+        if not isinstance(spec, dict) or not spec.get("name"):
+            continue
+        if spec["name"] not in by_name:
+            order.append(spec["name"])
+        by_name[spec["name"]] = spec
+    return [by_name[n] for n in order if not by_name[n].get("disabled")]
+
+
+class IntentEngine:
+    def __init__(self):
+        self._default = CompiledIntents(DEFAULT_INTENTS)
+        self._guilds: Dict[int, CompiledIntents] = {}
+        self._session_factory = None
+        self.rebuilds = 0
+
+    async def load(self, session_factory) -> None:
+        """Compile every guild that has custom intents (one query), then follow `intents:updated`."""
+        if self._session_factory is None:
+            broadcaster.register_handler(self._on_broadcast)
+        self._session_factory = session_factory
+        async with session_factory() as session:
+            q = await session.execute(GuildConfig.__table__.select().where(GuildConfig.intents.isnot(None)))
+            rows = q.fetchall()
+        for row in rows:
+            self.set_guild(row.guild_id, row.intents)
+        logger.info("Intent engine loaded (%d guild overrides)", len(self._guilds))
+
+    def set_guild(self, guild_id: int, raw: Optional[str]) -> None:
+        try:
+            overrides = json.loads(raw) if raw else []
+        except Exception:
+            logger.warning("Invalid intents JSON for guild %s", guild_id)
+            overrides = []
+        if not overrides:
+            self._guilds.pop(guild_id, None)
+            return
+        self._guilds[guild_id] = CompiledIntents(merge_specs(overrides))
+        self.rebuilds += 1
+
+    async def reload_guild(self, guild_id: int) -> None:
+        if self._session_factory is None:
+            return
+        async with self._session_factory() as session:
+            q = await session.execute(GuildConfig.__table__.select().where(GuildConfig.guild_id == guild_id))
+            row = q.first()
+        self.set_guild(guild_id, row.intents if row else None)
+
+    def match(self, text: str, guild_id: Optional[int] = None) -> Optional[Intent]:
+        compiled = self._guilds.get(guild_id, self._default) if guild_id is not None else self._default
+        return compiled.match(text)
+
+    async def _on_broadcast(self, data):
+        try:
+            if isinstance(data, dict) and data.get("type") == "intents:updated":
+                guild_id = (data.get("payload") or {}).get("guild_id")
+                if guild_id is not None:
+                    await self.reload_guild(guild_id)
+        except Exception:
+            logger.exception("Intent reload failed")
+
+
+# singleton
+intent_engine = IntentEngine()
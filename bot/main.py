@@ -9,6 +9,18 @@ from discord.ext import commands
 
 load_dotenv()
 
+from bot import gemini_client
+from bot.gemini_client import client as gemini
+from bot.cache import response_cache
+from bot.outbound import outbound
+from bot.persistence import write_behind
+from bot.memory import conversation_store
+from bot.dispatcher import dispatcher
+from bot.events import broadcaster
+from bot.eventbus import event_bus
+from bot.metrics import metrics
+from bot.telemetry import metrics_reporter
+
 DISCORD_TOKEN = os.getenv("DISCORD_TOKEN")
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite+aiosqlite:///./bot.db")
 
@@ -18,24 +30,56 @@ logger = logging.getLogger("bot")
 intents = commands.Intents.default()
 intents.message_content = True
 
-bot = commands.Bot(command_prefix="/", intents=intents)
 
+def create_bot(shard_ids=None, shard_count=None) -> commands.Bot:
+    """Single-gateway bot, or an AutoShardedBot for the given shards (used by bot.cluster workers)."""
+    if shard_ids is not None:
+        bot = commands.AutoShardedBot(command_prefix="/", intents=intents, shard_ids=shard_ids, shard_count=shard_count)
+    else:
+        bot = commands.Bot(command_prefix="/", intents=intents)
+    # one on_message listener; cogs register route handlers with the dispatcher
+    dispatcher.attach(bot)
 
-@bot.event
-async def on_ready():
-    logger.info(f"Logged in as {bot.user} (id: {bot.user.id})")
-    logger.info("------")
+    @bot.event
+    async def on_ready():
+        logger.info(f"Logged in as {bot.user} (id: {bot.user.id})")
+        logger.info("------")
 
+    return bot
 
-async def main():
+
+async def run_bot(bot: commands.Bot, process: str = "bot"):
     # Dynamically load cogs
     try:
         await bot.load_extension("bot.cogs.ai_commands")
     except Exception as e:
         logger.exception("Failed to load cog: %s", e)
 
+    # share events with the API process (SSE / Socket.IO clients, dashboard controls)
+    await event_bus.start(broadcaster)
+    # the API serves /api/metrics, /api/cache and /api/gemini from these snapshots
+    metrics.source("cache", response_cache.stats)
+    metrics.source("gemini", gemini_client.stats)
+    metrics.source("outbound", outbound.stats)
+    metrics.source("dispatcher", dispatcher.stats)
+    metrics_reporter.start(process)
+
     # Start the bot
-    await bot.start(DISCORD_TOKEN)
+    try:
+        await bot.start(DISCORD_TOKEN)
+    finally:
+        # drain buffered log rows before exiting
+        await write_behind.close()
+        await conversation_store.close()
+        await gemini.close()
+        # publish held (coalesced) events before the bus goes away
+        broadcaster.flush()
+        await metrics_reporter.close()
+        await event_bus.close()
+
+
+async def main():
+    await run_bot(create_bot())
 
 
 if __name__ == "__main__":
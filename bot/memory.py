@@ -0,0 +1,226 @@
+"""Bounded conversation memory: LRU of per-user histories that spills idle users to the
+`conversations` table and rehydrates them lazily on their next message."""
+import os
+import json
+import asyncio
+import logging
+from collections import OrderedDict, deque
+from datetime import datetime
+from typing import Deque, Dict, List, Optional, Tuple
+
+from shared.models import ConversationHistory
+
+logger = logging.getLogger(__name__)
+
+HISTORY_LEN = 8
+MEMORY_MAX_USERS = int(os.getenv("MEMORY_MAX_USERS", "5000"))
+MEMORY_MAX_BYTES = int(os.getenv("MEMORY_MAX_BYTES", str(32 * 1024 * 1024)))
+
+
+def _size(hist: Deque[str]) -> int:
+    return sum(len(e.encode("utf-8")) for e in hist)
+
+
+def _dump(hist: Deque[str]) -> str:
+    return json.dumps(list(hist), ensure_ascii=False, separators=(",", ":"))
+
+
+def _load(raw: Optional[str]) -> List[str]:
+    if not raw:
+        return []
+    try:
+        data = json.loads(raw)
+        return [str(e) for e in data] if isinstance(data, list) else []
+    except Exception:
+        return []
+
+
+class ConversationStore:
+    """user_id -> history deque, capped by user count and total text size.
+
+    get() pins the history it hands out and the caller release()s it after the turn; pinned
+    histories (also those waiting for the summarizer) are never evicted, so nothing is appended
+    to a deque that was already spilled. Byte usage is re-measured on get() and release().
+    """
+
+    def __init__(self, max_users: int = MEMORY_MAX_USERS, max_bytes: int = MEMORY_MAX_BYTES, history_len: int = HISTORY_LEN):
+        self.max_users = max_users
+        self.max_bytes = max_bytes
+        self.history_len = history_len
+        self._session_factory = None
+        self._entries: "OrderedDict[int, Deque[str]]" = OrderedDict()
+        self._sizes: Dict[int, int] = {}
+        self._guilds: Dict[int, Optional[int]] = {}
+        self._bytes = 0
+        self._loading: Dict[int, asyncio.Task] = {}
+        self._pins: Dict[int, int] = {}
+        # evicted but not yet written: user_id -> (guild_id, serialized history)
+        self._spill: Dict[int, Tuple[Optional[int], str]] = {}
+        self._flush_task: asyncio.Task | None = None
+        self.evictions = 0
+        self.rehydrations = 0
+
+    def configure(self, session_factory) -> None:
+        self._session_factory = session_factory
+
+    def pin(self, user_id: int) -> None:
+        """Keep `user_id`'s history in memory until the matching release()."""
+        self._pins[user_id] = self._pins.get(user_id, 0) + 1
+
+    def release(self, user_id: int) -> None:
+        n = self._pins.get(user_id, 0) - 1
+        if n > 0:
+            self._pins[user_id] = n
+            return
+        self._pins.pop(user_id, None)
+        if user_id in self._entries:
+            self._measure(user_id)
+            self._evict()
+
+    async def get(self, user_id: int, guild_id: Optional[int] = None) -> Deque[str]:
+        """History of `user_id`, pinned until release(user_id)."""
+        self.pin(user_id)
+        try:
+            return await self._get(user_id, guild_id)
+        except BaseException:
+            self.release(user_id)
+            raise
+
+    async def _get(self, user_id: int, guild_id: Optional[int]) -> Deque[str]:
+        hist = self._entries.get(user_id)
+        if hist is not None:
+            self._entries.move_to_end(user_id)
+            self._measure(user_id)
+            return hist
+        task = self._loading.get(user_id)
+        if task is None:
+            # loaded in its own task: a cancelled caller must not fail the others waiting for
+            # the same user, nor drop a history already taken out of the spill
+            task = asyncio.ensure_future(self._load_history(user_id, guild_id))
+            self._loading[user_id] = task
+            task.add_done_callback(lambda t: self._loaded(user_id, t))
+        return await asyncio.shield(task)
+
+    async def _load_history(self, user_id: int, guild_id: Optional[int]) -> Deque[str]:
+        items = await self._rehydrate(user_id)
+        hist = deque(items, maxlen=self.history_len)
+        self._entries[user_id] = hist
+        self._guilds[user_id] = guild_id
+        self._sizes[user_id] = 0
+        self._measure(user_id)
+        self._evict()
+        return hist
+
+    def _loaded(self, user_id: int, task: asyncio.Task) -> None:
+        if self._loading.get(user_id) is task:
+            del self._loading[user_id]
+        if not task.cancelled():
+            task.exception()
+
+    async def _rehydrate(self, user_id: int) -> List[str]:
+        spilled = self._spill.pop(user_id, None)
+        if spilled is not None:
+            return _load(spilled[1])
+        if self._session_factory is None:
+            return []
+        try:
+            async with self._session_factory() as session:
+                q = await session.execute(
+                    ConversationHistory.__table__.select()
+                    .where(ConversationHistory.user_id == user_id)
+                    .order_by(ConversationHistory.updated_at.desc())
+                    .limit(1)
+                )
+                row = q.first()
+        except Exception:
+            logger.exception("Conversation rehydrate failed for %s", user_id)
+            return []
+        if row is None:
+            return []
+        self.rehydrations += 1
+        return _load(row.context)
+
+    def _measure(self, user_id: int) -> None:
+        new = _size(self._entries[user_id])
+        self._bytes += new - self._sizes.get(user_id, 0)
+        self._sizes[user_id] = new
+
+    def _over(self) -> bool:
+        return len(self._entries) > self.max_users or self._bytes > self.max_bytes
+
+    def _evict(self) -> None:
+        if not self._over():
+            return
+        # oldest first; pinned histories (a running turn or a pending summary) stay
+        for uid in list(self._entries):
+            if len(self._entries) <= 1 or not self._over():
+                break
+            if uid in self._pins:
+                continue
+            hist = self._entries.pop(uid)
+            self._bytes -= self._sizes.pop(uid, 0)
+            guild_id = self._guilds.pop(uid, None)
+            if hist:
+                self._spill[uid] = (guild_id, _dump(hist))
+            self.evictions += 1
+        if self._spill and (self._flush_task is None or self._flush_task.done()):
+            self._flush_task = asyncio.create_task(self._flush_spill())
+
+    async def _flush_spill(self) -> None:
+        # let a burst of evictions accumulate into one transaction
+        await asyncio.sleep(0)
+        while self._spill:
+            batch, self._spill = self._spill, {}
+            try:
+                await self._write(batch)
+            except Exception:
+                logger.exception("Conversation spill failed (%d users)", len(batch))
+                # keep them for the next attempt unless they were rehydrated meanwhile
+                for uid, v in batch.items():
+                    if uid not in self._entries:
+                        self._spill.setdefault(uid, v)
+                await asyncio.sleep(1.0)
+
+    async def _write(self, batch: Dict[int, Tuple[Optional[int], str]]) -> None:
+        if self._session_factory is None or not batch:
+            return
+        table = ConversationHistory.__table__
+        now = datetime.utcnow()
+        async with self._session_factory() as session:
+            q = await session.execute(table.select().where(ConversationHistory.user_id.in_(list(batch))))
+            existing = {row.user_id for row in q.fetchall()}
+            for uid in existing:
+                guild_id, context = batch[uid]
+                await session.execute(table.update().where(ConversationHistory.user_id == uid).values(context=context, updated_at=now))
+            new_rows = [{"user_id": uid, "guild_id": g, "context": c, "updated_at": now} for uid, (g, c) in batch.items() if uid not in existing]
+            if new_rows:
+                await session.execute(table.insert(), new_rows)
+            await session.commit()
+
+    async def close(self) -> None:
+        """Persist every in-memory history so users keep their context across restarts."""
+        for uid, hist in self._entries.items():
+            if hist:
+                self._spill[uid] = (self._guilds.get(uid), _dump(hist))
+        if self._flush_task is not None and not self._flush_task.done():
+            await self._flush_task
+        if self._spill:
+            batch, self._spill = self._spill, {}
+            try:
+                await self._write(batch)
+            except Exception:
+                logger.exception("Conversation store close failed")
+
+    def stats(self) -> dict:
+        return {
+            "users": len(self._entries),
+            "pinned": len(self._pins),
+            "bytes": self._bytes,
+            "spill_pending": len(self._spill),
+            "evictions": self.evictions,
+            "rehydrations": self.rehydrations,
+        }
+
+
+# singleton
+conversation_store = ConversationStore()
@@ -0,0 +1,150 @@
+"""Per-stage latency histograms (fixed buckets) rendered in the Prometheus text format.
+
+snapshot() captures a registry as plain JSON, so the API can render the bot processes'
+metrics next to its own (see bot.telemetry).
+"""
+import time
+import functools
+import logging
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# bucket upper bounds in seconds
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+METRIC_NAME = "bot_stage_duration_seconds"
+
+
+class Histogram:
+    def __init__(self, buckets: Iterable[float] = DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)  # last slot is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, seconds: float) -> None:
+        self.counts[bisect_left(self.buckets, seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+
+    def quantile(self, q: float) -> Optional[float]:
+        """Upper bound of the bucket holding the q-th observation (None without data)."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(self.buckets, self.counts):
+            seen += n
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+
+class Metrics:
+    """Named stage histograms; stages are created on first use."""
+
+    def __init__(self, buckets: Iterable[float] = DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._histograms: Dict[str, Histogram] = {}
+        self._gauges: Dict[str, Callable[[], float]] = {}
+        self._sources: Dict[str, Callable[[], dict]] = {}
+
+    def observe(self, stage: str, seconds: float) -> None:
+        hist = self._histograms.get(stage)
+        if hist is None:
+            hist = self._histograms[stage] = Histogram(self.buckets)
+        hist.observe(seconds)
+
+    def gauge(self, name: str, fn: Callable[[], float]) -> None:
+        """Register a gauge read at render time (e.g. a queue depth)."""
+        self._gauges[name] = fn
+
+    def source(self, name: str, fn: Callable[[], dict]) -> None:
+        """Register a JSON stats section (e.g. cache counters) carried in snapshot()."""
+        self._sources[name] = fn
+
+    @contextmanager
+    def span(self, stage: str):
+        """Time the enclosed block (recorded even if it raises)."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def timed(self, stage: str):
+        """Decorator form of span() for coroutine functions."""
+        def wrap(fn):
+            @functools.wraps(fn)
+            async def inner(*args, **kwargs):
+                with self.span(stage):
+                    return await fn(*args, **kwargs)
+            return inner
+        return wrap
+
+    def snapshot(self) -> dict:
+        gauges = {}
+        for name, fn in self._gauges.items():
+            try:
+                gauges[name] = float(fn())
+            except Exception:
+                logger.exception("Gauge %s failed", name)
+        sources = {}
+        for name, fn in self._sources.items():
+            try:
+                sources[name] = fn()
+            except Exception:
+                logger.exception("Stats source %s failed", name)
+        return {
+            "histograms": {
+                stage: {"buckets": list(h.buckets), "counts": list(h.counts), "sum": h.sum, "count": h.count}
+                for stage, h in self._histograms.items()
+            },
+            "gauges": gauges,
+            "stats": sources,
+        }
+
+    def render(self, snapshots: Optional[Dict[str, dict]] = None) -> str:
+        """This registry, or `snapshots` (process name -> snapshot()) with a `process` label."""
+        if snapshots is None:
+            snapshots = {"": self.snapshot()}
+
+        def labels(process: str, **extra) -> str:
+            pairs = ([("process", process)] if process else []) + list(extra.items())
+            return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}" if pairs else ""
+
+        lines = [
+            f"# HELP {METRIC_NAME} Time spent in each processing stage.",
+            f"# TYPE {METRIC_NAME} histogram",
+        ]
+        for process in sorted(snapshots):
+            histograms = snapshots[process].get("histograms") or {}
+            for stage in sorted(histograms):
+                hist = histograms[stage]
+                cumulative = 0
+                for bound, n in zip(hist["buckets"], hist["counts"]):
+                    cumulative += n
+                    lines.append(f'{METRIC_NAME}_bucket{labels(process, stage=stage, le=f"{bound:g}")} {cumulative}')
+                lines.append(f'{METRIC_NAME}_bucket{labels(process, stage=stage, le="+Inf")} {hist["count"]}')
+                lines.append(f'{METRIC_NAME}_sum{labels(process, stage=stage)} {hist["sum"]:.6f}')
+                lines.append(f'{METRIC_NAME}_count{labels(process, stage=stage)} {hist["count"]}')
+        gauges: Dict[str, List[str]] = {}
+        for process in sorted(snapshots):
+            for name, value in (snapshots[process].get("gauges") or {}).items():
+                gauges.setdefault(name, []).append(f"bot_{name}{labels(process)} {value:g}")
+        for name in sorted(gauges):
+            lines.append(f"# TYPE bot_{name} gauge")
+            lines.extend(gauges[name])
+        return "\n".join(lines) + "\n"
+
+    def stats(self) -> dict:
+        return {
+            stage: {"count": h.count, "sum": h.sum, "p50": h.quantile(0.5), "p99": h.quantile(0.99)}
+            for stage, h in self._histograms.items()
+        }
+
+
+# singleton
+metrics = Metrics()
@@ -0,0 +1,235 @@
+"""Outbound Discord delivery: per-channel send queues that respect rate limits.
+
+Every channel gets a FIFO drained by its own task. A send waits for a token from the channel's
+bucket (Discord allows about 5 messages per 5s per channel) and from the global bucket. A 429
+pauses the channel for `retry_after` and the request is retried. Texts longer than the 2000
+character limit are split at paragraph, line or word boundaries without breaking code blocks.
+An edit to a message that already has an edit queued replaces that edit, so only the newest
+content is sent.
+"""
+import os
+import re
+import asyncio
+import logging
+from collections import deque
+from typing import Deque, Dict, List, Optional
+
+import discord
+
+from bot.scheduler import TokenBucket
+from bot.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+DISCORD_MESSAGE_LIMIT = 2000
+# per-channel bucket: OUTBOUND_CHANNEL_BURST messages every OUTBOUND_CHANNEL_PERIOD seconds
+OUTBOUND_CHANNEL_BURST = int(os.getenv("OUTBOUND_CHANNEL_BURST", "5"))
+OUTBOUND_CHANNEL_PERIOD = float(os.getenv("OUTBOUND_CHANNEL_PERIOD", "5"))
+OUTBOUND_GLOBAL_PER_SECOND = int(os.getenv("OUTBOUND_GLOBAL_PER_SECOND", "50"))
+OUTBOUND_RETRIES = 3
+
+_FENCE = re.compile(r"^```(\S*)", re.M)
+_CLOSE = "\n```"
+
+
+def _open_fence(text: str) -> Optional[str]:
+    """Language tag of a code block left open at the end of `text` ("" if untagged), else None."""
+    inside, lang = False, None
+    for m in _FENCE.finditer(text):
+        inside = not inside
+        lang = m.group(1) if inside else None
+    return lang if inside else None
+
+
+def _boundary(window: str) -> int:
+    for sep in ("\n\n", "\n", " "):
+        i = window.rfind(sep)
+        if i > len(window) // 2:
+            return i
+    return len(window)
+
+
+def split_message(text: str, limit: int = DISCORD_MESSAGE_LIMIT) -> List[str]:
+    """Split `text` into chunks of at most `limit` characters.
+
+    Cuts prefer blank lines, then newlines, then spaces. A code block cut in the middle is
+    closed at the end of one chunk and reopened (same language) at the start of the next.
+    """
+    chunks: List[str] = []
+    reopen = ""
+    rest = text
+    while rest:
+        room = limit - len(reopen)
+        if len(rest) <= room:
+            chunks.append(reopen + rest)
+            break
+        cut = _boundary(rest[:room - len(_CLOSE)])
+        chunk = reopen + rest[:cut]
+        rest = rest[cut:]
+        lang = _open_fence(chunk)
+        if lang is None:
+            reopen = ""
+            chunk = chunk.rstrip()
+            rest = rest.lstrip()
+        else:
+            reopen = f"```{lang}\n"
+            chunk = chunk.rstrip("\n") + _CLOSE
+            rest = rest[1:] if rest.startswith("\n") else rest
+        if chunk.strip():
+            chunks.append(chunk)
+    return chunks
+
+
+class _Op:
+    __slots__ = ("kind", "target", "parts", "kwargs", "future", "enqueued")
+
+    def __init__(self, kind: str, target, parts: List[Optional[str]], kwargs: dict, loop: asyncio.AbstractEventLoop):
+        self.kind = kind  # "send" | "edit"
+        self.target = target  # channel for sends, message for edits
+        self.parts = parts
+        self.kwargs = kwargs
+        self.future = loop.create_future()
+        self.enqueued = loop.time()
+
+
+class _ChannelQueue:
+    def __init__(self):
+        self.ops: Deque[_Op] = deque()
+        self.edits: Dict[int, _Op] = {}
+        self.bucket = TokenBucket(OUTBOUND_CHANNEL_BURST * 60.0 / OUTBOUND_CHANNEL_PERIOD, capacity=OUTBOUND_CHANNEL_BURST)
+        self.task: asyncio.Task | None = None
+
+
+class OutboundQueue:
+    def __init__(self):
+        self._channels: Dict[int, _ChannelQueue] = {}
+        self._global = TokenBucket(OUTBOUND_GLOBAL_PER_SECOND * 60.0, capacity=OUTBOUND_GLOBAL_PER_SECOND)
+        self.sent = 0
+        self.edits = 0
+        self.merged = 0
+        self.rate_limited = 0
+        self.failed = 0
+        metrics.gauge("outbound_queue_depth", lambda: self.depth)
+        metrics.gauge("outbound_channels", lambda: len(self._channels))
+
+    @property
+    def depth(self) -> int:
+        return sum(len(cq.ops) for cq in self._channels.values())
+
+    def _queue(self, channel_id: int) -> _ChannelQueue:
+        cq = self._channels.get(channel_id)
+        if cq is None:
+            cq = self._channels[channel_id] = _ChannelQueue()
+        return cq
+
+    def _start(self, channel_id: int, cq: _ChannelQueue) -> None:
+        if cq.task is None or cq.task.done():
+            cq.task = asyncio.create_task(self._drain(channel_id, cq))
+
+    def send(self, channel, content: Optional[str] = None, **kwargs) -> "asyncio.Future[List[discord.Message]]":
+        """Queue a message (split if longer than the limit). Resolves to the list of sent messages."""
+        loop = asyncio.get_running_loop()
+        parts = split_message(content) if content else []
+        if not parts:
+            parts = [None]  # embed/file only
+        op = _Op("send", channel, parts, kwargs, loop)
+        cq = self._queue(channel.id)
+        cq.ops.append(op)
+        self._start(channel.id, cq)
+        return op.future
+
+    def edit(self, message: discord.Message, content: str, **kwargs) -> "asyncio.Future[discord.Message]":
+        """Queue an edit; a still-pending edit of the same message is replaced by this one."""
+        content = content[:DISCORD_MESSAGE_LIMIT]
+        cq = self._queue(message.channel.id)
+        pending = cq.edits.get(message.id)
+        if pending is not None:
+            pending.parts = [content]
+            pending.kwargs = kwargs
+            self.merged += 1
+            return pending.future
+        op = _Op("edit", message, [content], kwargs, asyncio.get_running_loop())
+        cq.ops.append(op)
+        cq.edits[message.id] = op
+        self._start(message.channel.id, cq)
+        return op.future
+
+    async def _acquire(self, cq: _ChannelQueue) -> None:
+        while True:
+            wait = max(cq.bucket.delay(1), self._global.delay(1))
+            if wait <= 0:
+                cq.bucket.take(1)
+                self._global.take(1)
+                return
+            await asyncio.sleep(wait)
+
+    async def _call(self, cq: _ChannelQueue, fn, *args, **kwargs):
+        for attempt in range(OUTBOUND_RETRIES + 1):
+            await self._acquire(cq)
+            try:
+                return await fn(*args, **kwargs)
+            except discord.HTTPException as e:
+                if e.status != 429 or attempt == OUTBOUND_RETRIES:
+                    raise
+                self.rate_limited += 1
+                retry_after = getattr(e, "retry_after", None)
+                if retry_after is None:
+                    try:
+                        retry_after = float(e.response.headers.get("Retry-After", 1.0))
+                    except Exception:
+                        retry_after = 1.0
+                # drain the channel bucket so queued ops also wait out the limit
+                cq.bucket.tokens = min(cq.bucket.tokens, 0.0)
+                await asyncio.sleep(retry_after)
+
+    async def _perform(self, cq: _ChannelQueue, op: _Op):
+        if op.kind == "edit":
+            result = await self._call(cq, op.target.edit, content=op.parts[0], **op.kwargs)
+            self.edits += 1
+            return result if result is not None else op.target
+        sent = []
+        for i, part in enumerate(op.parts):
+            # embeds / files / references go with the first chunk only
+            kwargs = op.kwargs if i == 0 else {}
+            sent.append(await self._call(cq, op.target.send, part, **kwargs))
+            self.sent += 1
+        return sent
+
+    async def _drain(self, channel_id: int, cq: _ChannelQueue) -> None:
+        loop = asyncio.get_running_loop()
+        while cq.ops:
+            op = cq.ops.popleft()
+            if op.kind == "edit":
+                cq.edits.pop(op.target.id, None)
+            metrics.observe("outbound.wait", loop.time() - op.enqueued)
+            try:
+                with metrics.span(f"outbound.{op.kind}"):
+                    result = await self._perform(cq, op)
+            except Exception as e:
+                self.failed += 1
+                if not op.future.done():
+                    op.future.set_exception(e)
+                    op.future.exception()  # callers may not await fire-and-forget edits
+                continue
+            if not op.future.done():
+                op.future.set_result(result)
+        # forget idle channels once their bucket is full again (a fresh queue would start full)
+        if self._channels.get(channel_id) is cq and cq.bucket.delay(cq.bucket.capacity) == 0:
+            del self._channels[channel_id]
+
+    def stats(self) -> dict:
+        depths = [len(cq.ops) for cq in self._channels.values()]
+        return {
+            "channels": len(depths),
+            "depth": sum(depths),
+            "max_depth": max(depths, default=0),
+            "sent": self.sent,
+            "edits": self.edits,
+            "merged_edits": self.merged,
+            "rate_limited": self.rate_limited,
+            "failed": self.failed,
+        }
+
+
+# singleton
+outbound = OutboundQueue()
@@ -0,0 +1,140 @@
+"""Write-behind persistence: buffer log rows in memory and flush them as bulk multi-row inserts."""
+import os
+import time
+import asyncio
+import logging
+from typing import Callable, Dict, List, Optional, Tuple
+
+from sqlalchemy import insert
+
+logger = logging.getLogger(__name__)
+
+WRITE_BATCH_SIZE = int(os.getenv("WRITE_BATCH_SIZE", "200"))
+WRITE_FLUSH_INTERVAL = float(os.getenv("WRITE_FLUSH_INTERVAL", "0.5"))
+# pending rows before add() starts blocking callers (backpressure)
+WRITE_MAX_PENDING = int(os.getenv("WRITE_MAX_PENDING", "5000"))
+WRITE_RETRIES = 3
+
+# (model class, column values, callback receiving the inserted primary key)
+_Entry = Tuple[type, dict, Optional[Callable[[int], None]]]
+
+
+class WriteBehind:
+    """Buffers rows and inserts them in batches, on whichever of size / time triggers first.
+
+    `add()` returns as soon as the row is buffered; it only waits when WRITE_MAX_PENDING
+    rows are already queued. Callbacks run after the batch commits with the row's new id,
+    so events that need a DB id can be published once the row exists.
+    """
+
+    def __init__(self, batch_size: int = WRITE_BATCH_SIZE, flush_interval: float = WRITE_FLUSH_INTERVAL, max_pending: int = WRITE_MAX_PENDING):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self._session_factory = None
+        self._queue: asyncio.Queue | None = None
+        self._task: asyncio.Task | None = None
+        self._closing = False
+        self.flushed_rows = 0
+        self.flushes = 0
+        self.dropped = 0
+
+    def configure(self, session_factory) -> None:
+        self._session_factory = session_factory
+
+    def _ensure_running(self) -> None:
+        if self._queue is None:
+            self._queue = asyncio.Queue(maxsize=self.max_pending)
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def add(self, model_cls: type, values: dict, on_flushed: Optional[Callable[[int], None]] = None) -> None:
+        if self._closing:
+            raise RuntimeError("write-behind buffer is closed")
+        self._ensure_running()
+        await self._queue.put((model_cls, values, on_flushed))
+
+    async def _collect(self) -> List[_Entry]:
+        batch = [await self._queue.get()]
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or self._closing:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        # take anything else already buffered without waiting
+        while len(batch) < self.batch_size and not self._queue.empty():
+            batch.append(self._queue.get_nowait())
+        return batch
+
+    async def _write(self, batch: List[_Entry]) -> None:
+        groups: Dict[type, List[_Entry]] = {}
+        for entry in batch:
+            groups.setdefault(entry[0], []).append(entry)
+        for attempt in range(1, WRITE_RETRIES + 1):
+            try:
+                callbacks = []
+                async with self._session_factory() as session:
+                    for model_cls, entries in groups.items():
+                        table = model_cls.__table__
+                        stmt = insert(table).returning(table.c.id, sort_by_parameter_order=True)
+                        result = await session.execute(stmt, [e[1] for e in entries])
+                        ids = [r[0] for r in result.fetchall()]
+                        callbacks.extend((e[2], row_id) for e, row_id in zip(entries, ids) if e[2])
+                    await session.commit()
+                break
+            except Exception:
+                logger.exception("Write-behind flush failed (attempt %d/%d, %d rows)", attempt, WRITE_RETRIES, len(batch))
+                if attempt == WRITE_RETRIES:
+                    self.dropped += len(batch)
+                    return
+                await asyncio.sleep(0.2 * attempt)
+        self.flushes += 1
+        self.flushed_rows += len(batch)
+        for cb, row_id in callbacks:
+            try:
+                cb(row_id)
+            except Exception:
+                logger.exception("Write-behind callback failed")
+
+    async def _run(self) -> None:
+        while True:
+            batch = await self._collect()
+            try:
+                await self._write(batch)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    async def flush(self) -> None:
+        """Wait until every row buffered so far is written."""
+        if self._queue is not None:
+            await self._queue.join()
+
+    async def close(self) -> None:
+        """Drain the buffer and stop the flusher (call on shutdown)."""
+        self._closing = True
+        if self._queue is None:
+            return
+        if self._task is not None and not self._task.done():
+            await self._queue.join()
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    def stats(self) -> dict:
+        return {
+            "pending": self._queue.qsize() if self._queue else 0,
+            "flushes": self.flushes,
+            "flushed_rows": self.flushed_rows,
+            "dropped": self.dropped,
+        }
+
+
+# singleton
+write_behind = WriteBehind()
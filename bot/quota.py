@@ -0,0 +1,217 @@
+"""In-memory sliding-window quota enforcement for the `quota` table.
+
+Quota rows are matched by name:
+- `free_tokens`   global token budget
+- `guild:<id>`    per-guild budget
+- `user:<id>`     per-user budget
+
+Counters are seeded from `usage_logs` at startup and updated on every reply, so the check before a
+Gemini call is a couple of dict lookups. Crossing a threshold publishes `quota:warning`,
+`quota:paused` and `quota:resumed` broadcaster events. Usage itself is shared with the other
+processes as an unsequenced event bus message, so it never reaches SSE clients.
+"""
+import os
+import time
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import select
+
+from shared.models import Quota, UsageLog
+from bot.events import broadcaster, encode_json
+from bot.eventbus import event_bus
+
+logger = logging.getLogger(__name__)
+
+GLOBAL_QUOTA = "free_tokens"
+QUOTA_BUCKETS = int(os.getenv("QUOTA_BUCKETS", "60"))
+QUOTA_WARN_RATIO = float(os.getenv("QUOTA_WARN_RATIO", "0.8"))
+# how often paused scopes are re-checked so `quota:resumed` fires without traffic (seconds)
+QUOTA_TICK = float(os.getenv("QUOTA_TICK", "30"))
+USAGE_TYPE = "quota:usage"
+
+LEVEL_OK = 0
+LEVEL_WARN = 1
+LEVEL_PAUSED = 2
+
+
+class SlidingWindowCounter:
+    """Sum over the last `window` seconds, kept in `buckets` fixed slots (O(1) amortized add/total)."""
+
+    def __init__(self, window: float, buckets: int = QUOTA_BUCKETS):
+        self.window = float(window)
+        self.buckets = max(1, buckets)
+        self.width = self.window / self.buckets
+        self._slots = [0.0] * self.buckets
+        self._head = 0  # absolute index of the newest slot
+        self._total = 0.0
+
+    def _advance(self, now: float) -> None:
+        idx = int(now // self.width)
+        if idx <= self._head:
+            return
+        if idx - self._head >= self.buckets:
+            self._slots = [0.0] * self.buckets
+            self._total = 0.0
+        else:
+            for i in range(self._head + 1, idx + 1):
+                slot = i % self.buckets
+                self._total -= self._slots[slot]
+                self._slots[slot] = 0.0
+        self._head = idx
+
+    def add(self, amount: float, now: Optional[float] = None, at: Optional[float] = None) -> None:
+        """Add `amount` now, or at an earlier timestamp `at` (used when seeding)."""
+        now = time.time() if now is None else now
+        self._advance(now)
+        at = now if at is None else at
+        if at <= now - self.window:
+            return
+        idx = int(at // self.width)
+        self._slots[idx % self.buckets] += amount
+        self._total += amount
+
+    def total(self, now: Optional[float] = None) -> float:
+        self._advance(time.time() if now is None else now)
+        return max(self._total, 0.0)
+
+
+class QuotaEngine:
+    def __init__(self):
+        self._limits: Dict[str, Tuple[float, int]] = {}
+        self._counters: Dict[str, SlidingWindowCounter] = {}
+        self._levels: Dict[str, int] = {}
+        self._session_factory = None
+        self._task: asyncio.Task | None = None
+
+    async def load(self, session_factory) -> None:
+        """Read quota limits and seed counters from usage inside each window."""
+        if self._session_factory is None:
+            broadcaster.register_handler(self._on_broadcast)
+            event_bus.on(USAGE_TYPE, self._on_usage)
+        self._session_factory = session_factory
+        async with session_factory() as session:
+            rows = (await session.execute(Quota.__table__.select())).fetchall()
+            limits = {r.name: (float(r.limit), int(r.window_seconds or 86400)) for r in rows}
+            self._set_limits(limits)
+            if limits:
+                since = datetime.utcnow() - timedelta(seconds=max(w for _, w in limits.values()))
+                q = await session.execute(
+                    select(UsageLog.guild_id, UsageLog.user_id, UsageLog.tokens, UsageLog.created_at).where(UsageLog.created_at >= since)
+                )
+                now = time.time()
+                offset = now - datetime.utcnow().timestamp()
+                for guild_id, user_id, tokens, created_at in q.fetchall():
+                    at = created_at.timestamp() + offset if created_at else now
+                    for name in self._scopes(guild_id, user_id):
+                        self._counters[name].add(float(tokens or 0.0), now=now, at=at)
+        for name in list(self._counters):
+            self._evaluate(name, publish=False)
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._tick())
+        logger.info("Quota engine loaded (%d quotas)", len(self._limits))
+
+    def _set_limits(self, limits: Dict[str, Tuple[float, int]]) -> None:
+        for name, (limit, window) in limits.items():
+            old = self._limits.get(name)
+            if old is None or old[1] != window:
+                self._counters[name] = SlidingWindowCounter(window)
+        for name in list(self._counters):
+            if name not in limits:
+                self._counters.pop(name, None)
+                self._levels.pop(name, None)
+        self._limits = limits
+
+    def _scopes(self, guild_id: Optional[int], user_id: Optional[int]) -> List[str]:
+        names = [GLOBAL_QUOTA]
+        if guild_id is not None:
+            names.append(f"guild:{guild_id}")
+        if user_id is not None:
+            names.append(f"user:{user_id}")
+        return [n for n in names if n in self._limits]
+
+    def _evaluate(self, name: str, publish: bool = True) -> int:
+        limit, window = self._limits[name]
+        used = self._counters[name].total()
+        ratio = used / limit if limit > 0 else 1.0
+        level = LEVEL_PAUSED if ratio >= 1.0 else LEVEL_WARN if ratio >= QUOTA_WARN_RATIO else LEVEL_OK
+        prev = self._levels.get(name, LEVEL_OK)
+        self._levels[name] = level
+        if publish and level != prev:
+            if level == LEVEL_PAUSED:
+                event = "quota:paused"
+            elif prev == LEVEL_PAUSED:
+                event = "quota:resumed"
+            elif level == LEVEL_WARN:
+                event = "quota:warning"
+            else:
+                event = None
+            if event:
+                logger.info("%s %s (%.0f/%.0f tokens)", event, name, used, limit)
+                try:
+                    broadcaster.publish({"type": event, "payload": {"scope": name, "used": used, "limit": limit, "window_seconds": window}})
+                except Exception:
+                    logger.exception("Quota event publish failed")
+        return level
+
+    def check(self, guild_id: Optional[int], user_id: Optional[int]) -> Optional[str]:
+        """Return the first exhausted scope name for this guild/user, or None if the call may proceed."""
+        for name in self._scopes(guild_id, user_id):
+            level = self._levels.get(name, LEVEL_OK)
+            if level == LEVEL_PAUSED:
+                # the window may have slid since the last record(): re-evaluate before refusing
+                level = self._evaluate(name)
+            if level == LEVEL_PAUSED:
+                return name
+        return None
+
+    def record(self, guild_id: Optional[int], user_id: Optional[int], tokens: float, local: bool = True) -> None:
+        """Count `tokens` against every matching scope. Local usage is also sent to the other
+        processes over the event bus, which apply it with `local=False`, silently."""
+        for name in self._scopes(guild_id, user_id):
+            self._counters[name].add(float(tokens or 0.0))
+            self._evaluate(name, publish=local)
+        if local:
+            payload = {"guild_id": guild_id, "user_id": user_id, "tokens": float(tokens or 0.0)}
+            event_bus.send(encode_json({"type": USAGE_TYPE, "payload": payload}), sequenced=False)
+
+    def usage(self, name: str = GLOBAL_QUOTA) -> Optional[dict]:
+        if name not in self._limits:
+            return None
+        limit, window = self._limits[name]
+        return {"scope": name, "used": self._counters[name].total(), "limit": limit, "window_seconds": window,
+                "paused": self._levels.get(name) == LEVEL_PAUSED}
+
+    async def reload(self) -> None:
+        if self._session_factory is None:
+            return
+        async with self._session_factory() as session:
+            rows = (await session.execute(Quota.__table__.select())).fetchall()
+        self._set_limits({r.name: (float(r.limit), int(r.window_seconds or 86400)) for r in rows})
+
+    async def _tick(self) -> None:
+        while True:
+            await asyncio.sleep(QUOTA_TICK)
+            for name, level in list(self._levels.items()):
+                if level != LEVEL_OK and name in self._limits:
+                    self._evaluate(name)
+
+    async def _on_broadcast(self, data):
+        try:
+            if not isinstance(data, dict):
+                return
+            if data.get("type") == "quota:updated":
+                await self.reload()
+        except Exception:
+            logger.exception("Quota reload failed")
+
+    def _on_usage(self, data: dict) -> None:
+        # usage recorded by another process
+        p = data.get("payload") or {}
+        self.record(p.get("guild_id"), p.get("user_id"), p.get("tokens") or 0.0, local=False)
+
+
+# singleton
+quota_engine = QuotaEngine()
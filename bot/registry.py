@@ -0,0 +1,98 @@
+"""In-process registry of AI channel IDs so the message hot path is a dict lookup instead of a DB query."""
+import asyncio
+import logging
+from typing import Dict, Optional
+
+from shared.models import AIChannel
+from bot.events import broadcaster
+
+logger = logging.getLogger(__name__)
+
+
+class ChannelRegistry:
+    """channel_id -> guild_id for every registered AI channel.
+
+    Loaded once from `ai_channels` at startup and kept current through the
+    `channel:created` / `channel:deleted` broadcaster events. If the load fails the registry
+    still becomes ready, and lookup() falls back to querying the table per channel.
+    """
+
+    def __init__(self):
+        self._channels: Dict[int, Optional[int]] = {}
+        self._ready = asyncio.Event()
+        self._subscribed = False
+        self._session_factory = None
+        self.failed = False
+
+    @property
+    def loaded(self) -> bool:
+        return self._ready.is_set()
+
+    async def wait_ready(self) -> None:
+        await self._ready.wait()
+
+    async def load(self, session_factory) -> None:
+        self._session_factory = session_factory
+        if not self._subscribed:
+            broadcaster.register_handler(self._on_broadcast)
+            self._subscribed = True
+        try:
+            async with session_factory() as session:
+                q = await session.execute(AIChannel.__table__.select())
+                rows = q.fetchall()
+            self._channels.update({row.channel_id: row.guild_id for row in rows})
+            self.failed = False
+            logger.info("Channel registry loaded (%d AI channels)", len(self._channels))
+        except Exception:
+            self.failed = True
+            raise
+        finally:
+            # never leave the dispatcher waiting; a failed load is served by lookup()'s fallback
+            self._ready.set()
+
+    async def lookup(self, channel_id: int) -> bool:
+        """`channel_id in registry`, asking the database directly while the initial load has failed."""
+        if channel_id in self._channels or not self.failed or self._session_factory is None:
+            return channel_id in self._channels
+        try:
+            async with self._session_factory() as session:
+                q = await session.execute(AIChannel.__table__.select().where(AIChannel.channel_id == channel_id))
+                row = q.first()
+        except Exception:
+            logger.exception("AI channel lookup failed for %s", channel_id)
+            return False
+        if row is None:
+            return False
+        self.add(row.channel_id, row.guild_id)
+        return True
+
+    def add(self, channel_id: int, guild_id: Optional[int] = None) -> None:
+        self._channels[int(channel_id)] = guild_id
+
+    def remove(self, channel_id: int) -> None:
+        self._channels.pop(int(channel_id), None)
+
+    def __contains__(self, channel_id: int) -> bool:
+        return channel_id in self._channels
+
+    def __len__(self) -> int:
+        return len(self._channels)
+
+    def guild_of(self, channel_id: int) -> Optional[int]:
+        return self._channels.get(channel_id)
+
+    async def _on_broadcast(self, data):
+        try:
+            if not isinstance(data, dict):
+                return
+            payload = data.get("payload") or {}
+            if data.get("type") == "channel:created":
+                self.add(payload.get("id") or payload.get("channel_id"), payload.get("guild_id"))
+            elif data.get("type") == "channel:deleted":
+                self.remove(payload.get("channel_id") or payload.get("id"))
+        except Exception:
+            logger.exception("Channel registry update failed")
+
+
+# singleton
+channel_registry = ChannelRegistry()
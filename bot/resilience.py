@@ -0,0 +1,161 @@
+"""Per-model circuit breakers and latency tracking used for hedged Gemini requests."""
+import os
+import time
+import logging
+from collections import deque
+from typing import Deque, Dict, Tuple
+
+logger = logging.getLogger(__name__)
+
+# per-call deadline (seconds); streams apply it to the first chunk and to each gap between chunks
+GEMINI_DEADLINE = float(os.getenv("GEMINI_DEADLINE", "30"))
+# calls slower than this count as "slow" for the breaker
+GEMINI_SLOW_CALL = float(os.getenv("GEMINI_SLOW_CALL", "15"))
+BREAKER_WINDOW = int(os.getenv("GEMINI_BREAKER_WINDOW", "20"))
+BREAKER_MIN_CALLS = int(os.getenv("GEMINI_BREAKER_MIN_CALLS", "5"))
+BREAKER_ERROR_RATE = float(os.getenv("GEMINI_BREAKER_ERROR_RATE", "0.5"))
+BREAKER_SLOW_RATE = float(os.getenv("GEMINI_BREAKER_SLOW_RATE", "0.5"))
+BREAKER_COOLDOWN = float(os.getenv("GEMINI_BREAKER_COOLDOWN", "30"))
+# never hedge earlier than this, even when p95 is tiny
+HEDGE_MIN_DELAY = float(os.getenv("GEMINI_HEDGE_MIN_DELAY", "0.5"))
+HEDGE_MIN_SAMPLES = 20
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class Permit:
+    """One call let through by CircuitBreaker.allow(); pass it back with the call's outcome."""
+
+    __slots__ = ("generation", "probe")
+
+    def __init__(self, generation: int, probe: bool = False):
+        self.generation = generation
+        self.probe = probe
+
+
+class CircuitBreaker:
+    """Trips when the recent window has too many errors or too many slow calls.
+
+    After BREAKER_COOLDOWN seconds an open breaker goes half-open and lets one probe through;
+    only the probe's outcome closes or re-opens it. Every trip starts a new generation, and
+    outcomes of calls let through in an earlier generation are ignored.
+    """
+
+    def __init__(self, model: str):
+        self.model = model
+        self.state = CLOSED
+        self.opened_at = 0.0
+        self.trips = 0
+        self.generation = 0
+        self._probe: Permit | None = None
+        # (ok, seconds) of recent calls
+        self._window: Deque[Tuple[bool, float]] = deque(maxlen=BREAKER_WINDOW)
+        # successful latencies for percentile estimation
+        self._latencies: Deque[float] = deque(maxlen=200)
+
+    def allow(self) -> Permit | None:
+        """A permit for one call, or None while the breaker is open (or its probe is out)."""
+        if self.state == CLOSED:
+            return Permit(self.generation)
+        if self.state == OPEN:
+            if time.monotonic() - self.opened_at < BREAKER_COOLDOWN:
+                return None
+            self.state = HALF_OPEN
+            self._probe = None
+        # half-open: one probe at a time
+        if self._probe is not None:
+            return None
+        self._probe = Permit(self.generation, probe=True)
+        return self._probe
+
+    def _trip(self) -> None:
+        if self.state != OPEN:
+            logger.warning("Circuit breaker for %s opened", self.model)
+            self.trips += 1
+        self.state = OPEN
+        self.opened_at = time.monotonic()
+        self.generation += 1
+        self._probe = None
+
+    def _current(self, permit: Permit) -> bool:
+        # half-open: only the probe counts; otherwise any call of this generation
+        if permit.generation != self.generation:
+            return False
+        return permit is self._probe if self.state == HALF_OPEN else self.state == CLOSED
+
+    def record_success(self, permit: Permit, seconds: float) -> None:
+        if not self._current(permit):
+            return
+        self._latencies.append(seconds)
+        if self.state == HALF_OPEN:
+            logger.info("Circuit breaker for %s closed", self.model)
+            self.state = CLOSED
+            self._probe = None
+            self._window.clear()
+        self._window.append((True, seconds))
+        self._evaluate()
+
+    def record_failure(self, permit: Permit) -> None:
+        if not self._current(permit):
+            return
+        if self.state == HALF_OPEN:
+            self._trip()
+            return
+        self._window.append((False, 0.0))
+        self._evaluate()
+
+    def record_cancel(self, permit: Permit) -> None:
+        """A call was abandoned (e.g. lost a hedge race) without an outcome; a probe is given back."""
+        if permit is self._probe:
+            self._probe = None
+
+    def _evaluate(self) -> None:
+        n = len(self._window)
+        if self.state != CLOSED or n < BREAKER_MIN_CALLS:
+            return
+        errors = sum(1 for ok, _ in self._window if not ok)
+        slow = sum(1 for ok, s in self._window if ok and s >= GEMINI_SLOW_CALL)
+        if errors / n >= BREAKER_ERROR_RATE or slow / n >= BREAKER_SLOW_RATE:
+            self._trip()
+
+    def percentile(self, p: float) -> float | None:
+        if not self._latencies:
+            return None
+        data = sorted(self._latencies)
+        return data[min(len(data) - 1, int(p * len(data)))]
+
+    def hedge_delay(self) -> float | None:
+        """Seconds to wait on the primary before hedging (its p95), or None without enough samples."""
+        if len(self._latencies) < HEDGE_MIN_SAMPLES:
+            return None
+        return max(self.percentile(0.95), HEDGE_MIN_DELAY)
+
+    def stats(self) -> dict:
+        return {
+            "state": self.state,
+            "trips": self.trips,
+            "window": len(self._window),
+            "p50": self.percentile(0.5),
+            "p95": self.percentile(0.95),
+        }
+
+
+class BreakerRegistry:
+    def __init__(self):
+        self._breakers: Dict[str, CircuitBreaker] = {}
+
+    def get(self, model: str) -> CircuitBreaker:
+        b = self._breakers.get(model)
+        if b is None:
+            b = CircuitBreaker(model)
+            self._breakers[model] = b
+        return b
+
+    def stats(self) -> dict:
+        return {m: b.stats() for m, b in self._breakers.items()}
+
+
+# singleton
+breakers = BreakerRegistry()
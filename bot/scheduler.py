@@ -0,0 +1,275 @@
+"""Gemini request scheduler: per-model token buckets, weighted fair queuing across guilds,
+priority classes and bounded queue depth with load shedding."""
+import os
+import time
+import heapq
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Priority classes (lower value is served first)
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 1
+
+GEMINI_RPM = float(os.getenv("GEMINI_RPM", "60"))
+GEMINI_TPM = float(os.getenv("GEMINI_TPM", "1000000"))
+GEMINI_MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", "32"))
+GEMINI_QUEUE_DEPTH = int(os.getenv("GEMINI_QUEUE_DEPTH", "200"))
+# fraction of the queue background work may occupy before it is shed
+BACKGROUND_QUEUE_SHARE = float(os.getenv("GEMINI_BACKGROUND_QUEUE_SHARE", "0.5"))
+# per-(model, guild) finish tags kept before stale ones are dropped, and how long a guild that
+# sends nothing keeps its tag (seconds); it then starts again at the model's virtual time
+LAST_FINISH_PRUNE = 1024
+LAST_FINISH_IDLE = 300.0
+
+
+class SchedulerBusy(Exception):
+    """Raised when a request is shed because the queue is full."""
+
+
+class TokenBucket:
+    """Classic token bucket refilled continuously at `per_minute / 60` tokens per second."""
+
+    def __init__(self, per_minute: float, capacity: float | None = None):
+        self.rate = per_minute / 60.0
+        self.capacity = capacity or per_minute
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, amount: float) -> float:
+        """Seconds until `amount` tokens are available (0 if available now)."""
+        self._refill()
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate if self.rate > 0 else float("inf")
+
+    def take(self, amount: float) -> None:
+        self._refill()
+        self.tokens -= amount
+
+    def refund(self, amount: float) -> None:
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+
+@dataclass
+class ModelLimits:
+    rpm: TokenBucket
+    tpm: TokenBucket
+
+
+@dataclass(order=True)
+class _Request:
+    priority: int
+    finish: float
+    seq: int
+    model: str = field(compare=False)
+    guild_id: Optional[int] = field(compare=False)
+    cost: float = field(compare=False)
+    future: asyncio.Future = field(compare=False)
+    enqueued: float = field(compare=False)
+    # counted in the queue depth (until dispatched or cancelled)
+    queued: bool = field(default=True, compare=False)
+
+
+class Ticket:
+    """Handle for an admitted request; reports queue wait and reconciles token usage."""
+
+    def __init__(self, scheduler: "Scheduler", model: str, cost: float, queue_ms: float):
+        self._scheduler = scheduler
+        self.model = model
+        self.cost = cost
+        self.queue_ms = queue_ms
+
+    def used(self, tokens: float) -> None:
+        """Charge the actual token usage instead of the up-front estimate."""
+        limits = self._scheduler.limits(self.model)
+        delta = tokens - self.cost
+        if delta > 0:
+            limits.tpm.take(delta)
+        elif delta < 0:
+            limits.tpm.refund(-delta)
+        self.cost = tokens
+
+
+class Scheduler:
+    def __init__(self, rpm: float = GEMINI_RPM, tpm: float = GEMINI_TPM, max_concurrency: int = GEMINI_MAX_CONCURRENCY, max_depth: int = GEMINI_QUEUE_DEPTH):
+        self.default_rpm = rpm
+        self.default_tpm = tpm
+        self.max_concurrency = max_concurrency
+        self.max_depth = max_depth
+        self.weights: Dict[int, float] = {}
+        self._limits: Dict[str, ModelLimits] = {}
+        self._queues: Dict[str, List[_Request]] = {}
+        self._virtual: Dict[str, float] = {}
+        # (model, guild_id) -> (finish tag, monotonic time of the guild's last request)
+        self._last_finish: Dict[tuple, Tuple[float, float]] = {}
+        self._prune_at = LAST_FINISH_PRUNE
+        self._depth = 0
+        self._background_depth = 0
+        self._inflight = 0
+        self._seq = 0
+        self._wakeup: asyncio.Event | None = None
+        self._task: asyncio.Task | None = None
+        self.dispatched = 0
+        self.shed = 0
+        self._wait_ms_total = 0.0
+
+    def limits(self, model: str) -> ModelLimits:
+        lim = self._limits.get(model)
+        if lim is None:
+            lim = ModelLimits(TokenBucket(self.default_rpm), TokenBucket(self.default_tpm))
+            self._limits[model] = lim
+        return lim
+
+    def set_limits(self, model: str, rpm: float, tpm: float) -> None:
+        self._limits[model] = ModelLimits(TokenBucket(rpm), TokenBucket(tpm))
+
+    def set_weight(self, guild_id: int, weight: float) -> None:
+        self.weights[guild_id] = max(weight, 0.01)
+
+    def _ensure_running(self) -> None:
+        if self._wakeup is None:
+            self._wakeup = asyncio.Event()
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    def _admit(self, priority: int) -> None:
+        if self._depth >= self.max_depth:
+            self.shed += 1
+            raise SchedulerBusy("queue full")
+        if priority > PRIORITY_INTERACTIVE and self._background_depth >= self.max_depth * BACKGROUND_QUEUE_SHARE:
+            self.shed += 1
+            raise SchedulerBusy("background queue full")
+
+    async def _enqueue(self, model: str, guild_id: Optional[int], priority: int, cost: float) -> Ticket:
+        self._admit(priority)
+        self._ensure_running()
+        # weighted fair queuing: finish tag = max(virtual time, guild's last finish) + cost / weight
+        weight = self.weights.get(guild_id, 1.0)
+        start_tag = max(self._virtual.get(model, 0.0), self._last_finish.get((model, guild_id), (0.0, 0.0))[0])
+        finish = start_tag + cost / weight
+        self._last_finish[(model, guild_id)] = (finish, time.monotonic())
+        if len(self._last_finish) > self._prune_at:
+            self._prune()
+        self._seq += 1
+        fut = asyncio.get_running_loop().create_future()
+        req = _Request(priority, finish, self._seq, model, guild_id, cost, fut, time.perf_counter())
+        heapq.heappush(self._queues.setdefault(model, []), req)
+        self._depth += 1
+        if priority > PRIORITY_INTERACTIVE:
+            self._background_depth += 1
+        self._wakeup.set()
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.cancelled():
+                # abandoned while queued: stop counting it now, the heap entry is skipped later
+                self._dequeued(req)
+            elif fut.done():
+                # dispatched at the same moment we were cancelled: give the slot back
+                self._release()
+            raise
+        queue_ms = (time.perf_counter() - req.enqueued) * 1000.0
+        self._wait_ms_total += queue_ms
+        return Ticket(self, model, cost, queue_ms)
+
+    def _dequeued(self, req: _Request) -> None:
+        if not req.queued:
+            return
+        req.queued = False
+        self._depth -= 1
+        if req.priority > PRIORITY_INTERACTIVE:
+            self._background_depth -= 1
+
+    def _prune(self) -> None:
+        # a finish tag at or behind its model's virtual time no longer changes any start tag, and a
+        # guild idle for LAST_FINISH_IDLE is treated as a new flow
+        idle = time.monotonic() - LAST_FINISH_IDLE
+        self._last_finish = {k: (f, at) for k, (f, at) in self._last_finish.items()
+                             if f > self._virtual.get(k[0], 0.0) and at > idle}
+        self._prune_at = max(LAST_FINISH_PRUNE, 2 * len(self._last_finish))
+
+    def _release(self) -> None:
+        self._inflight -= 1
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def _dispatch_ready(self):
+        """Admit every request that fits the concurrency and rate limits.
+        Returns seconds until the next rate-limited request could go (None if nothing is waiting on a bucket)."""
+        wait = None
+        progress = True
+        while progress:
+            progress = False
+            for model, heap in self._queues.items():
+                while heap and heap[0].future.done():
+                    self._dequeued(heapq.heappop(heap))
+                if not heap or self._inflight >= self.max_concurrency:
+                    continue
+                req = heap[0]
+                lim = self.limits(model)
+                d = max(lim.rpm.delay(1), lim.tpm.delay(req.cost))
+                if d > 0:
+                    wait = d if wait is None else min(wait, d)
+                    continue
+                heapq.heappop(heap)
+                self._dequeued(req)
+                lim.rpm.take(1)
+                lim.tpm.take(req.cost)
+                self._virtual[model] = max(self._virtual.get(model, 0.0), req.finish - req.cost / self.weights.get(req.guild_id, 1.0))
+                self._inflight += 1
+                self.dispatched += 1
+                req.future.set_result(None)
+                progress = True
+        return wait
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                wait = self._dispatch_ready()
+            except Exception:
+                logger.exception("Scheduler dispatch failed")
+                wait = 1.0
+            self._wakeup.clear()
+            try:
+                if wait is None:
+                    await self._wakeup.wait()
+                else:
+                    await asyncio.wait_for(self._wakeup.wait(), wait)
+            except asyncio.TimeoutError:
+                pass
+
+    @asynccontextmanager
+    async def slot(self, model: str, guild_id: Optional[int] = None, priority: int = PRIORITY_INTERACTIVE, cost: float = 1.0):
+        """Wait for a turn to call `model`. Raises SchedulerBusy when the request is shed."""
+        ticket = await self._enqueue(model, guild_id, priority, cost)
+        try:
+            yield ticket
+        finally:
+            self._release()
+
+    def stats(self) -> dict:
+        return {
+            "queued": self._depth,
+            "queued_background": self._background_depth,
+            "in_flight": self._inflight,
+            "dispatched": self.dispatched,
+            "shed": self.shed,
+            "avg_queue_ms": (self._wait_ms_total / self.dispatched) if self.dispatched else 0.0,
+            "buckets": {m: {"rpm": round(l.rpm.tokens, 2), "tpm": round(l.tpm.tokens, 2)} for m, l in self._limits.items()},
+        }
+
+
+# singleton
+scheduler = Scheduler()
@@ -0,0 +1,149 @@
+"""Background conversation summarization, kept off the reply path.
+
+Replies use the current history immediately; a worker compacts long histories with the cheap
+model (debounced per user, several users per pass) and swaps the summary in for the next turn.
+"""
+import os
+import asyncio
+import logging
+from datetime import datetime
+from typing import Deque, Dict, List, Optional, Tuple
+
+from shared.models import ConversationSummary
+from bot.gemini_client import summarize_context
+from bot.memory import conversation_store
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_DEBOUNCE = float(os.getenv("SUMMARY_DEBOUNCE", "2.0"))
+SUMMARY_BATCH = int(os.getenv("SUMMARY_BATCH", "8"))
+
+
+class _Pending:
+    __slots__ = ("guild_id", "history", "due")
+
+    def __init__(self, guild_id: Optional[int], history: Deque[str], due: float):
+        self.guild_id = guild_id
+        self.history = history
+        self.due = due
+
+
+class SummaryWorker:
+    def __init__(self, debounce: float = SUMMARY_DEBOUNCE, batch_size: int = SUMMARY_BATCH):
+        self.debounce = debounce
+        self.batch_size = batch_size
+        self._session_factory = None
+        self._pending: Dict[int, _Pending] = {}
+        self._running: set = set()
+        self._wakeup: asyncio.Event | None = None
+        self._task: asyncio.Task | None = None
+        self.summaries = 0
+        self.stale = 0
+
+    def configure(self, session_factory) -> None:
+        self._session_factory = session_factory
+
+    def request(self, user_id: int, guild_id: Optional[int], history: Deque[str]) -> None:
+        """Ask for `history` to be compacted. Repeated requests within the debounce window collapse into one."""
+        if user_id in self._running:
+            return
+        loop = asyncio.get_running_loop()
+        if user_id not in self._pending:
+            # keep the history in memory until its summary is swapped in (released in _process)
+            conversation_store.pin(user_id)
+        self._pending[user_id] = _Pending(guild_id, history, loop.time() + self.debounce)
+        if self._wakeup is None:
+            self._wakeup = asyncio.Event()
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        self._wakeup.set()
+
+    def _due(self) -> Tuple[List[Tuple[int, _Pending]], Optional[float]]:
+        now = asyncio.get_running_loop().time()
+        ready = sorted(((uid, p) for uid, p in self._pending.items() if p.due <= now), key=lambda x: x[1].due)
+        ready = ready[:self.batch_size]
+        for uid, _ in ready:
+            del self._pending[uid]
+        later = [p.due - now for p in self._pending.values() if p.due > now]
+        return ready, (min(later) if later else None)
+
+    async def _run(self) -> None:
+        while True:
+            ready, wait = self._due()
+            if ready:
+                await self._process(ready)
+                continue
+            self._wakeup.clear()
+            try:
+                if wait is None:
+                    await self._wakeup.wait()
+                else:
+                    await asyncio.wait_for(self._wakeup.wait(), wait)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _process(self, batch: List[Tuple[int, _Pending]]) -> None:
+        snapshots = []
+        for uid, p in batch:
+            self._running.add(uid)
+            snapshots.append(list(p.history))
+        try:
+            results = await asyncio.gather(
+                *(summarize_context("\n".join(snap), guild_id=p.guild_id) for (_, p), snap in zip(batch, snapshots)),
+                return_exceptions=True,
+            )
+            done = []
+            for (uid, p), snap, res in zip(batch, snapshots, results):
+                if isinstance(res, BaseException) or not res.get("summary"):
+                    continue
+                summary = res["summary"]
+                if not self._swap(p.history, snap, summary):
+                    self.stale += 1
+                    continue
+                self.summaries += 1
+                done.append((uid, p.guild_id, summary, res.get("tokens", 0.0)))
+            if done:
+                await self._store(done)
+        except Exception:
+            logger.exception("Summary batch failed")
+        finally:
+            for uid, _ in batch:
+                self._running.discard(uid)
+                conversation_store.release(uid)
+
+    @staticmethod
+    def _swap(history: Deque[str], snapshot: List[str], summary: str) -> bool:
+        """Replace the summarized prefix of `history` with the summary, keeping turns added meanwhile.
+        Runs without awaiting, so the next turn sees either the old or the new history, never a mix."""
+        current = list(history)
+        if current[:len(snapshot)] != snapshot:
+            # history was trimmed meanwhile; the next request will summarize the fresh state
+            return False
+        history.clear()
+        history.append(f"Summary: {summary}")
+        history.extend(current[len(snapshot):])
+        return True
+
+    async def _store(self, rows: List[Tuple[int, Optional[int], str, float]]) -> None:
+        if self._session_factory is None:
+            return
+        async with self._session_factory() as session:
+            for user_id, guild_id, summary, tokens in rows:
+                q = await session.execute(ConversationSummary.__table__.select().where(ConversationSummary.user_id == user_id))
+                existing = q.first()
+                if existing:
+                    await session.execute(
+                        ConversationSummary.__table__.update()
+                        .where(ConversationSummary.user_id == user_id)
+                        .values(summary=summary, tokens_used=tokens, updated_at=datetime.utcnow())
+                    )
+                else:
+                    session.add(ConversationSummary(user_id=user_id, guild_id=guild_id, summary=summary, tokens_used=tokens))
+            await session.commit()
+
+    def stats(self) -> dict:
+        return {"pending": len(self._pending), "running": len(self._running), "summaries": self.summaries, "stale": self.stale}
+
+
+# singleton
+summarizer = SummaryWorker()
@@ -0,0 +1,86 @@
+"""Metrics of every process in one place.
+
+Each process pushes metrics.snapshot() over the event bus every METRICS_PUSH_INTERVAL seconds.
+The API keeps the latest snapshot per process and renders them next to its own with a
+`process` label, so /api/metrics shows the bot's on_message stages even though they are
+recorded in another process. Snapshots are bus-only messages and never reach SSE clients.
+"""
+import os
+import time
+import asyncio
+import logging
+from typing import Dict, Tuple
+
+from bot.events import encode_json
+from bot.eventbus import event_bus
+from bot.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+METRICS_PUSH_INTERVAL = float(os.getenv("METRICS_PUSH_INTERVAL", "5"))
+SNAPSHOT_TYPE = "metrics:snapshot"
+# a process that missed this many pushes is dropped from the output
+STALE_PUSHES = 3
+
+
+class MetricsReporter:
+    def __init__(self, interval: float = METRICS_PUSH_INTERVAL):
+        self.interval = interval
+        self.process = "local"
+        self._remote: Dict[str, Tuple[float, dict]] = {}
+        self._task: asyncio.Task | None = None
+
+    def start(self, process: str) -> None:
+        """Publish this process's snapshots as `process` and collect everyone else's."""
+        self.process = process
+        event_bus.on(SNAPSHOT_TYPE, self._receive)
+        if event_bus.enabled and self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                self.push()
+            except Exception:
+                logger.exception("Metrics snapshot push failed")
+
+    def push(self) -> None:
+        payload = {"process": self.process, "metrics": metrics.snapshot()}
+        event_bus.send(encode_json({"type": SNAPSHOT_TYPE, "payload": payload}), sequenced=False)
+
+    def _receive(self, data: dict) -> None:
+        payload = data.get("payload") or {}
+        process = payload.get("process")
+        snapshot = payload.get("metrics")
+        if process and isinstance(snapshot, dict):
+            self._remote[process] = (time.monotonic(), snapshot)
+
+    def snapshots(self) -> Dict[str, dict]:
+        """Latest snapshot per process, this one included."""
+        cutoff = time.monotonic() - STALE_PUSHES * self.interval
+        for process in [p for p, (ts, _) in self._remote.items() if ts < cutoff]:
+            del self._remote[process]
+        snapshots = {p: snapshot for p, (_, snapshot) in self._remote.items()}
+        snapshots[self.process] = metrics.snapshot()
+        return snapshots
+
+    def render(self) -> str:
+        return metrics.render(self.snapshots())
+
+    def section(self, name: str) -> dict:
+        """One stats section (see Metrics.source) from every process that reports it."""
+        return {p: s["stats"][name] for p, s in self.snapshots().items() if name in (s.get("stats") or {})}
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+# singleton
+metrics_reporter = MetricsReporter()
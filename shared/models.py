@@ -1,6 +1,6 @@
 """Shared SQLAlchemy models used by bot and API"""
 from datetime import datetime
-from sqlalchemy import (Column, Integer, BigInteger, String, DateTime, Float, Text)
+from sqlalchemy import (Column, Integer, BigInteger, String, DateTime, Float, Text, inspect, text)
 from sqlalchemy.ext.declarative import declarative_base
 
 Base = declarative_base()
@@ -48,6 +48,7 @@ class GuildConfig(Base):
     prefix = Column(String, default="/")
     mode = Column(String, default="standard")
     reaction_channels = Column(Text, nullable=True)  # JSON list of channel ids
+    intents = Column(Text, nullable=True)  # JSON list of local intent specs (see bot/intents.py)
 
 
 class ChatLog(Base):
@@ -62,7 +63,9 @@ class ChatLog(Base):
     user_message = Column(Text, nullable=False)
     bot_response = Column(Text, nullable=True)
     tokens = Column(Float, default=0.0)
-    latency_ms = Column(Float, default=0.0)
+    queue_ms = Column(Float, default=0.0)  # wait in the Gemini scheduler
+    ttft_ms = Column(Float, default=0.0)  # time to first streamed token
+    latency_ms = Column(Float, default=0.0)  # total generation time
     created_at = Column(DateTime, default=datetime.utcnow)
 
 
@@ -133,3 +136,27 @@ class Stats(Base):
     total_messages = Column(Integer, default=0)
     unique_users = Column(Integer, default=0)
     updated_at = Column(DateTime, default=datetime.utcnow)
+
+
+# Columns added to existing tables after their first release. create_all() only creates
+# missing tables, so these are added with ALTER TABLE on startup (see migrate()).
+ADDED_COLUMNS = {
+    "chat_logs": {
+        "queue_ms": "FLOAT DEFAULT 0.0",
+        "ttft_ms": "FLOAT DEFAULT 0.0",
+    },
+    "guild_configs": {
+        "intents": "TEXT",
+    },
+}
+
+
+def migrate(conn):
+    """Create missing tables and add missing columns. Run with `await conn.run_sync(migrate)`."""
+    Base.metadata.create_all(conn)
+    inspector = inspect(conn)
+    for table, columns in ADDED_COLUMNS.items():
+        existing = {c["name"] for c in inspector.get_columns(table)}
+        for name, ddl in columns.items():
+            if name not in existing:
+                conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {name} {ddl}"))
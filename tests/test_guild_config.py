@@ -0,0 +1,28 @@
+import asyncio
+
+from bot.guild_config import GuildConfigCache, GuildConfigSnapshot
+
+
+def test_cancelled_first_caller_does_not_cancel_waiters():
+    async def scenario():
+        cache = GuildConfigCache()
+        release = asyncio.Event()
+
+        async def load(guild_id):
+            await release.wait()
+            return GuildConfigSnapshot(guild_id=guild_id, mode="creative")
+
+        cache._load = load
+        first = asyncio.create_task(cache.get(1))
+        await asyncio.sleep(0)
+        second = asyncio.create_task(cache.get(1))
+        await asyncio.sleep(0)
+        first.cancel()
+        await asyncio.sleep(0)
+        release.set()
+        snap = await second
+        assert first.cancelled()
+        assert snap.mode == "creative"
+        assert not cache._loading
+
+    asyncio.run(scenario())
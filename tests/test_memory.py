@@ -0,0 +1,30 @@
+import asyncio
+
+from bot.memory import ConversationStore
+
+
+def test_cancelled_first_loader_does_not_fail_waiters():
+    async def scenario():
+        store = ConversationStore()
+        release = asyncio.Event()
+
+        async def rehydrate(user_id):
+            await release.wait()
+            return ["user: hi", "bot: hello"]
+
+        store._rehydrate = rehydrate
+        first = asyncio.create_task(store.get(7))
+        await asyncio.sleep(0)
+        second = asyncio.create_task(store.get(7))
+        await asyncio.sleep(0)
+        first.cancel()
+        await asyncio.sleep(0)
+        release.set()
+        hist = await second
+        assert first.cancelled()
+        assert list(hist) == ["user: hi", "bot: hello"]
+        assert store.stats()["pinned"] == 1
+        store.release(7)
+        assert not store._loading
+
+    asyncio.run(scenario())
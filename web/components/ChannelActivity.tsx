@@ -1,31 +1,24 @@
 "use client"
 
-import React, { useEffect, useState } from 'react'
+import React, { useState } from 'react'
+import { useEventStream } from '@/lib/eventStream'
 
 type Activity = { channel_id: number; name?: string; score: number }
 
 export default function ChannelActivity() {
   const [activities, setActivities] = useState<Activity[]>([])
 
-  useEffect(() => {
-    const es = new EventSource('/api/stream')
-    es.onmessage = (ev) => {
-      try {
-        const d = JSON.parse(ev.data)
-        if (d.type === 'chat' && d.payload.channel_id) {
-          const id = d.payload.channel_id
-          setActivities(prev => {
-            const found = prev.find(p => p.channel_id === id)
-            if (found) {
-              return prev.map(p => p.channel_id === id ? { ...p, score: Math.min(p.score + 1, 100) } : { ...p, score: Math.max(p.score - 0.02, 0) })
-            }
-            return [{ channel_id: id, name: d.payload.channel_name || `#${id}`, score: 1 }, ...prev].slice(0, 20)
-          })
-        }
-      } catch (e) {}
-    }
-    return () => es.close()
-  }, [])
+  useEventStream(['chat'], (d) => {
+    if (d.type !== 'chat' || !d.payload.channel_id) return
+    const id = d.payload.channel_id
+    setActivities(prev => {
+      const found = prev.find(p => p.channel_id === id)
+      if (found) {
+        return prev.map(p => p.channel_id === id ? { ...p, score: Math.min(p.score + 1, 100) } : { ...p, score: Math.max(p.score - 0.02, 0) })
+      }
+      return [{ channel_id: id, name: d.payload.channel_name || `#${id}`, score: 1 }, ...prev].slice(0, 20)
+    })
+  })
 
   return (
     <div className="space-y-2">
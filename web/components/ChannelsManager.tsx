@@ -1,6 +1,7 @@
 "use client"
 
 import React, { useEffect, useState } from 'react'
+import { useEventStream } from '@/lib/eventStream'
 
 type Channel = {
   id: number
@@ -25,24 +26,19 @@ export default function ChannelsManager() {
       setPrivateChannels(data.private || [])
     }
     load()
+  }, [])
 
-    const es = new EventSource('/api/stream')
-    es.onmessage = (ev) => {
-      try {
-        const d = JSON.parse(ev.data)
-        if (d.type === 'channel:created') {
-          const p = d.payload
-          if (p.type === 'public') setPublicChannels(prev => [p, ...prev])
-          else setPrivateChannels(prev => [p, ...prev])
-        }
-        if (d.type === 'channel:deleted') {
-          setPublicChannels(prev => prev.filter(c => c.channel_id !== d.payload.channel_id))
-          setPrivateChannels(prev => prev.filter(c => c.channel_id !== d.payload.channel_id))
-        }
-      } catch (e) {}
+  useEventStream(['channel'], (d) => {
+    if (d.type === 'channel:created') {
+      const p = d.payload
+      if (p.type === 'public') setPublicChannels(prev => [p, ...prev])
+      else setPrivateChannels(prev => [p, ...prev])
     }
-    return () => es.close()
-  }, [])
+    if (d.type === 'channel:deleted') {
+      setPublicChannels(prev => prev.filter(c => c.channel_id !== d.payload.channel_id))
+      setPrivateChannels(prev => prev.filter(c => c.channel_id !== d.payload.channel_id))
+    }
+  })
 
   async function archiveChannel(channel_id: number) {
     if (!confirm('チャネルをアーカイブしますか？')) return
@@ -1,6 +1,7 @@
 "use client"
 
 import React, { useEffect, useState } from 'react'
+import { useEventStream } from '@/lib/eventStream'
 
 type ChatItem = {
   id: number
@@ -9,6 +10,7 @@ type ChatItem = {
   user_message: string
   bot_response: string
   tokens: number
+  ttft_ms?: number
   latency_ms: number
   created_at: string
 }
@@ -16,31 +18,28 @@ type ChatItem = {
 export default function ChatLog() {
   const [items, setItems] = useState<ChatItem[]>([])
 
-  useEffect(() => {
-    async function load() {
-      try {
-        const res = await fetch('/api/chatlogs?limit=100')
-        const data = await res.json()
-        setItems(data.items || [])
-      } catch (e) {
-        console.error(e)
-      }
+  async function load() {
+    try {
+      const res = await fetch('/api/chatlogs?limit=100')
+      const data = await res.json()
+      setItems(data.items || [])
+    } catch (e) {
+      console.error(e)
     }
+  }
+
+  useEffect(() => {
     load()
+  }, [])
 
-    const es = new EventSource('/api/stream')
-    es.onmessage = (ev) => {
-      try {
-        const d = JSON.parse(ev.data)
-        if (d.type === 'chat') {
-          setItems(prev => [d.payload, ...prev].slice(0, 100))
-        }
-      } catch (e) {
-        // ignore
-      }
+  // reconnects replay missed events from the server's buffer; only a reset needs a refetch
+  useEventStream(['chat'], (d) => {
+    if (d.type === 'stream:reset') {
+      load()
+      return
     }
-    return () => es.close()
-  }, [])
+    setItems(prev => [d.payload, ...prev].slice(0, 100))
+  })
 
   return (
     <div className="space-y-3">
@@ -67,6 +66,7 @@ export default function ChatLog() {
               <div className="mt-2 text-sm text-teal-300">AI: {item.bot_response}</div>
               <div className="mt-3 flex items-center gap-3 text-xs text-gray-400">
                 <div>Tokens: <strong className="text-white">{Math.round(item.tokens)}</strong></div>
+                <div>TTFT: <strong className="text-white">{Math.round(item.ttft_ms ?? item.latency_ms)}ms</strong></div>
                 <div>Latency: <strong className="text-white">{Math.round(item.latency_ms)}ms</strong></div>
               </div>
             </div>
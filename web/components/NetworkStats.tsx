@@ -1,32 +1,23 @@
 "use client"
 
-import React, { useEffect, useState } from 'react'
+import React, { useState } from 'react'
 import { LineChart, Line, XAxis, YAxis, Tooltip, ResponsiveContainer } from 'recharts'
+import { useEventStream } from '@/lib/eventStream'
 
 type NetPoint = { t: string; rx: number; tx: number }
 
 export default function NetworkStats() {
   const [data, setData] = useState<NetPoint[]>([])
 
-  useEffect(() => {
-    const es = new EventSource('/api/stream')
-    es.onmessage = (ev) => {
-      try {
-        const d = JSON.parse(ev.data)
-        if (d.type === 'network') {
-          const ts = new Date(d.payload.timestamp)
-          const label = ts.toLocaleTimeString()
-          setData(prev => {
-            const next = [...prev, { t: label, rx: d.payload.rx, tx: d.payload.tx }]
-            return next.slice(-40)
-          })
-        }
-      } catch (e) {
-        // ignore
-      }
-    }
-    return () => es.close()
-  }, [])
+  useEventStream(['network'], (d) => {
+    if (d.type !== 'network') return
+    const ts = new Date(d.payload.timestamp)
+    const label = ts.toLocaleTimeString()
+    setData(prev => {
+      const next = [...prev, { t: label, rx: d.payload.rx, tx: d.payload.tx }]
+      return next.slice(-40)
+    })
+  })
 
   return (
     <div className="p-4 rounded-2xl bg-[#0b0b0b] border border-[#1a1a1a]">
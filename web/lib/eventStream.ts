@@ -0,0 +1,76 @@
+"use client"
+
+import { useEffect, useRef } from 'react'
+
+// One multiplexed EventSource per page: widgets register the event types they need and the
+// connection is (re)opened with the union of those types as a server-side filter.
+// The browser resends Last-Event-ID on its own reconnects; when we reopen the connection
+// ourselves the last seen id is passed explicitly so nothing is missed in between.
+
+export type StreamEvent = { type: string; payload: any }
+type Listener = { types: string[]; handler: (ev: StreamEvent) => void }
+
+const listeners = new Set<Listener>()
+let source: EventSource | null = null
+let sourceKey = ''
+let lastEventId = ''
+let scheduled = false
+
+function matches(types: string[], type: string) {
+  // stream:reset (missed events no longer buffered) goes to every widget
+  return type === 'stream:reset' || types.includes(type) || types.includes(type.split(':')[0])
+}
+
+function reconnect() {
+  scheduled = false
+  const types = Array.from(new Set(Array.from(listeners).flatMap(l => l.types))).sort()
+  const key = types.join(',')
+  if (source && key === sourceKey) return
+  source?.close()
+  source = null
+  sourceKey = key
+  if (!types.length) return
+  const resume = lastEventId ? `&last_event_id=${lastEventId}` : ''
+  source = new EventSource(`/api/stream?types=${encodeURIComponent(key)}${resume}`)
+  source.onmessage = (ev) => {
+    if (ev.lastEventId) lastEventId = ev.lastEventId
+    let d: StreamEvent
+    try {
+      d = JSON.parse(ev.data)
+    } catch (e) {
+      return
+    }
+    listeners.forEach(l => {
+      if (!matches(l.types, d.type)) return
+      try {
+        l.handler(d)
+      } catch (e) {
+        console.error(e)
+      }
+    })
+  }
+}
+
+function schedule() {
+  // batch the registrations of one render pass into a single (re)connect
+  if (scheduled) return
+  scheduled = true
+  queueMicrotask(reconnect)
+}
+
+export function subscribeEvents(types: string[], handler: (ev: StreamEvent) => void) {
+  const listener = { types, handler }
+  listeners.add(listener)
+  schedule()
+  return () => {
+    listeners.delete(listener)
+    schedule()
+  }
+}
+
+export function useEventStream(types: string[], handler: (ev: StreamEvent) => void) {
+  const ref = useRef(handler)
+  ref.current = handler
+  const key = types.join(',')
+  useEffect(() => subscribeEvents(key.split(','), ev => ref.current(ev)), [key])
+}